@@ -7,6 +7,8 @@ Created on Fri Jun 5 10:00:00 2020
 """
 
 import pickle
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 import numpy as np
 import pandas as pd
@@ -23,6 +25,8 @@ import nxtensor.utils.db_utils as du
 from multiprocessing import Pool
 
 import nxtensor.core.assembly as assembly
+from nxtensor.core.statistics import Statistics, QuantileSketch, merge_statistics, merge_quantile_sketches
+import nxtensor.core.normalization as normalization
 
 import os
 import os.path as path
@@ -30,16 +34,22 @@ import os.path as path
 from nxtensor.exceptions import ConfigurationError
 from nxtensor.extraction import ExtractionConfig
 from nxtensor.utils.tensor_dimensions import TensorDimension
+from nxtensor.utils.hdf5_option_names import Hdf5OptName
+from nxtensor.utils.normalization_modes import NormalizationMode
 
 import random
 
+# The number of images stacked at once by streaming_channel_stacking.
+STACKING_CHUNK_SIZE: int = 1024
+
 
 def preprocessing(extraction_conf_file_path: str) -> None:
     extraction_conf = ExtractionConfig.load(extraction_conf_file_path)
     print(f"> starting pre-process of assemble '{extraction_conf.str_id}'")
     metadata_block_has_header = True
     preprocessing_file_path = __generate_preprocessing_file_path(extraction_conf)
-    periods, label_ids, block_file_structure = assembly.compute_block_file_structure(extraction_conf.blocks_dir_path)
+    periods, label_ids, block_file_structure = assembly.compute_block_file_structure(extraction_conf.blocks_dir_path,
+                                                                                     extraction_conf.block_format)
 
     if extraction_conf.has_tensor_to_be_shuffled:
         periods = random.sample(periods, len(periods))
@@ -71,13 +81,20 @@ def __load_extraction_conf(extraction_conf_file_path: str):
         raise ConfigurationError(msg, e)
 
 
+# When has_to_stream is true, the channels are built block after block (see streaming_channel_building): the
+# memory is bounded by the size of a block instead of the size of a channel, but the blocks can't be processed by a
+# user function.
 def channel_building_batch(extraction_conf_file_path: str, nb_workers: int = None,
                            user_specific_block_processing:
                                Callable[[Sequence[Period], Sequence[LabelId],
                                          Mapping[Period, Mapping[LabelId, Tuple[np.ndarray, pd.DataFrame, int]]]],
                                         Tuple[Sequence[Period], Sequence[LabelId],
                                         Mapping[Period, Mapping[LabelId, Tuple[np.ndarray, pd.DataFrame, int]]]]] =
-                               assembly.default_block_processing_func) -> None:
+                               assembly.default_block_processing_func,
+                           has_to_stream: bool = False) -> None:
+    if has_to_stream and user_specific_block_processing is not assembly.default_block_processing_func:
+        msg = '> [ERROR] the blocks of a streamed channel building cannot be processed by a user function'
+        raise ConfigurationError(msg)
     extraction_conf: ExtractionConfig = ExtractionConfig.load(extraction_conf_file_path)
     preprocessing_file_path = __generate_preprocessing_file_path(extraction_conf)
     # Deserialize the preprocessing data.
@@ -90,10 +107,21 @@ def channel_building_batch(extraction_conf_file_path: str, nb_workers: int = Non
 
     variable_ids = list(extraction_conf.get_variables().keys())
 
-    static_parameters = (extraction_conf.channels_dir_path, periods, label_ids,
-                         total_number_images, block_file_structure, extraction_conf.tensor_dataset_ratios,
-                         user_specific_block_processing)
-    parameters_list = [(variable_id, *static_parameters) for variable_id in variable_ids]
+    if has_to_stream:
+        static_parameters = (extraction_conf.channels_dir_path, periods, label_ids,
+                             total_number_images, block_file_structure, extraction_conf.tensor_dataset_ratios,
+                             extraction_conf.dtype, extraction_conf.channel_hdf5_options)
+        channel_building_func = streaming_channel_building
+    else:
+        static_parameters = (extraction_conf.channels_dir_path, periods, label_ids,
+                             total_number_images, block_file_structure, extraction_conf.tensor_dataset_ratios,
+                             user_specific_block_processing, extraction_conf.dtype,
+                             extraction_conf.channel_hdf5_options)
+        channel_building_func = channel_building
+    parameters_list = [(channel_building_func, variable_id, *static_parameters,
+                        extraction_conf.get_normalization_mode(variable_id),
+                        extraction_conf.normalization_clip_percentiles)
+                       for variable_id in variable_ids]
 
     len_variable_ids = len(variable_ids)
     if not nb_workers:
@@ -112,7 +140,8 @@ def channel_building_batch(extraction_conf_file_path: str, nb_workers: int = Non
 
 
 def __map_channel_building(parameters):
-    channel_building(*parameters)
+    channel_building_func, *parameters = parameters
+    channel_building_func(*parameters)
 
 
 def channel_building(variable_id: VariableId, channel_output_dir_path: str,
@@ -124,41 +153,171 @@ def channel_building(variable_id: VariableId, channel_output_dir_path: str,
                                    Mapping[Period, Mapping[LabelId, Tuple[np.ndarray, pd.DataFrame, int]]]],
                                   Tuple[Sequence[Period], Sequence[LabelId],
                                   Mapping[Period, Mapping[LabelId, Tuple[np.ndarray, pd.DataFrame, int]]]]] =
-                         assembly.default_block_processing_func) -> None:
+                         assembly.default_block_processing_func,
+                     dtype: str = None, hdf5_options: Mapping[Hdf5OptName, any] = None,
+                     normalization_mode: NormalizationMode = NormalizationMode.STANDARD,
+                     clip_percentiles: Sequence[float] = None) -> None:
+    # The statistics and the quantile sketch of the channel are merged from the ones of the blocks, unless the blocks
+    # are processed by a user function (or were extracted without them): then they are computed from the channel
+    # data.
+    channel_statistics = None
+    channel_sketch = None
+    if user_specific_block_processing is assembly.default_block_processing_func:
+        blocks = assembly.list_blocks(periods, label_ids, block_file_structure)
+        channel_statistics = assembly.merge_block_statistics(variable_id, blocks, dtype)
+        channel_sketch = assembly.merge_block_quantile_sketches(variable_id, blocks, dtype)
     block_data_structure = assembly.load_data_blocks(variable_id, periods, label_ids, block_file_structure)
     periods, label_ids, block_data_structure = user_specific_block_processing(periods, label_ids, block_data_structure)
     channel_data, channel_metadata, dataset_indexes = \
         assembly.concatenate_data_compute_dataset_indexes(periods, label_ids, total_number_images, block_data_structure,
-                                                          ratios)
-    channel_data, mean, scale = assembly.normalize_scale(channel_data, True, True)
+                                                          ratios, dtype)
+    del block_data_structure
+    channel_data = assembly.to_floating(channel_data)
+    if channel_statistics is None:
+        channel_statistics = Statistics.compute(channel_data)
+    if channel_sketch is None:
+        channel_sketch = QuantileSketch.compute(channel_data)
+    offset, scale, clip = normalization.compute_normalization_parameters(normalization_mode, channel_statistics,
+                                                                         channel_sketch, clip_percentiles)
+    assembly.normalize_scale_inplace(channel_data, offset, scale, clip=clip)
+    min, max = assembly.compute_normalized_min_max(channel_statistics, offset, scale, channel_data.dtype, clip)
     os.makedirs(channel_output_dir_path, exist_ok=True)
     # Split the data and metadata according to the user's dataset specifications.
     for dataset_name, indexes in dataset_indexes:
         dataset_data, dataset_metadata = assembly.split_channel(channel_data, channel_metadata, indexes)
         dataset_data_file_path, dataset_metadata_file_path = \
             nu.compute_data_meta_data_file_path(variable_id, channel_output_dir_path, dataset_name)
-        hu.write_ndarray_to_hdf5(dataset_data_file_path, dataset_data)
+        hu.write_ndarray_to_hdf5(dataset_data_file_path, dataset_data, dtype, options=hdf5_options)
         du.save_to_csv_file(dataset_metadata, dataset_metadata_file_path, assembly.PANDAS_CSV_WRITE_OPTS)
 
-    # Cast into 64 bits otherwise the value is trunked.
-    min = float(channel_data.min())
-    max = float(channel_data.max())
-    stat_data = [{TensorDimension.MIN: min, TensorDimension.MAX: max, TensorDimension.MEAN: mean[0],
-                  TensorDimension.STD: scale[0]}]
+    __save_channel_stats(variable_id, channel_output_dir_path, min, max, channel_statistics, channel_sketch,
+                         normalization_mode, offset, scale, clip)
+
+
+# Build the channel of the given variable block after block: the statistics are merged from the ones of the blocks
+# (or computed in a first pass over the blocks extracted without statistics), then the blocks are normalized and
+# written into the preallocated dataset files. Only one block is in memory at once. The channels are the same as the
+# ones of channel_building.
+def streaming_channel_building(variable_id: VariableId, channel_output_dir_path: str,
+                               periods: Sequence[Period], label_ids: Sequence[LabelId], total_number_images: int,
+                               block_file_structure: Mapping[Period, Mapping[LabelId, Tuple[str, str, int]]],
+                               ratios: Mapping[str, float], dtype: str = None,
+                               hdf5_options: Mapping[Hdf5OptName, any] = None,
+                               normalization_mode: NormalizationMode = NormalizationMode.STANDARD,
+                               clip_percentiles: Sequence[float] = None) -> None:
+    blocks = assembly.list_blocks(periods, label_ids, block_file_structure)
+    dataset_ranges = assembly.compute_dataset_ranges(periods, label_ids, total_number_images, block_file_structure,
+                                                     ratios)
+    block_dtypes = list()
+    image_shape = tuple()
+    for block_files in blocks:
+        with hu.open_hdf5_dataset(block_files[0].format(variable_id)) as dataset:
+            block_dtypes.append(dataset.dtype)
+            image_shape = dataset.shape[1:]
+    channel_dtype = np.dtype(dtype) if dtype is not None else np.result_type(*block_dtypes)
+    channel_statistics = assembly.merge_block_statistics(variable_id, blocks, dtype)
+    channel_sketch = assembly.merge_block_quantile_sketches(variable_id, blocks, dtype)
+    if channel_statistics is None or channel_sketch is None:
+        print(f'> computing {variable_id} channel statistics')
+        block_statistics = list()
+        block_sketches = list()
+        for block_files in blocks:
+            block_data = assembly.to_floating(assembly.load_block_data(variable_id, block_files, channel_dtype))
+            block_statistics.append(Statistics.compute(block_data))
+            block_sketches.append(QuantileSketch.compute(block_data))
+        channel_statistics = merge_statistics(block_statistics)
+        channel_sketch = merge_quantile_sketches(block_sketches)
+    offset, scale, clip = normalization.compute_normalization_parameters(normalization_mode, channel_statistics,
+                                                                         channel_sketch, clip_percentiles)
+
+    print(f'> writing {variable_id} channel data')
+    os.makedirs(channel_output_dir_path, exist_ok=True)
+    channel_min = np.inf
+    channel_max = -np.inf
+    with ExitStack() as stack:
+        datasets = list()
+        for dataset_name, start, stop in dataset_ranges:
+            dataset_data_file_path, dataset_metadata_file_path = \
+                nu.compute_data_meta_data_file_path(variable_id, channel_output_dir_path, dataset_name)
+            dataset = stack.enter_context(hu.create_hdf5_dataset(dataset_data_file_path,
+                                                                 (stop - start,) + image_shape,
+                                                                 channel_dtype, hdf5_options))
+            datasets.append((dataset, start, stop, dataset_metadata_file_path))
+        has_metadata_header = {dataset_metadata_file_path: False for _, _, _, dataset_metadata_file_path in datasets}
+        block_start = 0
+        block_metadata = None
+        for block_files in blocks:
+            block_data = assembly.to_floating(assembly.load_block_data(variable_id, block_files, channel_dtype))
+            assembly.normalize_scale_inplace(block_data, offset, scale, clip=clip)
+            if block_data.size > 0:
+                # Cast into 64 bits otherwise the value is trunked.
+                channel_min = min(channel_min, float(block_data.min()))
+                channel_max = max(channel_max, float(block_data.max()))
+            block_metadata = assembly.load_block_metadata(variable_id, block_files)
+            block_stop = block_start + len(block_data)
+            for dataset, start, stop, dataset_metadata_file_path in datasets:
+                left_index = max(start, block_start)
+                right_index = min(stop, block_stop)
+                if left_index < right_index:
+                    dataset[left_index-start:right_index-start] = block_data[left_index-block_start:
+                                                                             right_index-block_start]
+                    __append_metadata(block_metadata.iloc[left_index-block_start:right_index-block_start],
+                                      dataset_metadata_file_path, has_metadata_header[dataset_metadata_file_path])
+                    has_metadata_header[dataset_metadata_file_path] = True
+            block_start = block_stop
+        # The datasets without any image have a metadata file with only the header.
+        for dataset_metadata_file_path, has_header in has_metadata_header.items():
+            if not has_header and block_metadata is not None:
+                __append_metadata(block_metadata.iloc[0:0], dataset_metadata_file_path, False)
+    __save_channel_stats(variable_id, channel_output_dir_path, channel_min, channel_max, channel_statistics,
+                         channel_sketch, normalization_mode, offset, scale, clip)
+
+
+# The metadata is written with the header, unless the file already has it.
+def __append_metadata(metadata: pd.DataFrame, metadata_file_path: str, has_header: bool) -> None:
+    if has_header:
+        options = {k: v for k, v in assembly.PANDAS_CSV_WRITE_OPTS.items()}
+        options['header'] = False
+        options['mode'] = 'a'
+        du.save_to_csv_file(metadata, metadata_file_path, options)
+    else:
+        du.save_to_csv_file(metadata, metadata_file_path, assembly.PANDAS_CSV_WRITE_OPTS)
+
+
+# The min and the max are the ones of the normalized channel, the other statistics are the ones of the channel before
+# its normalization: the mean, the standard deviation, the percentiles of its quantile sketch (e.g. p50), and the
+# normalization parameters.
+def __save_channel_stats(variable_id: VariableId, channel_output_dir_path: str, min: float, max: float,
+                         channel_statistics: Statistics, channel_sketch: QuantileSketch,
+                         normalization_mode: NormalizationMode, offset: float, scale: float,
+                         clip: Tuple[float, float] = None) -> None:
+    std = channel_statistics.compute_std()
+    stat_data = {TensorDimension.MIN: min, TensorDimension.MAX: max, TensorDimension.MEAN: channel_statistics.mean,
+                 # Like normalize_scale, a null standard deviation is replaced by 1.
+                 TensorDimension.STD: std if std != 0. else 1.,
+                 normalization.NORMALIZATION: normalization_mode, normalization.OFFSET: offset,
+                 normalization.SCALE: scale,
+                 normalization.CLIP_MIN: clip[0] if clip else None, normalization.CLIP_MAX: clip[1] if clip else None}
+    stat_data.update(normalization.compute_summary(channel_sketch))
     stat_file_path = nu.compute_stat_file_path(variable_id, channel_output_dir_path)
-    cu.to_csv(data=stat_data, file_path=stat_file_path)
+    cu.to_csv(data=[stat_data], file_path=stat_file_path)
 
 
+# When has_to_stream is true, the tensors are stacked by ranges of images (see streaming_channel_stacking): the
+# memory is bounded by the size of a range instead of the size of a tensor.
 def channel_stacking_batch(tensor_id: str,
                            extraction_conf_file_path: str,
-                           nb_workers: int = None) -> None:
+                           nb_workers: int = None,
+                           has_to_stream: bool = False) -> None:
 
     extraction_conf: ExtractionConfig = ExtractionConfig.load(extraction_conf_file_path)
     dataset_names = extraction_conf.tensor_dataset_ratios.keys()
     variable_ids = list(extraction_conf.get_variables().keys())
     static_parameters = (tensor_id, extraction_conf.tensors_dir_path, extraction_conf.channels_dir_path,
-                         variable_ids, extraction_conf.has_tensor_to_be_shuffled)
-    parameters_list = [(dataset_name, *static_parameters) for dataset_name in dataset_names]
+                         variable_ids, extraction_conf.has_tensor_to_be_shuffled, extraction_conf.dtype,
+                         extraction_conf.tensor_hdf5_options)
+    channel_stacking_func = streaming_channel_stacking if has_to_stream else channel_stacking
+    parameters_list = [(channel_stacking_func, dataset_name, *static_parameters) for dataset_name in dataset_names]
 
     len_dataset_types = len(dataset_names)
     if not nb_workers:
@@ -174,26 +333,26 @@ def channel_stacking_batch(tensor_id: str,
     else:
         print(f"> stacking the dataset '{nu.list_to_string(dataset_names)}' sequentially")
         for parameters in parameters_list:
-            channel_stacking(*parameters)
+            __map_channel_stacking(parameters)
 
 
 def __map_channel_stacking(parameters):
-    channel_stacking(*parameters)
+    channel_stacking_func, *parameters = parameters
+    channel_stacking_func(*parameters)
 
 
 def channel_stacking(dataset_name: str, tensor_id: str, tensor_output_dir: str,
-                     channels_dir: str, variable_ids: Sequence[VariableId], has_to_shuffle: bool) -> Tuple[str, str]:
-    channel_data_list = list()
+                     channels_dir: str, variable_ids: Sequence[VariableId], has_to_shuffle: bool,
+                     dtype: str = None, hdf5_options: Mapping[Hdf5OptName, any] = None) -> Tuple[str, str]:
+    channel_data_file_paths = list()
     channel_metadata_file_path = ''
     for variable_id in variable_ids:
-        print(f"> loading the data and metadata of variable '{variable_id}'")
         channel_data_file_path, channel_metadata_file_path = \
             nu.compute_data_meta_data_file_path(variable_id, channels_dir, dataset_name)
-        channel_data = hu.read_ndarray_from_hdf5(channel_data_file_path)
-        channel_data_list.append(channel_data)
+        channel_data_file_paths.append(channel_data_file_path)
 
-    print("> stacking the channels")
-    tensor_data = assembly.stack_channel(channel_data_list)
+    print(f"> stacking the channels '{nu.list_to_string(variable_ids)}'")
+    tensor_data = assembly.stack_channel_files(channel_data_file_paths, dtype)
     metadata = du.load_csv_file(channel_metadata_file_path, assembly.PANDAS_CSV_READ_OPTS)
 
     if has_to_shuffle:
@@ -206,7 +365,59 @@ def channel_stacking(dataset_name: str, tensor_id: str, tensor_output_dir: str,
     print(f"> saving the tensor '{dataset_name}' data and metadata")
     os.makedirs(tensor_output_dir, exist_ok=True)
     du.save_to_csv_file(metadata, tensor_metadata_file_path, assembly.PANDAS_CSV_WRITE_OPTS)
-    hu.write_ndarray_to_hdf5(tensor_data_file_path, tensor_data)
+    hu.write_ndarray_to_hdf5(tensor_data_file_path, tensor_data, dtype, options=hdf5_options)
+    return tensor_data_file_path, tensor_metadata_file_path
+
+
+# Stack the channels into the tensor dataset file, created beforehand, by ranges of nb_images images: the ranges of
+# the channels are read concurrently (one thread per channel) into a buffer which is written into the tensor. Only
+# the buffer is in memory. The tensors are the same as the ones of channel_stacking.
+def streaming_channel_stacking(dataset_name: str, tensor_id: str, tensor_output_dir: str,
+                               channels_dir: str, variable_ids: Sequence[VariableId], has_to_shuffle: bool,
+                               dtype: str = None, hdf5_options: Mapping[Hdf5OptName, any] = None,
+                               nb_images: int = STACKING_CHUNK_SIZE) -> Tuple[str, str]:
+    channel_data_file_paths = list()
+    channel_metadata_file_path = ''
+    for variable_id in variable_ids:
+        channel_data_file_path, channel_metadata_file_path = \
+            nu.compute_data_meta_data_file_path(variable_id, channels_dir, dataset_name)
+        channel_data_file_paths.append(channel_data_file_path)
+    metadata = du.load_csv_file(channel_metadata_file_path, assembly.PANDAS_CSV_READ_OPTS)
+    tensor_data_file_path, tensor_metadata_file_path = \
+        nu.compute_data_meta_data_file_path(tensor_id, tensor_output_dir, dataset_name)
+    os.makedirs(tensor_output_dir, exist_ok=True)
+
+    print(f"> stacking the channels '{nu.list_to_string(variable_ids)}'")
+    with ExitStack() as stack:
+        channel_datasets = [stack.enter_context(hu.open_hdf5_dataset(channel_data_file_path))
+                            for channel_data_file_path in channel_data_file_paths]
+        nb_channel_images = channel_datasets[0].shape[0]
+        image_shape = channel_datasets[0].shape[1:]
+        for variable_id, channel_dataset in zip(variable_ids, channel_datasets):
+            if channel_dataset.shape != channel_datasets[0].shape:
+                msg = f"> [ERROR] the shape of the channel '{variable_id}' ({channel_dataset.shape}) mismatches " \
+                      f"the shape of the channel '{variable_ids[0]}' ({channel_datasets[0].shape})"
+                raise ConfigurationError(msg)
+        tensor_dtype = dtype if dtype is not None else np.result_type(*[channel_dataset.dtype
+                                                                        for channel_dataset in channel_datasets])
+        tensor_shape = (nb_channel_images,) + image_shape + (len(channel_datasets),)
+        if has_to_shuffle:
+            print(f"> shuffling the tensor '{dataset_name}'")
+            permutations = np.random.permutation(nb_channel_images)
+            metadata = metadata.iloc[permutations]
+        tensor_dataset = stack.enter_context(hu.create_hdf5_dataset(tensor_data_file_path, tensor_shape,
+                                                                    tensor_dtype, hdf5_options))
+        buffer = np.empty((min(nb_images, nb_channel_images),) + tensor_shape[1:], dtype=tensor_dtype)
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=len(channel_datasets)))
+        for start in range(0, nb_channel_images, nb_images):
+            stop = min(start + nb_images, nb_channel_images)
+            rows = permutations[start:stop] if has_to_shuffle else slice(start, stop)
+            range_buffer = buffer[:stop-start]
+            assembly.read_channel_rows(channel_datasets, range_buffer, rows, executor)
+            tensor_dataset[start:stop] = range_buffer
+
+    print(f"> saving the tensor '{dataset_name}' metadata")
+    du.save_to_csv_file(metadata, tensor_metadata_file_path, assembly.PANDAS_CSV_WRITE_OPTS)
     return tensor_data_file_path, tensor_metadata_file_path
 
 
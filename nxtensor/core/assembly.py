@@ -6,13 +6,18 @@ Created on Fri Jun 5 10:00:00 2020
 @author: sebastien@gardoll.fr
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
 import numpy as np
 import pandas as pd
 
-from typing import Tuple, Sequence, Mapping, Set
+from typing import Optional, Tuple, Sequence, Mapping, Set, Union
 
 from nxtensor.exceptions import ConfigurationError
 from nxtensor.core.types import VariableId, LabelId, Period
+from nxtensor.core.statistics import Statistics, QuantileSketch
+from nxtensor.utils.block_formats import BlockFormat
 
 import nxtensor.utils.hdf5_utils as hu
 import nxtensor.utils.file_utils as fu
@@ -21,13 +26,12 @@ import nxtensor.utils.time_utils as tu
 import nxtensor.utils.csv_utils as cu
 import nxtensor.utils.db_utils as du
 
-from sklearn.preprocessing import StandardScaler
-
 import os
 
 import os.path as path
 
 import nxtensor.core.xarray_channel_extraction as chan_xtract
+import nxtensor.core.normalization as normalization
 
 PANDAS_CSV_WRITE_OPTS = {k: v for k, v in cu.DEFAULT_CSV_OPTIONS.items()}
 PANDAS_CSV_WRITE_OPTS['header'] = True
@@ -38,7 +42,8 @@ PANDAS_CSV_READ_OPTS = {k: v for k, v in cu.DEFAULT_CSV_OPTIONS.items()}
 PANDAS_CSV_READ_OPTS['dtype'] = chan_xtract.METADATA_TYPES
 
 
-def compute_block_file_structure(blocks_dir_path: str) -> \
+# With the HDF5 block format, the metadata file templates are the data file templates (see BlockFormat).
+def compute_block_file_structure(blocks_dir_path: str, block_format: BlockFormat = BlockFormat.CSV) -> \
         Tuple[Sequence[Period], Sequence[LabelId], Mapping[Period, Mapping[LabelId, Tuple[str, str]]]]:
     # TODO: let the user choose the periods and labels (and implement a file discriminant).
     # File system structure: see naming_utils.
@@ -59,6 +64,8 @@ def compute_block_file_structure(blocks_dir_path: str) -> \
                 parent_dir = path.join(blocks_dir_path, current_period_str, label_id)
                 data_file_path_template, metadata_file_path_template = \
                     nu.compute_data_meta_data_file_template_path(parent_dir)
+                if block_format == BlockFormat.HDF5:
+                    metadata_file_path_template = data_file_path_template
                 block_file_structure[current_period][label_id] = (data_file_path_template, metadata_file_path_template)
     return tu.sort_periods(periods), nu.sort_labels(label_ids), block_file_structure
 
@@ -73,8 +80,11 @@ def count_block_images(variable_id: VariableId,
         annotated_block_file_structure[period] = dict()
         for label_id, label_data in label_mapping.items():
             metadata_file_path = label_data[1].format(variable_id)
-            number_images = fu.count_lines_text_file(metadata_file_path) - 1 \
-                if metadata_block_has_header else fu.count_lines_text_file(metadata_file_path)
+            if __has_embedded_metadata(label_data):
+                number_images = hu.read_nb_rows_from_hdf5(metadata_file_path)
+            else:
+                number_images = fu.count_lines_text_file(metadata_file_path) - 1 \
+                    if metadata_block_has_header else fu.count_lines_text_file(metadata_file_path)
             total_number_images += number_images
             annotated_block_file_structure[period][label_id] = (label_data[0], label_data[1], number_images)
 
@@ -96,8 +106,34 @@ def concatenate_data_compute_dataset_indexes(periods: Sequence[Period],
                                              total_number_images: int,
                                              block_file_structure: Mapping[Period, Mapping[LabelId,
                                                                            Tuple[np.ndarray, pd.DataFrame, int]]],
-                                             ratios: Mapping[str, float]) \
-                       -> Tuple[np.ndarray, pd.DataFrame, Sequence[Tuple[str, Sequence[int]]]] :
+                                             ratios: Mapping[str, float], dtype: str = None) \
+                       -> Tuple[np.ndarray, pd.DataFrame, Sequence[Tuple[str, slice]]] :
+    # The datasets are contiguous ranges of images: they are sliced without copy (see split_channel).
+    dataset_ranges = compute_dataset_ranges(periods, label_ids, total_number_images, block_file_structure, ratios)
+    dataset_indexes = [(dataset_name, slice(start, stop)) for dataset_name, start, stop in dataset_ranges]
+    # Stack the data & metadata.
+    data = list()
+    metadata = list()
+    for period in periods:
+        period_data = block_file_structure[period]
+        for label_id in label_ids:
+            if label_id in period_data:
+                label_data = period_data[label_id]
+                data.append(label_data[0])
+                metadata.append(label_data[1])
+    concatenated_data = concatenate_data(data, dtype)
+    concatenated_metadata = concatenate_metadata(metadata)
+    return concatenated_data, concatenated_metadata, dataset_indexes
+
+
+# Return the name and the range of images [start, stop[ of each dataset, the blocks being concatenated period after
+# period (in the order of the given periods and labels). The number of images of a block is the last element of its
+# tuple (e.g. (data_file_template, metadata_file_template, number_images)). The datasets are split between periods.
+def compute_dataset_ranges(periods: Sequence[Period],
+                           label_ids: Sequence[LabelId],
+                           total_number_images: int,
+                           block_structure: Mapping[Period, Mapping[LabelId, Tuple]],
+                           ratios: Mapping[str, float]) -> Sequence[Tuple[str, int, int]]:
     # Compute the number of images for each dataset.
     image_ratios = list()
     ratio_sum: float = 0
@@ -120,47 +156,51 @@ def concatenate_data_compute_dataset_indexes(periods: Sequence[Period],
 
     del round_diff, ratio_sum, ratios, image_number_sum
 
-    # Stack the data & metadata and compute split positions.
-    data = list()
-    metadata = list()
-    dataset_indexes = list()
+    # Compute split positions.
+    dataset_ranges = list()
     dataset_iter = iter(image_ratios)
     current_dataset = next(dataset_iter)
     dataset_image_counter = 0
     left_index = 0
-    # print(f'total number imgs: {total_number_images}')
-    # print(f'image ratios: {image_ratios}')
     for period in periods:
-        # print(f'period: {period}')
-        period_data = block_file_structure[period]
+        period_data = block_structure[period]
         for label_id in label_ids:
             if label_id in period_data:
-                label_data = period_data[label_id]
-                data.append(label_data[0])
-                metadata.append(label_data[1])
-                dataset_image_counter += label_data[2]    # this condition is related to the last dataset
-        # print(f'img counter: {left_index + dataset_image_counter}')
+                dataset_image_counter += period_data[label_id][-1]    # this condition is related to the last dataset
         if dataset_image_counter >= current_dataset[1] or left_index + dataset_image_counter == total_number_images:
             right_index = left_index + dataset_image_counter
             print(f"> dataset '{current_dataset[0]}' real ratio is {dataset_image_counter*100./total_number_images}%")
-            dataset_indexes.append((current_dataset[0], [index for index in range(left_index, right_index)]))
+            dataset_ranges.append((current_dataset[0], left_index, right_index))
             left_index = right_index
             dataset_image_counter = 0
             try:
                 current_dataset = next(dataset_iter)
             except StopIteration:
                 current_dataset = None  # Well the first for loop should end here.
-    concatenated_data = concatenate_data(data)
-    concatenated_metadata = concatenate_metadata(metadata)
-    return concatenated_data, concatenated_metadata, dataset_indexes
+    return dataset_ranges
 
 
 def concatenate_metadata(metadata: Sequence[pd.DataFrame]) -> pd.DataFrame:
     return pd.concat(objs=metadata, ignore_index=True)
 
 
-def concatenate_data(data: Sequence[np.ndarray]) -> np.ndarray:
-    return np.concatenate(data)
+# The blocks are copied into an array of the given type (the type of the blocks if None): the concatenated data
+# never exists at a wider precision.
+def concatenate_data(data: Sequence[np.ndarray], dtype: str = None) -> np.ndarray:
+    if dtype is None:
+        dtype = np.result_type(*data)
+    nb_images = sum(len(block) for block in data)
+    result = np.empty((nb_images,) + data[0].shape[1:], dtype=dtype)
+    np.concatenate(data, out=result)
+    return result
+
+
+# Return the files of the blocks, in the order of their concatenation (see concatenate_data_compute_dataset_indexes).
+def list_blocks(periods: Sequence[Period], label_ids: Sequence[LabelId],
+                block_file_structure: Mapping[Period, Mapping[LabelId, Tuple[str, str, int]]]) \
+        -> Sequence[Tuple[str, str, int]]:
+    return [block_file_structure[period][label_id] for period in periods for label_id in label_ids
+            if label_id in block_file_structure[period]]
 
 
 def load_data_blocks(variable_id: VariableId, periods: Sequence[Period], label_ids: Sequence[LabelId],
@@ -172,52 +212,211 @@ def load_data_blocks(variable_id: VariableId, periods: Sequence[Period], label_i
         label_data_structure = dict()
         for label_id in label_ids:
             if label_id in block_file_structure[period]:
-                data_file_template = block_file_structure[period][label_id][0]
-                data = hu.read_ndarray_from_hdf5(data_file_template.format(variable_id))
-                metadata_file_template = block_file_structure[period][label_id][1]
-                metadata = du.load_csv_file(metadata_file_template.format(variable_id), PANDAS_CSV_READ_OPTS)
-                image_number = block_file_structure[period][label_id][2]
+                block_files = block_file_structure[period][label_id]
+                data = hu.read_ndarray_from_hdf5(block_files[0].format(variable_id))
+                metadata = load_block_metadata(variable_id, block_files)
+                image_number = block_files[2]
                 label_data_structure[label_id] = (data, metadata, image_number)
         block_data_structure[period] = label_data_structure
     return block_data_structure
 
 
+# Return the data of the given block, cast into the given type (if any).
+def load_block_data(variable_id: VariableId, block_files: Tuple[str, str, int], dtype: str = None) -> np.ndarray:
+    data = hu.read_ndarray_from_hdf5(block_files[0].format(variable_id))
+    return data if dtype is None else data.astype(dtype, copy=False)
+
+
+# Return the metadata of the given block (see compute_block_file_structure).
+def load_block_metadata(variable_id: VariableId, block_files: Tuple[str, str, int]) -> pd.DataFrame:
+    metadata_file_path = block_files[1].format(variable_id)
+    if __has_embedded_metadata(block_files):
+        return load_embedded_metadata_block(metadata_file_path)
+    else:
+        return du.load_csv_file(metadata_file_path, PANDAS_CSV_READ_OPTS)
+
+
+# Return the metadata of a block stored in the HDF5 file of its data, like a metadata block loaded from a CSV file
+# (sorted columns and METADATA_TYPES).
+def load_embedded_metadata_block(file_path: str) -> pd.DataFrame:
+    result = pd.DataFrame(hu.read_metadata_from_hdf5(file_path))
+    result = result[sorted(result.columns)]
+    return result.astype({column: column_type for column, column_type in chan_xtract.METADATA_TYPES.items()
+                          if column in result.columns})
+
+
+# The metadata of a block is embedded in its data file when their file templates are the same (see BlockFormat).
+def __has_embedded_metadata(block_files: Tuple[str, ...]) -> bool:
+    return block_files[0] == block_files[1]
+
+
+# Standardize the given data in place with the given mean and standard deviation: like the StandardScaler, a null or
+# None mean (std) is not subtracted (divided by). The non-floating data is cast into float64 beforehand.
 def normalize_scale_with_params(channel_data: np.ndarray, mean: float = None, std: float = None) -> np.ndarray:
-    tmp = channel_data.reshape((-1, 1), order='C')
-    scaler = StandardScaler(copy=False, with_mean=mean, with_std=std)
-    scaler.mean_ = mean
-    scaler.scale_ = std
-    scaler.transform(tmp)
-    std_channel_data = tmp.reshape(channel_data.shape, order='C')
-    return std_channel_data
-
-
-def normalize_scale(channel_data: np.ndarray, with_mean: bool, with_std: bool) -> Tuple:
-    tmp = channel_data.reshape((-1, 1), order='C')
-    scaler = StandardScaler(copy=False, with_mean=with_mean, with_std=with_std)
-    scaler.fit(tmp)
-    scaler.transform(tmp)
-    std_channel_data = tmp.reshape(channel_data.shape, order='C')
+    channel_data = to_floating(channel_data)
+    normalize_scale_inplace(channel_data, mean if mean else None, std if std else None)
+    return channel_data
+
+
+# Return the mean and the standard deviation of the given data. They are accumulated in float64, by batches
+# of images, whatever the type of the data. Like the StandardScaler, the missing values (NaN) are ignored.
+def compute_mean_std(channel_data: np.ndarray) -> Tuple[float, float]:
+    statistics = Statistics.compute(channel_data)
+    return statistics.mean, statistics.compute_std()
+
+
+# Return the statistics of the given block, written by the extraction, or None if the block doesn't have them or
+# if they were not computed in the given type.
+def load_block_statistics(variable_id: VariableId, block_files: Tuple[str, str, int], dtype: str = None) \
+        -> Optional[Statistics]:
+    attributes = __load_block_attributes(variable_id, block_files, dtype)
+    return None if attributes is None else Statistics.from_mapping(attributes)
+
+
+# Return the merge of the statistics of the given blocks, without reading their data, or None if a block doesn't
+# have statistics (see load_block_statistics).
+def merge_block_statistics(variable_id: VariableId, blocks: Sequence[Tuple[str, str, int]], dtype: str = None) \
+        -> Optional[Statistics]:
+    result = Statistics()
+    for block_files in blocks:
+        block_statistics = load_block_statistics(variable_id, block_files, dtype)
+        if block_statistics is None:
+            return None
+        result = result.merge(block_statistics)
+    return result
+
+
+# See load_block_statistics.
+def load_block_quantile_sketch(variable_id: VariableId, block_files: Tuple[str, str, int], dtype: str = None) \
+        -> Optional[QuantileSketch]:
+    attributes = __load_block_attributes(variable_id, block_files, dtype)
+    return None if attributes is None else QuantileSketch.from_mapping(attributes)
+
+
+# See merge_block_statistics.
+def merge_block_quantile_sketches(variable_id: VariableId, blocks: Sequence[Tuple[str, str, int]],
+                                  dtype: str = None) -> Optional[QuantileSketch]:
+    result = QuantileSketch()
+    for block_files in blocks:
+        block_sketch = load_block_quantile_sketch(variable_id, block_files, dtype)
+        if block_sketch is None:
+            return None
+        result = result.merge(block_sketch)
+    return result
+
+
+def __load_block_attributes(variable_id: VariableId, block_files: Tuple[str, str, int], dtype: str = None) \
+        -> Optional[Mapping[str, any]]:
+    with hu.open_hdf5_dataset(block_files[0].format(variable_id)) as dataset:
+        if dtype is not None and dataset.dtype != np.dtype(dtype):
+            return None
+        return dict(dataset.attrs)
+
+
+# Return the min and the max of the data of the given statistics once normalized in the given type (like
+# normalize_scale_inplace). The normalization is monotonic: they are the normalized min and max of the data.
+def compute_normalized_min_max(statistics: Statistics, mean: float, scale: float, dtype: np.dtype,
+                               clip: Tuple[float, float] = None) -> Tuple[float, float]:
+    min_max = np.array([statistics.min, statistics.max], dtype=dtype)
+    normalize_scale_inplace(min_max, mean, scale, clip=clip)
+    return float(min_max[0]), float(min_max[1])
+
+
+# Standardize the given data in place: the data is cast into the given type, if any, beforehand (the non-floating
+# data into float64). Like the StandardScaler, the missing values (NaN) are ignored by the fit and kept as is.
+# The mean and the scale are returned as arrays of one element (like the attributes of the scikit-learn
+# StandardScaler).
+def normalize_scale(channel_data: np.ndarray, with_mean: bool, with_std: bool, dtype: str = None) -> Tuple:
+    if dtype is not None:
+        channel_data = channel_data.astype(dtype, copy=False)
+    channel_data = to_floating(channel_data)
+    mean, std = compute_mean_std(channel_data)
+    # Like the StandardScaler, a null standard deviation is replaced by 1 so as not to divide by zero.
+    scale = std if std != 0. else 1.
+    normalize_scale_inplace(channel_data, mean if with_mean else None, scale if with_std else None)
+    mean = np.array([mean])
+    scale = np.array([scale])
     if with_mean and with_std:
-        return std_channel_data, scaler.mean_, scaler.scale_
+        return channel_data, mean, scale
     elif with_mean:
-        return std_channel_data, scaler.mean_
+        return channel_data, mean
     elif with_std:
-        return std_channel_data, scaler.scale_
+        return channel_data, scale
     else:
-        return std_channel_data
+        return channel_data
+
+
+# Clip into the given bounds, subtract the given mean and divide by the given scale (when not None), in place and in
+# the type of the data, by chunks of images in several threads (see normalization).
+def normalize_scale_inplace(data: np.ndarray, mean: float = None, scale: float = None,
+                            nb_threads: int = None, clip: Tuple[float, float] = None) -> None:
+    normalization.normalize_inplace(data, mean, scale, nb_threads, clip=clip)
 
 
-def split_channel(channel_data: np.ndarray, channel_metadata: pd.DataFrame, dataset_indexes: Sequence[int]) \
-                  -> Tuple[np.ndarray, pd.DataFrame]:
+# Return the given data, cast into float64 if it is not floating (so as to be normalized in place).
+def to_floating(data: np.ndarray) -> np.ndarray:
+    return data if np.issubdtype(data.dtype, np.floating) else data.astype(np.float64)
+
+
+# The data of a dataset given by a slice is a view of the channel data (see
+# concatenate_data_compute_dataset_indexes), otherwise a copy (e.g. a sequence of indexes).
+def split_channel(channel_data: np.ndarray, channel_metadata: pd.DataFrame,
+                  dataset_indexes: Union[slice, Sequence[int]]) -> Tuple[np.ndarray, pd.DataFrame]:
     return channel_data[dataset_indexes], channel_metadata.iloc[dataset_indexes]
 
 
-def stack_channel(channel_data_list: Sequence[np.ndarray]) -> np.ndarray:
-    tensor = np.stack(channel_data_list, axis=3)
+# The channels are copied into a tensor of the given type (the type of the channels if None).
+def stack_channel(channel_data_list: Sequence[np.ndarray], dtype: str = None) -> np.ndarray:
+    if dtype is None:
+        dtype = np.result_type(*channel_data_list)
+    tensor = np.empty(channel_data_list[0].shape + (len(channel_data_list),), dtype=dtype)
+    for index, channel_data in enumerate(channel_data_list):
+        tensor[..., index] = channel_data
+    return tensor
+
+
+# The channel files are read directly into a tensor of the given type (the type of the channels if None): the
+# channels are never loaded apart from the tensor.
+def stack_channel_files(channel_data_file_paths: Sequence[str], dtype: str = None) -> np.ndarray:
+    shapes = list()
+    dtypes = list()
+    for channel_data_file_path in channel_data_file_paths:
+        with hu.open_hdf5_dataset(channel_data_file_path) as dataset:
+            shapes.append(dataset.shape)
+            dtypes.append(dataset.dtype)
+    if dtype is None:
+        dtype = np.result_type(*dtypes)
+    tensor = np.empty(shapes[0] + (len(channel_data_file_paths),), dtype=dtype)
+    for index, channel_data_file_path in enumerate(channel_data_file_paths):
+        hu.read_ndarray_into(channel_data_file_path, tensor, destination_selection=np.s_[..., index])
     return tensor
 
 
+# Read the given rows of each channel dataset into its channel of the destination (destination[..., index]), one
+# thread per channel. The rows are a slice or a sequence of indexes in any order (e.g. a slice of a permutation):
+# destination[position] is the row rows[position].
+def read_channel_rows(channel_datasets: Sequence[h5py.Dataset], destination: np.ndarray,
+                      rows: Union[slice, np.ndarray], executor: ThreadPoolExecutor = None) -> None:
+    if isinstance(rows, slice):
+        def read_channel(index: int) -> None:
+            hu.read_dataset_into(channel_datasets[index], destination, rows, np.s_[..., index])
+    else:
+        # HDF5 reads the rows in increasing order.
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+
+        def read_channel(index: int) -> None:
+            destination[order, ..., index] = channel_datasets[index][sorted_rows]
+
+    channel_indexes = range(len(channel_datasets))
+    if executor is None:
+        for index in channel_indexes:
+            read_channel(index)
+    else:
+        # Raise the exception of a thread, if any.
+        list(executor.map(read_channel, channel_indexes))
+
+
 def shuffle_data(data: np.ndarray, metadata: pd.DataFrame) -> Tuple[np.ndarray, pd.DataFrame]:
     permutations = np.random.permutation(data.shape[0])
     shuffled_data = data[permutations]
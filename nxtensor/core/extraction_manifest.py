@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+from typing import Dict, Mapping, Sequence, Tuple
+
+import csv
+import os
+import os.path as path
+import zlib
+
+import numpy as np
+
+import nxtensor.utils.naming_utils as nu
+import nxtensor.utils.time_utils as tu
+from nxtensor.core.types import LabelId, MetaDataBlock, Period
+
+__CHECKSUM_READ_BUFFER_SIZE: int = 1024 * 1024
+
+
+class ManifestField:
+
+    PERIOD         = 'period'
+    LABEL_ID       = 'label_id'
+    NB_REGIONS     = 'nb_regions'
+    NB_BYTES       = 'nb_bytes'
+    CHECKSUM       = 'checksum'  # CRC32 of the data block file followed by the metadata block file.
+    ROWS_CHECKSUM  = 'rows_checksum'  # CRC32 of the rows of the preprocessing block (see compute_rows_checksum).
+    DATA_BLOCK     = 'data_block'
+    METADATA_BLOCK = 'metadata_block'
+
+    KEYS = [PERIOD, LABEL_ID, NB_REGIONS, NB_BYTES, CHECKSUM, ROWS_CHECKSUM, DATA_BLOCK, METADATA_BLOCK]
+    # The paths of the files of a block, relative to the blocks directory.
+    FILE_KEYS = [DATA_BLOCK, METADATA_BLOCK]
+
+
+class ManifestWriter:
+
+    # The manifest of the extraction of a variable lists the blocks already written, one line per block: it is
+    # written by the parent process as the blocks complete, so it is usable while the extraction is still running
+    # and it is the completion journal of an extraction that is resumed (see load_manifest).
+    # The manifest file is located at the root of the blocks directory (see naming_utils). The paths of the block
+    # files are written relative to the blocks directory, so as a copied or moved blocks tree stays consistent.
+    # The given entries (blocks completed by a previous extraction, see load_manifest) are written first.
+    def __init__(self, manifest_file_path: str, blocks_dir_path: str, entries: Sequence[Mapping[str, any]] = ()):
+        self.manifest_file_path: str = manifest_file_path
+        self.blocks_dir_path: str = blocks_dir_path
+        os.makedirs(path.dirname(manifest_file_path), exist_ok=True)
+        self.__file = open(manifest_file_path, 'w', encoding='utf-8', newline='')
+        self.__csv_writer = csv.DictWriter(self.__file, fieldnames=ManifestField.KEYS, delimiter=',',
+                                           quotechar='"', quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+        self.__csv_writer.writeheader()
+        for entry in entries:
+            self.__write_entry(entry)
+        self.__file.flush()
+
+    def write(self, period: Period, label_id: LabelId, nb_regions: int, nb_bytes: int, checksum: str,
+              rows_checksum: str, file_paths: Mapping[str, str]) -> None:
+        entry = {ManifestField.PERIOD: nu.create_period_str(period), ManifestField.LABEL_ID: label_id,
+                 ManifestField.NB_REGIONS: nb_regions, ManifestField.NB_BYTES: nb_bytes,
+                 ManifestField.CHECKSUM: checksum, ManifestField.ROWS_CHECKSUM: rows_checksum,
+                 ManifestField.DATA_BLOCK: file_paths['data_block'],
+                 ManifestField.METADATA_BLOCK: file_paths['metadata_block']}
+        self.__write_entry(entry)
+        self.__file.flush()
+
+    def __write_entry(self, entry: Mapping[str, any]) -> None:
+        entry = dict(entry)
+        for key in ManifestField.FILE_KEYS:
+            entry[key] = path.relpath(entry[key], self.blocks_dir_path)
+        self.__csv_writer.writerow(entry)
+
+    def close(self) -> None:
+        self.__file.close()
+
+    def __enter__(self) -> 'ManifestWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+# The files given several times (e.g. the data and metadata of a block stored in the same file) are read once.
+def compute_checksum(*file_paths: str) -> str:
+    checksum = 0
+    for file_path in dict.fromkeys(file_paths):
+        with open(file_path, 'rb') as file:
+            buffer = file.read(__CHECKSUM_READ_BUFFER_SIZE)
+            while buffer:
+                checksum = zlib.crc32(buffer, checksum)
+                buffer = file.read(__CHECKSUM_READ_BUFFER_SIZE)
+    return f'{checksum:08x}'
+
+
+# The checksum of the rows of the given preprocessing block, computed on their values (the numbers in float64),
+# so as a block extracted from other rows (e.g. a label moved after a new preprocessing) is not resumed.
+def compute_rows_checksum(extraction_metadata_block: MetaDataBlock) -> str:
+    checksum = 0
+    for name in sorted(extraction_metadata_block.dtype.names):
+        column = extraction_metadata_block[name]
+        column = column.astype(np.float64) if column.dtype.kind in 'biuf' else column.astype(np.str_)
+        checksum = zlib.crc32(name.encode('utf-8'), checksum)
+        checksum = zlib.crc32(np.ascontiguousarray(column).tobytes(), checksum)
+    return f'{checksum:08x}'
+
+
+# Return the entries of the given manifest, mapped by period and label, with the paths of their files resolved
+# against the given blocks directory. Return an empty mapping if the manifest doesn't exist. The entries of a manifest
+# written before the checksums (of the files and of the rows) and the entries of which the files are outside the
+# blocks directory (e.g. the absolute paths written by a previous version in a copied blocks tree) are ignored.
+def load_manifest(manifest_file_path: str, blocks_dir_path: str) -> Dict[Tuple[Period, LabelId], Dict[str, any]]:
+    result: Dict[Tuple[Period, LabelId], Dict[str, any]] = dict()
+    if not path.exists(manifest_file_path):
+        return result
+    with open(manifest_file_path, 'r', encoding='utf-8', newline='') as file:
+        csv_reader = csv.DictReader(file, delimiter=',', quotechar='"', quoting=csv.QUOTE_NONNUMERIC)
+        for entry in csv_reader:
+            if not entry.get(ManifestField.CHECKSUM, None) or not entry.get(ManifestField.ROWS_CHECKSUM, None):
+                continue
+            for key in ManifestField.FILE_KEYS:
+                entry[key] = path.normpath(path.join(blocks_dir_path, entry[key]))
+            if not all(is_in_dir(entry[key], blocks_dir_path) for key in ManifestField.FILE_KEYS):
+                continue
+            entry[ManifestField.NB_REGIONS] = int(entry[ManifestField.NB_REGIONS])
+            entry[ManifestField.NB_BYTES] = int(entry[ManifestField.NB_BYTES])
+            period = tu.create_period(entry[ManifestField.PERIOD])
+            result[(period, entry[ManifestField.LABEL_ID])] = entry
+    return result
+
+
+# Return true if the given file is located in the given directory (or in its sub-directories), symbolic links
+# resolved.
+def is_in_dir(file_path: str, dir_path: str) -> bool:
+    dir_path = path.realpath(dir_path)
+    return path.commonpath((path.realpath(file_path), dir_path)) == dir_path
+
+
+# A block is complete and valid if its files exist and match the checksum and the number of regions of its entry,
+# and if it was extracted from the rows of the given checksum (if any, see compute_rows_checksum).
+def is_valid_entry(entry: Mapping[str, any], nb_regions: int, rows_checksum: str = None) -> bool:
+    if entry[ManifestField.NB_REGIONS] != nb_regions:
+        return False
+    if rows_checksum is not None and entry[ManifestField.ROWS_CHECKSUM] != rows_checksum:
+        return False
+    file_paths = (entry[ManifestField.DATA_BLOCK], entry[ManifestField.METADATA_BLOCK])
+    if not all(path.isfile(file_path) for file_path in file_paths):
+        return False
+    return compute_checksum(*file_paths) == entry[ManifestField.CHECKSUM]
+
+
+def __test_manifest():
+    import shutil
+    import tempfile
+    block = np.zeros(3, dtype=[('lat', np.float64), ('lon', np.float64), ('day2d', '<U2')])
+    block['lat'] = [10., 20., 30.]
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        blocks_dir_path = path.join(tmp_dir_path, 'blocks')
+        block_dir_path = path.join(blocks_dir_path, '2000_10', 'cyclone')
+        os.makedirs(block_dir_path)
+        file_paths = {'data_block': path.join(block_dir_path, 'msl_data.h5'),
+                      'metadata_block': path.join(block_dir_path, 'msl_metadata.csv')}
+        for file_path in file_paths.values():
+            with open(file_path, 'wb') as file:
+                file.write(file_path.encode('utf-8'))
+        manifest_file_path = nu.compute_manifest_file_path('msl', blocks_dir_path)
+        with ManifestWriter(manifest_file_path, blocks_dir_path) as manifest:
+            manifest.write((2000, 10), 'cyclone', len(block), 10, compute_checksum(*file_paths.values()),
+                           compute_rows_checksum(block), file_paths)
+
+        entry = load_manifest(manifest_file_path, blocks_dir_path)[((2000, 10), 'cyclone')]
+        assert entry[ManifestField.DATA_BLOCK] == file_paths['data_block']
+        assert is_valid_entry(entry, len(block), compute_rows_checksum(block))
+        assert not is_valid_entry(entry, len(block) + 1)
+        changed_block = block.copy()
+        changed_block['lat'][1] = 21.
+        assert not is_valid_entry(entry, len(block), compute_rows_checksum(changed_block))
+        # The same values in other types have the same checksum.
+        assert compute_rows_checksum(block.astype([('lat', np.float32), ('lon', np.int64), ('day2d', '<U2')])) == \
+            compute_rows_checksum(block)
+
+        # The paths are relative to the blocks directory: a copy of the blocks tree refers to its own files.
+        copy_dir_path = path.join(tmp_dir_path, 'copy')
+        shutil.copytree(blocks_dir_path, copy_dir_path)
+        copy_entry = load_manifest(nu.compute_manifest_file_path('msl', copy_dir_path), copy_dir_path)[
+            ((2000, 10), 'cyclone')]
+        assert copy_entry[ManifestField.DATA_BLOCK] == path.join(copy_dir_path, '2000_10', 'cyclone', 'msl_data.h5')
+        with open(copy_entry[ManifestField.DATA_BLOCK], 'ab') as file:
+            file.write(b'corrupted')
+        assert not is_valid_entry(copy_entry, len(block)) and is_valid_entry(entry, len(block))
+
+        # The entries outside the blocks directory are ignored.
+        with ManifestWriter(manifest_file_path, blocks_dir_path, [copy_entry]):
+            pass
+        assert len(load_manifest(manifest_file_path, blocks_dir_path)) == 0
+        assert not is_in_dir(copy_entry[ManifestField.DATA_BLOCK], blocks_dir_path)
+
+
+def __all_tests():
+    __test_manifest()
+
+
+if __name__ == '__main__':
+    __all_tests()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+from typing import Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from nxtensor.exceptions import ExtractionError
+
+
+class GridIndex:
+
+    # Resolve (time, lat, lon) labels into integer (t, i, j) positions of the grid of a dataset.
+    # The coordinate arrays are given once, when the index is created (see xarray_extractions.create_grid_index).
+    # The positions are computed with arithmetic when the coordinates are regularly spaced, with a binary
+    # search otherwise.
+    def __init__(self, times: pd.Index, lats: np.ndarray, lat_resolution: float,
+                 lons: np.ndarray, lon_resolution: float):
+        self.times: pd.Index = times
+        self.lats: np.ndarray = np.asarray(lats, dtype=np.float64)
+        self.lat_resolution: float = lat_resolution
+        self.lons: np.ndarray = np.asarray(lons, dtype=np.float64)
+        self.lon_resolution: float = lon_resolution
+        self.is_lat_decreasing: bool = bool(self.lats[0] > self.lats[-1])
+        self.__lat_step: float = GridIndex.__compute_step(self.lats)
+        self.__lon_step: float = GridIndex.__compute_step(self.lons)
+        # A grid that covers 360° of longitude is periodic: regions that cross its edge are wrapped around.
+        self.is_lon_periodic: bool = self.__lon_step is not None and \
+            bool(np.isclose(abs(self.__lon_step) * len(self.lons), 360.))
+
+    # Return the step of the given coordinates if they are regularly spaced, None otherwise.
+    @staticmethod
+    def __compute_step(series: np.ndarray):
+        if len(series) < 2:
+            return None
+        steps = np.diff(series)
+        step = float(steps[0])
+        if step != 0 and np.allclose(steps, step, rtol=0, atol=abs(step) * 1e-6):
+            return step
+        else:
+            return None
+
+    @staticmethod
+    def __compute_positions(series: np.ndarray, step: float, resolution: float, values: np.ndarray,
+                            coordinate_name: str, is_periodic: bool = False) -> np.ndarray:
+        if step is not None:
+            result = np.rint((values - series[0]) / step).astype(np.int64)
+            if is_periodic:
+                result = np.mod(result, len(series))
+        else:
+            is_decreasing = series[0] > series[-1]
+            sorted_series = -series if is_decreasing else series
+            sorted_values = -values if is_decreasing else values
+            result = np.searchsorted(sorted_series, sorted_values - resolution / 2)
+        clipped_result = np.clip(result, 0, len(series) - 1)
+        differences = np.abs(series[clipped_result] - values)
+        if is_periodic:
+            differences = np.mod(differences, 360.)
+            differences = np.minimum(differences, 360. - differences)
+        mismatches = (result != clipped_result) | (differences > resolution / 2)
+        if np.any(mismatches):
+            msg = f"unable to locate {coordinate_name} value(s) {values[mismatches][:5]} in the grid"
+            raise ExtractionError(msg)
+        return result
+
+    def lat_positions(self, lats: Sequence[float]) -> np.ndarray:
+        return GridIndex.__compute_positions(self.lats, self.__lat_step, self.lat_resolution,
+                                             np.asarray(lats, dtype=np.float64), 'latitude')
+
+    def lon_positions(self, lons: Sequence[float]) -> np.ndarray:
+        return GridIndex.__compute_positions(self.lons, self.__lon_step, self.lon_resolution,
+                                             np.asarray(lons, dtype=np.float64), 'longitude', self.is_lon_periodic)
+
+    # The dates are looked up exactly. The dates that miss are resolved like the label based selection, with partial
+    # string indexing (e.g. '2000-10-05' for daily data stamped at noon): they must match only one timestep.
+    def time_positions(self, formatted_dates: Sequence[str]) -> np.ndarray:
+        formatted_dates = np.asarray(formatted_dates)
+        result = self.times.get_indexer(pd.to_datetime(list(formatted_dates)))
+        for formatted_date in np.unique(formatted_dates[result < 0]):
+            result[formatted_dates == formatted_date] = self.__resolve_partial_date(str(formatted_date))
+        return result
+
+    def __resolve_partial_date(self, formatted_date: str) -> int:
+        try:
+            positions = np.arange(len(self.times))[self.times.get_loc(formatted_date)]
+        except KeyError:
+            msg = f"unable to locate the date '{formatted_date}' in the grid"
+            raise ExtractionError(msg)
+        positions = np.atleast_1d(positions)
+        if len(positions) != 1:
+            msg = f"ambiguous date '{formatted_date}': it matches {len(positions)} timesteps of the grid"
+            raise ExtractionError(msg)
+        return int(positions[0])
+
+    # Return the time positions (shape: (N,)), the latitude positions (shape: (N, y_size)) and the longitude
+    # positions (shape: (N, x_size)) of the regions that center the given locations.
+    # The regions always have y_size × x_size pixels: they are wrapped around the longitude edge of periodic grids,
+    # otherwise an ExtractionError is raised when a region overflows the grid.
+    def compute_window_positions(self, formatted_dates: Sequence[str],
+                                 lats: Sequence[float], half_lat_frame: int,
+                                 lons: Sequence[float], half_lon_frame: int) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        y_size, x_size = self.compute_window_shape(half_lat_frame, half_lon_frame)
+        time_positions = self.time_positions(formatted_dates)
+
+        # Same bounds as the label based extraction: the first row of a region is lat + half_lat_frame
+        # if the latitudes are decreasing, lat - half_lat_frame + lat_resolution otherwise.
+        half_nb_rows = int(round(half_lat_frame / self.lat_resolution))
+        lat_origins = self.lat_positions(lats) - half_nb_rows
+        if not self.is_lat_decreasing:
+            lat_origins += 1
+        overflows = (lat_origins < 0) | ((lat_origins + y_size) > len(self.lats))
+        if np.any(overflows):
+            msg = f"{np.count_nonzero(overflows)} region(s) overflow the latitude bounds of the grid"
+            raise ExtractionError(msg)
+        lat_positions = lat_origins[:, np.newaxis] + np.arange(y_size)
+
+        half_nb_columns = int(round(half_lon_frame / self.lon_resolution))
+        lon_origins = self.lon_positions(lons) - half_nb_columns
+        lon_positions = lon_origins[:, np.newaxis] + np.arange(x_size)
+        if self.is_lon_periodic:
+            lon_positions = np.mod(lon_positions, len(self.lons))
+        else:
+            overflows = (lon_origins < 0) | ((lon_origins + x_size) > len(self.lons))
+            if np.any(overflows):
+                msg = f"{np.count_nonzero(overflows)} region(s) overflow the longitude bounds of the grid"
+                raise ExtractionError(msg)
+
+        return time_positions, lat_positions, lon_positions
+
+    def compute_window_shape(self, half_lat_frame: int, half_lon_frame: int) -> Tuple[int, int]:
+        y_size = int(round(2 * half_lat_frame / self.lat_resolution))
+        x_size = int(round(2 * half_lon_frame / self.lon_resolution))
+        return y_size, x_size
+
+
+def __test_compute_window_positions():
+    times = pd.date_range('2000-10-01', periods=8, freq='6h')
+    # Decreasing latitudes and longitudes from 0 to 360 (e.g. ERA5).
+    lats = np.linspace(90., -90., 721)
+    lons = np.arange(0., 360., 0.25)
+    grid_index = GridIndex(times, lats, 0.25, lons, 0.25)
+    assert grid_index.is_lat_decreasing and grid_index.is_lon_periodic
+    time_positions, lat_positions, lon_positions = \
+        grid_index.compute_window_positions(['2000-10-01T06', '2000-10-02T18'], [40., 39.7], 2, [312., 359.8], 2)
+    assert list(time_positions) == [1, 7]
+    assert lat_positions.shape == (2, 16) and lon_positions.shape == (2, 16)
+    # The first row of a region is lat + half_lat_frame when the latitudes are decreasing.
+    assert lats[lat_positions[0, 0]] == 42. and lats[lat_positions[1, 0]] == 41.75
+    assert lons[lon_positions[0, 0]] == 310.
+    # The second region is wrapped around the longitude edge of the grid.
+    assert list(lons[lon_positions[1, 7:10]]) == [359.5, 359.75, 0.]
+    try:
+        grid_index.compute_window_positions(['2000-10-01'], [89.], 2, [0.], 2)
+        assert False
+    except ExtractionError:
+        pass
+
+    # Increasing and irregular latitudes (binary search), not periodic longitudes.
+    lats = np.array([-10., -9., -7.5, -7., -6., -5., -4., -3.])
+    grid_index = GridIndex(times, lats, 1., np.arange(10.), 1.)
+    assert not grid_index.is_lat_decreasing and not grid_index.is_lon_periodic
+    assert list(grid_index.lat_positions([-7.4, -3.])) == [2, 7]
+    _, lat_positions, lon_positions = grid_index.compute_window_positions(['2000-10-01'], [-6.], 2, [5.], 2)
+    assert list(lat_positions[0]) == [3, 4, 5, 6] and list(lon_positions[0]) == [3, 4, 5, 6]
+    for lats, lons in (([-20.], [5.]), ([-6.], [9.])):
+        try:
+            grid_index.compute_window_positions(['2000-10-01'], lats, 2, lons, 2)
+            assert False
+        except ExtractionError:
+            pass
+
+
+def __test_time_positions():
+    # Daily data stamped at noon.
+    grid_index = GridIndex(pd.date_range('2000-10-01T12', periods=10, freq='D'), np.arange(10.), 1.,
+                           np.arange(10.), 1.)
+    assert list(grid_index.time_positions(['2000-10-05', '2000-10-01T12', '2000-10-05'])) == [4, 0, 4]
+    # Twice a day: a day is ambiguous.
+    grid_index = GridIndex(pd.date_range('2000-10-01T06', periods=4, freq='12h'), np.arange(10.), 1.,
+                           np.arange(10.), 1.)
+    for formatted_dates in (['2000-10-01'], ['2000-11-01']):
+        try:
+            grid_index.time_positions(formatted_dates)
+            assert False
+        except ExtractionError:
+            pass
+
+
+def __all_tests():
+    __test_compute_window_positions()
+    __test_time_positions()
+
+
+if __name__ == '__main__':
+    __all_tests()
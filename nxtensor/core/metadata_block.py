@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 09:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+from string import Formatter
+import os
+import shutil
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from nxtensor.core.types import MetaDataBlock
+from nxtensor.utils.coordinates import Coordinate
+from nxtensor.utils.tensor_dimensions import TensorDimension
+from nxtensor.utils.time_resolutions import TimeResolution
+
+# A block of extraction metadata is a NumPy structured array: one field per column (lat, lon, year, month, etc.)
+# and one element per row. The blocks are built, sliced and pickled without any per-row Python object.
+
+# The 2-digit time fields and the fields they are formatted from.
+__FORMATTED_TIME_FIELDS = {TimeResolution.MONTH2D: TimeResolution.MONTH,
+                           TimeResolution.DAY2D: TimeResolution.DAY,
+                           TimeResolution.HOUR2D: TimeResolution.HOUR}
+
+# The formatted fields of a block (see create_metadata_block).
+FORMATTED_TIME_KEYS = tuple(__FORMATTED_TIME_FIELDS.keys())
+
+
+# A block saved in a NumPy file (see save_metadata_block), of which only the rows [start, stop[ are referenced.
+# The reference is cheap to pickle: the processes exchange references and load the rows they process, memory-mapped.
+class MetaDataBlockReference:
+
+    def __init__(self, file_path: str, start: int, stop: int):
+        self.file_path: str = file_path
+        self.start: int = start
+        self.stop: int = stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    # Only the slices of contiguous rows are supported (e.g. reference[nb_previous_rows:]).
+    def __getitem__(self, key: slice) -> 'MetaDataBlockReference':
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            msg = f"> [ERROR] unsupported slice '{key}' of metadata block reference"
+            raise ValueError(msg)
+        return MetaDataBlockReference(self.file_path, self.start + start, self.start + max(start, stop))
+
+    def load(self) -> MetaDataBlock:
+        return np.load(self.file_path, mmap_mode='r')[self.start:self.stop]
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(file_path={self.file_path}, start={self.start}, stop={self.stop})"
+
+
+# A block or a reference to a block.
+LazyMetaDataBlock = Union[MetaDataBlock, MetaDataBlockReference]
+
+
+# Save the given block into the given NumPy file and return its reference. The blocks with Python objects (e.g.
+# string columns of the db) can't be memory-mapped: they are returned as is.
+def save_metadata_block(extraction_metadata_block: MetaDataBlock, file_path: str) -> LazyMetaDataBlock:
+    if extraction_metadata_block.dtype.hasobject:
+        return extraction_metadata_block
+    np.save(file_path, extraction_metadata_block, allow_pickle=False)
+    return MetaDataBlockReference(file_path, 0, len(extraction_metadata_block))
+
+
+# Return the rows of the given block or block reference.
+def load_metadata_block(extraction_metadata_block: LazyMetaDataBlock) -> MetaDataBlock:
+    if isinstance(extraction_metadata_block, MetaDataBlockReference):
+        return extraction_metadata_block.load()
+    return extraction_metadata_block
+
+
+# Append the rows of the given block to the given shard file (raw rows, without header). The blocks appended to
+# a shard must have the same dtype (see create_shard_dtype).
+def append_to_shard(extraction_metadata_block: MetaDataBlock, shard_file_path: str) -> None:
+    with open(shard_file_path, 'ab') as shard_file:
+        extraction_metadata_block.tofile(shard_file)
+
+
+# Convert the given shard file of nb_rows rows of the given dtype into a NumPy file and return its reference.
+# The rows are copied by buffer: the shard is never loaded in memory. The shard file is removed.
+def save_shard(shard_file_path: str, dtype: np.dtype, nb_rows: int, file_path: str) -> MetaDataBlockReference:
+    header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (nb_rows,)}
+    with open(file_path, 'wb') as file:
+        np.lib.format.write_array_header_1_0(file, header)
+        with open(shard_file_path, 'rb') as shard_file:
+            shutil.copyfileobj(shard_file, file)
+    os.remove(shard_file_path)
+    return MetaDataBlockReference(file_path, 0, nb_rows)
+
+
+# Return the dtype of the given block, with the same type per field whatever the rows (e.g. a chunk of integer
+# latitudes): the blocks built from the chunks of a db are appended to the same shards.
+def create_shard_dtype(dtype: np.dtype) -> np.dtype:
+    fields = list()
+    for name in dtype.names:
+        if name in FORMATTED_TIME_KEYS:
+            fields.append((name, '<U2'))
+        elif name in TimeResolution.KEYS:
+            fields.append((name, np.int64))
+        elif name in (Coordinate.LAT, Coordinate.LON, TensorDimension.LABEL_NUM_ID):
+            fields.append((name, np.float64))
+        else:
+            fields.append((name, dtype.fields[name][0]))
+    return np.dtype(fields)
+
+
+# Convert the rows of the given dataframe into a block. The 2-digit time fields (month2d, day2d and hour2d) are
+# added, so as to format the date templates of the variables (e.g. '{year}-{month2d}-{day2d}T{hour2d}').
+def create_metadata_block(dataframe: pd.DataFrame) -> MetaDataBlock:
+    columns: Dict[str, np.ndarray] = {str(name): dataframe[name].to_numpy() for name in dataframe.columns}
+    for formatted_key, key in __FORMATTED_TIME_FIELDS.items():
+        if key in columns:
+            columns[formatted_key] = np.char.zfill(columns[key].astype(np.int64).astype(np.str_), 2)
+    return __create_structured_array(columns, len(dataframe))
+
+
+# Return the value of the given template (str.format syntax) for each row of the given block.
+# The fields of the template are the fields of the block.
+def format_template(template: str, extraction_metadata_block: MetaDataBlock) -> np.ndarray:
+    parsed_template = list(Formatter().parse(template))
+    if any(conversion or format_spec or (field_name is not None and field_name not in
+                                         extraction_metadata_block.dtype.names)
+           for _, field_name, format_spec, conversion in parsed_template):
+        # Conversions, format specifications and attribute or index fields fall back to str.format.
+        return np.array([template.format(**row) for row in to_records(extraction_metadata_block)], dtype=np.str_)
+
+    result = np.full(len(extraction_metadata_block), '', dtype=np.str_)
+    for literal_text, field_name, _, _ in parsed_template:
+        if literal_text:
+            result = np.char.add(result, literal_text)
+        if field_name is not None:
+            result = np.char.add(result, extraction_metadata_block[field_name].astype(np.str_))
+    return result
+
+
+# Return the latitudes and the longitudes of the given block.
+def get_coordinates(extraction_metadata_block: MetaDataBlock) -> Tuple[np.ndarray, np.ndarray]:
+    return extraction_metadata_block[Coordinate.LAT], extraction_metadata_block[Coordinate.LON]
+
+
+# Return the rows of the given block as mappings of Python values (e.g. for the extraction row by row or the
+# csv_utils functions).
+def to_records(extraction_metadata_block: MetaDataBlock) \
+        -> List[Dict[Union[TimeResolution, Coordinate, TensorDimension], Union[int, float, str]]]:
+    names = extraction_metadata_block.dtype.names
+    return [dict(zip(names, row)) for row in extraction_metadata_block.tolist()]
+
+
+def __create_structured_array(columns: Dict[str, np.ndarray], nb_rows: int) -> MetaDataBlock:
+    result = np.empty(nb_rows, dtype=[(name, values.dtype) for name, values in columns.items()])
+    for name, values in columns.items():
+        result[name] = values
+    return result
+
+
+def __test_create_metadata_block():
+    dataframe = pd.DataFrame({Coordinate.LAT: [39.7, 15.], Coordinate.LON: [312., 301.5],
+                              TimeResolution.YEAR: [2000, 2000], TimeResolution.MONTH: [10, 10],
+                              TimeResolution.DAY: [1, 12], TimeResolution.HOUR: [0, 18],
+                              TensorDimension.LABEL_NUM_ID: [1., 1.]})
+    block = create_metadata_block(dataframe)
+    assert len(block) == 2
+    assert list(block[TimeResolution.DAY2D]) == ['01', '12']
+    assert list(block[TimeResolution.HOUR2D]) == ['00', '18']
+    template = '{year}-{month2d}-{day2d}T{hour2d}'
+    assert list(format_template(template, block)) == ['2000-10-01T00', '2000-10-12T18']
+    assert list(format_template('{year}-{month:02d}-{day}', block)) == ['2000-10-1', '2000-10-12']
+    records = to_records(block[1:])
+    assert records == [{Coordinate.LAT: 15., Coordinate.LON: 301.5, TimeResolution.YEAR: 2000,
+                        TimeResolution.MONTH: 10, TimeResolution.DAY: 12, TimeResolution.HOUR: 18,
+                        TensorDimension.LABEL_NUM_ID: 1., TimeResolution.MONTH2D: '10',
+                        TimeResolution.DAY2D: '12', TimeResolution.HOUR2D: '18'}]
+    assert template.format(**records[0]) == '2000-10-12T18'
+
+
+def __test_metadata_block_reference():
+    import tempfile
+    import os.path as path
+    dataframe = pd.DataFrame({Coordinate.LAT: np.arange(10.), Coordinate.LON: np.arange(10.),
+                              TimeResolution.YEAR: 2000, TimeResolution.MONTH: 10, TimeResolution.DAY: 1,
+                              TimeResolution.HOUR: np.arange(10)})
+    block = create_metadata_block(dataframe)
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        reference = save_metadata_block(block, path.join(tmp_dir_path, 'block.npy'))
+        assert len(reference) == 10
+        assert len(reference[3:]) == 7 and len(reference[3:][:2]) == 2 and len(reference[12:]) == 0
+        assert np.array_equal(load_metadata_block(reference[3:][:2]), block[3:5])
+        assert np.array_equal(load_metadata_block(block), block)
+
+
+def __test_shard():
+    import tempfile
+    import os.path as path
+    dataframe = pd.DataFrame({Coordinate.LAT: np.arange(10), Coordinate.LON: np.arange(10.),
+                              TimeResolution.YEAR: 2000, TimeResolution.MONTH: 10, TimeResolution.DAY: 1,
+                              TimeResolution.HOUR: np.arange(10)})
+    block = create_metadata_block(dataframe)
+    dtype = create_shard_dtype(block.dtype)
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        shard_file_path = path.join(tmp_dir_path, 'block.part')
+        append_to_shard(block[:4].astype(dtype), shard_file_path)
+        append_to_shard(block[4:].astype(dtype), shard_file_path)
+        reference = save_shard(shard_file_path, dtype, len(block), path.join(tmp_dir_path, 'block.npy'))
+        loaded_block = reference.load()
+        assert not path.exists(shard_file_path)
+        assert loaded_block.dtype == dtype and loaded_block[Coordinate.LAT].dtype == np.float64
+        assert np.array_equal(loaded_block[Coordinate.LAT], np.arange(10.))
+        assert list(loaded_block[TimeResolution.HOUR2D][-2:]) == ['08', '09']
+
+
+def __all_tests():
+    __test_create_metadata_block()
+    __test_shard()
+    __test_metadata_block_reference()
+
+
+if __name__ == '__main__':
+    __all_tests()
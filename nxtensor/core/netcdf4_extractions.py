@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 16:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+from typing import Mapping, Sequence, Tuple
+
+import logging
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+import nxtensor.utils.coordinate_utils as coordinate_utils
+from nxtensor.core.grid_index import GridIndex
+from nxtensor.core.read_planner import ReadStrategy, ReadPlan, ChunkLayout, DEFAULT_MAX_SLAB_NBYTES, \
+    DEFAULT_READ_OVERHEAD_NBYTES
+import nxtensor.core.read_planner as rp
+from nxtensor.exceptions import ExtractionError
+
+# Reader backend that slices the NetCDF variables directly with the netCDF4 library, into preallocated numpy
+# arrays: it bypasses the per call overhead of xarray (dask context, coordinates, etc.).
+# The functions have the same signatures as the ones of xarray_extractions and return the same values: the packed
+# and masked values are decoded according to the CF conventions, like xarray does.
+
+
+def open_netcdf(netcdf_file_path: str, options: Mapping[str, str] = None) -> netCDF4.Dataset:
+    if options is None:
+        options = {}
+    result = netCDF4.Dataset(netcdf_file_path, mode='r', **options)
+    # The values are decoded by __decode, on the whole slabs.
+    result.set_auto_maskandscale(False)
+    return result
+
+
+def create_grid_index(dataset: netCDF4.Dataset, lat_resolution: float, lon_resolution: float,
+                      time_netcdf_attr_name: str = 'time',
+                      lat_netcdf_attr_name: str = 'latitude',
+                      lon_netcdf_attr_name: str = 'longitude') -> GridIndex:
+    time_variable = dataset[time_netcdf_attr_name]
+    calendar = getattr(time_variable, 'calendar', 'standard')
+    dates = netCDF4.num2date(time_variable[:], units=time_variable.units, calendar=calendar,
+                             only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+    times = pd.DatetimeIndex(dates)
+    return GridIndex(times, dataset[lat_netcdf_attr_name][:], lat_resolution,
+                     dataset[lon_netcdf_attr_name][:], lon_resolution)
+
+
+def get_chunk_layout(dataset: netCDF4.Dataset, variable_netcdf_attr_name: str,
+                     time_netcdf_attr_name: str = 'time',
+                     lat_netcdf_attr_name: str = 'latitude',
+                     lon_netcdf_attr_name: str = 'longitude') -> ChunkLayout:
+    variable = dataset[variable_netcdf_attr_name]
+    chunk_sizes = variable.chunking()
+    if chunk_sizes == 'contiguous':
+        chunk_sizes = (1,) * variable.ndim
+    chunk_sizes = dict(zip(variable.dimensions, chunk_sizes))
+    dims = (time_netcdf_attr_name, lat_netcdf_attr_name, lon_netcdf_attr_name)
+    chunk_nbytes = int(np.prod(list(chunk_sizes.values()))) * variable.dtype.itemsize
+    filters = variable.filters()
+    is_compressed = filters is not None and any(filters.get(name, False)
+                                                for name in ('zlib', 'szip', 'zstd', 'bzip2', 'blosc'))
+    return ChunkLayout(shape=tuple(len(dataset.dimensions[dim]) for dim in dims),
+                       chunk_shape=tuple(chunk_sizes[dim] for dim in dims),
+                       chunk_nbytes=chunk_nbytes, is_compressed=is_compressed)
+
+
+def extract_square_region(dataset: netCDF4.Dataset, variable_netcdf_attr_name: str, formatted_date: str,
+                          lat: float, lat_resolution: float, half_lat_frame: int,
+                          lon: float, lon_resolution: float, half_lon_frame: int,
+                          variable_level: int = None, level_netcdf_attr_name: str = 'level',
+                          time_netcdf_attr_name: str = 'time',
+                          lat_netcdf_attr_name: str = 'latitude',
+                          lon_netcdf_attr_name: str = 'longitude',
+                          has_to_round: bool = False, lat_nb_decimal: int = None, lon_nb_decimal: int = None,
+                          dask_scheduler: str = 'single-threaded', grid_index: GridIndex = None) -> xr.DataArray:
+    result = extract_square_regions(dataset, variable_netcdf_attr_name, [formatted_date], [lat], lat_resolution,
+                                    half_lat_frame, [lon], lon_resolution, half_lon_frame, variable_level,
+                                    level_netcdf_attr_name, time_netcdf_attr_name, lat_netcdf_attr_name,
+                                    lon_netcdf_attr_name, has_to_round, lat_nb_decimal, lon_nb_decimal,
+                                    dask_scheduler, grid_index, ReadStrategy.BOUNDING_BOX)
+    return xr.DataArray(result[0])
+
+
+# See xarray_extractions.extract_square_regions. The dask scheduler is not used: it is kept so as the signatures
+# of the backends are the same.
+def extract_square_regions(dataset: netCDF4.Dataset, variable_netcdf_attr_name: str,
+                           formatted_dates: Sequence[str],
+                           lats: Sequence[float], lat_resolution: float, half_lat_frame: int,
+                           lons: Sequence[float], lon_resolution: float, half_lon_frame: int,
+                           variable_level: int = None, level_netcdf_attr_name: str = 'level',
+                           time_netcdf_attr_name: str = 'time',
+                           lat_netcdf_attr_name: str = 'latitude',
+                           lon_netcdf_attr_name: str = 'longitude',
+                           has_to_round: bool = False, lat_nb_decimal: int = None, lon_nb_decimal: int = None,
+                           dask_scheduler: str = 'single-threaded', grid_index: GridIndex = None,
+                           read_strategy: ReadStrategy = ReadStrategy.BOUNDING_BOX,
+                           max_slab_nbytes: int = DEFAULT_MAX_SLAB_NBYTES,
+                           read_overhead_nbytes: int = DEFAULT_READ_OVERHEAD_NBYTES) -> np.ndarray:
+    time_positions, lat_positions, lon_positions = \
+        __compute_window_positions(dataset, formatted_dates, lats, lat_resolution, half_lat_frame,
+                                   lons, lon_resolution, half_lon_frame, time_netcdf_attr_name,
+                                   lat_netcdf_attr_name, lon_netcdf_attr_name, has_to_round, lat_nb_decimal,
+                                   lon_nb_decimal, grid_index)
+
+    variable = dataset[variable_netcdf_attr_name]
+    dims = (time_netcdf_attr_name, lat_netcdf_attr_name, lon_netcdf_attr_name)
+    level_position = None
+    if variable_level:
+        levels = dataset[level_netcdf_attr_name][:]
+        level_positions = np.flatnonzero(levels == variable_level)
+        if len(level_positions) == 0:
+            msg = f"unable to locate the level {variable_level} of {variable_netcdf_attr_name}"
+            raise ExtractionError(msg)
+        level_position = int(level_positions[0])
+        dims = dims + (level_netcdf_attr_name,)
+    if set(variable.dimensions) != set(dims):
+        msg = f"unsupported dimensions {variable.dimensions} for {variable_netcdf_attr_name}"
+        raise ExtractionError(msg)
+
+    chunk_layout = get_chunk_layout(dataset, variable_netcdf_attr_name, time_netcdf_attr_name,
+                                    lat_netcdf_attr_name, lon_netcdf_attr_name)
+    read_plan = rp.plan_reads(read_strategy, time_positions, lat_positions, lon_positions, chunk_layout,
+                              variable.dtype.itemsize, max_slab_nbytes, read_overhead_nbytes)
+    logging.debug(f"extracting {len(time_positions)} regions of {variable_netcdf_attr_name}: {read_plan}")
+
+    # Regions are gathered raw, then decoded at once.
+    result = np.empty((len(time_positions),) + lat_positions.shape[1:] + lon_positions.shape[1:],
+                      dtype=variable.dtype)
+    for read in read_plan.reads:
+        indexers = dict()
+        indexers[time_netcdf_attr_name] = __to_indexer(read.time_positions)
+        indexers[lat_netcdf_attr_name] = slice(read.lat_start, read.lat_stop)
+        indexers[lon_netcdf_attr_name] = slice(read.lon_start, read.lon_stop)
+        indexers[level_netcdf_attr_name] = level_position
+        slab = variable[tuple(indexers[dim] for dim in variable.dimensions)]
+        # The integer level indexer drops its dimension.
+        slab_dims = [dim for dim in variable.dimensions if dim != level_netcdf_attr_name or level_position is None]
+        slab = np.transpose(slab, [slab_dims.index(dim) for dim in dims[0:3]])
+        rp.gather_regions(result, slab, read, time_positions, lat_positions, lon_positions)
+    return __decode(variable, result)
+
+
+# Return the plan of the reads of extract_square_regions for the same parameters.
+def plan_square_regions(dataset: netCDF4.Dataset, variable_netcdf_attr_name: str, formatted_dates: Sequence[str],
+                        lats: Sequence[float], lat_resolution: float, half_lat_frame: int,
+                        lons: Sequence[float], lon_resolution: float, half_lon_frame: int,
+                        time_netcdf_attr_name: str = 'time',
+                        lat_netcdf_attr_name: str = 'latitude',
+                        lon_netcdf_attr_name: str = 'longitude',
+                        has_to_round: bool = False, lat_nb_decimal: int = None, lon_nb_decimal: int = None,
+                        grid_index: GridIndex = None,
+                        read_strategy: ReadStrategy = ReadStrategy.BOUNDING_BOX,
+                        max_slab_nbytes: int = DEFAULT_MAX_SLAB_NBYTES,
+                        read_overhead_nbytes: int = DEFAULT_READ_OVERHEAD_NBYTES) -> ReadPlan:
+    time_positions, lat_positions, lon_positions = \
+        __compute_window_positions(dataset, formatted_dates, lats, lat_resolution, half_lat_frame,
+                                   lons, lon_resolution, half_lon_frame, time_netcdf_attr_name,
+                                   lat_netcdf_attr_name, lon_netcdf_attr_name, has_to_round, lat_nb_decimal,
+                                   lon_nb_decimal, grid_index)
+    chunk_layout = get_chunk_layout(dataset, variable_netcdf_attr_name, time_netcdf_attr_name,
+                                    lat_netcdf_attr_name, lon_netcdf_attr_name)
+    itemsize = dataset[variable_netcdf_attr_name].dtype.itemsize
+    return rp.plan_reads(read_strategy, time_positions, lat_positions, lon_positions, chunk_layout, itemsize,
+                         max_slab_nbytes, read_overhead_nbytes)
+
+
+def __compute_window_positions(dataset: netCDF4.Dataset, formatted_dates: Sequence[str],
+                               lats: Sequence[float], lat_resolution: float, half_lat_frame: int,
+                               lons: Sequence[float], lon_resolution: float, half_lon_frame: int,
+                               time_netcdf_attr_name: str, lat_netcdf_attr_name: str, lon_netcdf_attr_name: str,
+                               has_to_round: bool, lat_nb_decimal: int, lon_nb_decimal: int,
+                               grid_index: GridIndex) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if has_to_round:
+        if (not lat_nb_decimal) or (not lon_nb_decimal):
+            raise ExtractionError("when has_to_round is true, lat_nb_decimal and lon_nb_decimal must be provided")
+        lats = coordinate_utils.round_nearest_array(lats, lat_resolution, lat_nb_decimal)
+        lons = coordinate_utils.round_nearest_array(lons, lon_resolution, lon_nb_decimal)
+
+    if grid_index is None:
+        grid_index = create_grid_index(dataset, lat_resolution, lon_resolution, time_netcdf_attr_name,
+                                       lat_netcdf_attr_name, lon_netcdf_attr_name)
+    return grid_index.compute_window_positions(formatted_dates, lats, half_lat_frame, lons, half_lon_frame)
+
+
+# Return a slice if the given positions are contiguous, the positions otherwise.
+def __to_indexer(positions: np.ndarray):
+    if len(positions) > 0 and positions[-1] - positions[0] + 1 == len(positions):
+        return slice(int(positions[0]), int(positions[-1]) + 1)
+    else:
+        return positions
+
+
+# Decode the raw values according to the CF conventions (_FillValue, missing_value, scale_factor and add_offset),
+# with the same float types as xarray.
+def __decode(variable: netCDF4.Variable, values: np.ndarray) -> np.ndarray:
+    attributes = {name: variable.getncattr(name) for name in variable.ncattrs()}
+    fill_values = [attributes[name] for name in ('_FillValue', 'missing_value') if name in attributes]
+    scale_factor = attributes.get('scale_factor', None)
+    add_offset = attributes.get('add_offset', None)
+    dtype = __choose_float_dtype(values.dtype, scale_factor, add_offset)
+
+    if dtype is None and not (fill_values and np.issubdtype(values.dtype, np.integer)):
+        # Float values: the missing values are replaced in place.
+        if fill_values:
+            values[np.isin(values, np.ravel(fill_values))] = np.nan
+        return values
+
+    if dtype is None:
+        dtype = np.float32 if values.dtype.itemsize <= 2 else np.float64
+    mask = np.isin(values, np.ravel(fill_values)) if fill_values else None
+    result = values.astype(dtype)
+    if scale_factor is not None:
+        result *= np.asarray(scale_factor, dtype=dtype)
+    if add_offset is not None:
+        result += np.asarray(add_offset, dtype=dtype)
+    if mask is not None:
+        result[mask] = np.nan
+    return result
+
+
+# Return the float type of the decoded values, None if the values are not packed.
+def __choose_float_dtype(dtype: np.dtype, scale_factor, add_offset):
+    if scale_factor is None and add_offset is None:
+        return None
+    types = [np.asarray(value).dtype for value in (scale_factor, add_offset) if value is not None]
+    if len(types) == 2 and types[0] == types[1] and types[0] in (np.float32, np.float64):
+        # Packed 32 bits integers need the precision of float64.
+        if dtype.itemsize == 4 and np.issubdtype(dtype, np.integer):
+            return np.float64
+        return types[0].type
+    if add_offset is not None:
+        return np.float64
+    return types[0].type if np.issubdtype(types[0], np.floating) else np.float64
+
+
+def __test_extract_square_regions():
+    import os.path as path
+    import tempfile
+    import nxtensor.core.xarray_extractions as xtract
+    rng = np.random.default_rng(0)
+    times = pd.date_range('2000-10-01', periods=8, freq='6h')
+    lats = np.arange(20., 0., -0.5)
+    lons = np.arange(0., 360., 2.)
+    levels = np.array([500, 850])
+    values = rng.normal(loc=1000., scale=20., size=(len(times), len(levels), len(lats), len(lons)))
+    # A missing value in the first region of the level 500.
+    values[0, 0, 6, 0] = np.nan
+    dataset = xr.Dataset({'ta': (('time', 'level', 'latitude', 'longitude'), values),
+                          'msl': (('time', 'latitude', 'longitude'), values[:, 1])},
+                         coords={'time': times, 'level': levels, 'latitude': lats, 'longitude': lons})
+    # Packed, masked, chunked and compressed values.
+    encoding = {'ta': {'dtype': 'int16', 'scale_factor': 0.01, 'add_offset': 1000., '_FillValue': -32767,
+                       'zlib': True, 'chunksizes': (2, 1, 10, 30)},
+                'msl': {'dtype': 'float32'}}
+    formatted_dates = ['2000-10-01T00', '2000-10-02T18', '2000-10-01T12', '2000-10-01T00']
+    region_lats = [16., 10.5, 5., 17.]
+    region_lons = [0., 120., 358., 200.]
+    with tempfile.TemporaryDirectory() as tmp_dir_path:
+        netcdf_file_path = path.join(tmp_dir_path, 'test.nc')
+        dataset.to_netcdf(netcdf_file_path, encoding=encoding)
+        xarray_dataset = xtract.open_netcdf(netcdf_file_path)
+        netcdf4_dataset = open_netcdf(netcdf_file_path)
+        for variable_name, variable_level in (('ta', 500), ('ta', 850), ('msl', None)):
+            for read_strategy in (ReadStrategy.BOUNDING_BOX, ReadStrategy.TIME_SLICE, ReadStrategy.CHUNK_ALIGNED):
+                expected = xtract.extract_square_regions(xarray_dataset, variable_name, formatted_dates,
+                                                         region_lats, 0.5, 2, region_lons, 2., 8,
+                                                         variable_level=variable_level, read_strategy=read_strategy)
+                result = extract_square_regions(netcdf4_dataset, variable_name, formatted_dates, region_lats, 0.5,
+                                                2, region_lons, 2., 8, variable_level=variable_level,
+                                                read_strategy=read_strategy)
+                assert result.shape == (4, 8, 8) and result.dtype == expected.dtype
+                assert np.array_equal(result, expected, equal_nan=True), (variable_name, variable_level,
+                                                                          read_strategy)
+                assert np.isnan(result[0]).any() == (variable_level == 500)
+        expected = xtract.extract_square_region(xarray_dataset, 'ta', formatted_dates[1], region_lats[1], 0.5, 2,
+                                                region_lons[1], 2., 8, variable_level=850)
+        result = extract_square_region(netcdf4_dataset, 'ta', formatted_dates[1], region_lats[1], 0.5, 2,
+                                       region_lons[1], 2., 8, variable_level=850)
+        assert np.array_equal(result.values, expected.values)
+        xarray_dataset.close()
+        netcdf4_dataset.close()
+
+
+def __all_tests():
+    __test_extract_square_regions()
+
+
+if __name__ == '__main__':
+    __all_tests()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 24 09:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from nxtensor.core.statistics import Statistics, QuantileSketch
+from nxtensor.exceptions import ConfigurationError
+from nxtensor.utils.normalization_modes import NormalizationMode
+
+# The data is standardized by chunks of this number of images, each chunk in a thread: the NumPy ufuncs release
+# the GIL, so the threads run in parallel without any temporary array.
+CHUNK_SIZE: int = 1024
+
+# The percentiles of the percentile clip normalization, by default.
+DEFAULT_CLIP_PERCENTILES: Tuple[float, float] = (1., 99.)
+# The percentiles of the summary of the quantile sketch of a channel (see compute_summary).
+SUMMARY_PERCENTILES: Tuple[float, ...] = (1., 5., 25., 50., 75., 95., 99.)
+
+# The names of the normalization parameters in the statistics of a channel.
+NORMALIZATION: str = 'normalization'
+OFFSET: str = 'offset'
+SCALE: str = 'scale'
+CLIP_MIN: str = 'clip_min'
+CLIP_MAX: str = 'clip_max'
+
+
+# Return the offset, the scale and the clip bounds (or None) of the given normalization mode (see NormalizationMode),
+# computed from the statistics and the quantile sketch of the data. Like the StandardScaler, a null scale is
+# replaced by 1 so as not to divide by zero.
+def compute_normalization_parameters(mode: NormalizationMode, statistics: Statistics, sketch: QuantileSketch,
+                                     clip_percentiles: Sequence[float] = None) \
+        -> Tuple[float, float, Optional[Tuple[float, float]]]:
+    clip = None
+    if mode == NormalizationMode.STANDARD:
+        offset, scale = statistics.mean, statistics.compute_std()
+    elif mode == NormalizationMode.ROBUST:
+        first_quartile, median, third_quartile = sketch.compute_quantiles([0.25, 0.5, 0.75])
+        offset, scale = float(median), float(third_quartile - first_quartile)
+    elif mode == NormalizationMode.PERCENTILE_CLIP:
+        low_percentile, high_percentile = clip_percentiles if clip_percentiles else DEFAULT_CLIP_PERCENTILES
+        if not 0. <= low_percentile < high_percentile <= 100.:
+            msg = f"> [ERROR] wrong clip percentiles '{clip_percentiles}'"
+            raise ConfigurationError(msg)
+        low, high = sketch.compute_quantiles([low_percentile / 100., high_percentile / 100.])
+        clip = (float(low), float(high))
+        offset, scale = float(low), float(high - low)
+    else:
+        msg = f"> [ERROR] unknown normalization mode '{mode}'"
+        raise ConfigurationError(msg)
+    return offset, scale if scale != 0. else 1., clip
+
+
+# Return the given percentiles of the values of the given sketch, named after their percentile (e.g. 'p50').
+def compute_summary(sketch: QuantileSketch, percentiles: Sequence[float] = SUMMARY_PERCENTILES) -> Dict[str, float]:
+    quantiles = sketch.compute_quantiles([percentile / 100. for percentile in percentiles])
+    return {f'p{percentile:g}': float(quantile) for percentile, quantile in zip(percentiles, quantiles)}
+
+
+# Clip into the given bounds (when not None), subtract the given mean and divide by the given scale (when not None),
+# in place and in the type of the data (e.g. float32 or float16). The chunks of images are processed by nb_threads
+# threads (the number of CPUs if None).
+def normalize_inplace(data: np.ndarray, mean: float = None, scale: float = None, nb_threads: int = None,
+                      chunk_size: int = CHUNK_SIZE, clip: Tuple[float, float] = None) -> None:
+    if (mean is None and scale is None and clip is None) or data.size == 0:
+        return
+    chunk_starts = range(0, len(data), chunk_size)
+    if not nb_threads:
+        nb_threads = os.cpu_count() or 1
+    nb_threads = min(nb_threads, len(chunk_starts))
+
+    def normalize_chunk(start: int) -> None:
+        chunk = data[start:start+chunk_size]
+        if clip is not None:
+            np.clip(chunk, clip[0], clip[1], out=chunk, casting='unsafe')
+        if mean is not None:
+            np.subtract(chunk, mean, out=chunk, casting='unsafe')
+        if scale is not None:
+            np.divide(chunk, scale, out=chunk, casting='unsafe')
+
+    if nb_threads > 1:
+        with ThreadPoolExecutor(max_workers=nb_threads) as executor:
+            # Raise the exception of a thread, if any.
+            list(executor.map(normalize_chunk, chunk_starts))
+    else:
+        for start in chunk_starts:
+            normalize_chunk(start)
+
+
+def __test_normalize_inplace():
+    data = np.random.default_rng(0).normal(loc=10., scale=2., size=(2500, 4, 4)).astype(np.float32)
+    expected = (data - np.float32(10.)) / np.float32(2.)
+    for nb_threads in (1, 4):
+        normalized_data = data.copy()
+        normalize_inplace(normalized_data, 10., 2., nb_threads, chunk_size=1000)
+        assert normalized_data.dtype == np.float32
+        assert np.array_equal(normalized_data, expected)
+    normalized_data = data.copy()
+    normalize_inplace(normalized_data, None, None)
+    assert np.array_equal(normalized_data, data)
+    normalize_inplace(normalized_data, 10.)
+    assert np.array_equal(normalized_data, data - np.float32(10.))
+    # Like the StandardScaler, the missing values are ignored by the fit and kept by the normalization.
+    data[2, 1, 1] = np.nan
+    statistics = Statistics.compute(data)
+    normalized_data = data.copy()
+    normalize_inplace(normalized_data, statistics.mean, statistics.compute_std(), nb_threads=4, chunk_size=1000)
+    assert np.isnan(normalized_data[2, 1, 1]) and np.count_nonzero(np.isnan(normalized_data)) == 1
+    assert np.isclose(np.nanmean(normalized_data, dtype=np.float64), 0., atol=1e-6)
+    assert np.isclose(np.nanstd(normalized_data, dtype=np.float64), 1., atol=1e-6)
+
+
+def __test_compute_normalization_parameters():
+    data = np.random.default_rng(0).lognormal(mean=0., sigma=1.5, size=(200, 8, 8))
+    statistics = Statistics.compute(data)
+    sketch = QuantileSketch.compute(data)
+    offset, scale, clip = compute_normalization_parameters(NormalizationMode.STANDARD, statistics, sketch)
+    assert np.isclose(offset, data.mean()) and np.isclose(scale, data.std()) and clip is None
+    offset, scale, clip = compute_normalization_parameters(NormalizationMode.ROBUST, statistics, sketch)
+    quartiles = np.quantile(data, [0.25, 0.5, 0.75])
+    assert np.isclose(offset, quartiles[1], rtol=1e-2) and np.isclose(scale, quartiles[2] - quartiles[0], rtol=1e-2)
+    offset, scale, clip = compute_normalization_parameters(NormalizationMode.PERCENTILE_CLIP, statistics, sketch,
+                                                           [5., 95.])
+    normalized_data = data.copy()
+    normalize_inplace(normalized_data, offset, scale, clip=clip)
+    assert normalized_data.min() == 0. and np.isclose(normalized_data.max(), 1.)
+    assert list(compute_summary(sketch, [50.]).keys()) == ['p50']
+
+
+def __all_tests():
+    __test_normalize_inplace()
+    __test_compute_normalization_parameters()
+
+
+if __name__ == '__main__':
+    __all_tests()
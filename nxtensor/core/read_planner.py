@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+from typing import List, Tuple
+
+import numpy as np
+
+from nxtensor.exceptions import ConfigurationError
+
+# Default upper bound of the size of the data read at once, for the bounding box strategy.
+DEFAULT_MAX_SLAB_NBYTES: int = 256 * 1024 * 1024
+
+# The cost of a read, whatever its size (system calls, HDF5 B-tree lookups, etc.), expressed in bytes. The chunk
+# aligned strategy merges the reads of nearby regions when it is cheaper than reading them separately.
+DEFAULT_READ_OVERHEAD_NBYTES: int = 64 * 1024
+
+
+class ReadStrategy:
+
+    # Read the timesteps of a block restricted to the bounding box of all its regions.
+    BOUNDING_BOX  = 'bounding_box'
+    # Read each timestep once, restricted to the bounding box of its regions.
+    TIME_SLICE    = 'time_slice'
+    # Read each chunk of the file once: disjoint chunk aligned boxes or bounding box, whichever is the cheapest.
+    CHUNK_ALIGNED = 'chunk_aligned'
+
+
+class ChunkLayout:
+
+    # The on-disk layout of a variable, restricted to its (time, lat, lon) dimensions.
+    # chunk_nbytes is the size of a decompressed chunk (all the dimensions of the variable, e.g. the level).
+    # Contiguous variables have chunks of one value.
+    def __init__(self, shape: Tuple[int, int, int], chunk_shape: Tuple[int, int, int], chunk_nbytes: int,
+                 is_compressed: bool = False):
+        self.shape: Tuple[int, int, int] = shape
+        self.chunk_shape: Tuple[int, int, int] = chunk_shape
+        self.chunk_nbytes: int = chunk_nbytes
+        self.is_compressed: bool = is_compressed
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(shape={self.shape}, chunk_shape={self.chunk_shape}, " + \
+               f"chunk_nbytes={self.chunk_nbytes}, is_compressed={self.is_compressed})"
+
+
+class SlabRead:
+
+    # A read of the given timesteps (sorted), restricted to the given latitude and longitude positions
+    # (stop excluded), from which the given regions are cut.
+    def __init__(self, time_positions: np.ndarray, lat_start: int, lat_stop: int, lon_start: int, lon_stop: int,
+                 region_indexes: np.ndarray, estimated_nbytes: int):
+        self.time_positions: np.ndarray = time_positions
+        self.lat_start: int = lat_start
+        self.lat_stop: int = lat_stop
+        self.lon_start: int = lon_start
+        self.lon_stop: int = lon_stop
+        self.region_indexes: np.ndarray = region_indexes
+        # The number of decompressed bytes.
+        self.estimated_nbytes: int = estimated_nbytes
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(time={self.time_positions[0]}..{self.time_positions[-1]}, " + \
+               f"lat={self.lat_start}:{self.lat_stop}, lon={self.lon_start}:{self.lon_stop}, " + \
+               f"nb_regions={len(self.region_indexes)}, estimated_nbytes={self.estimated_nbytes})"
+
+
+class ReadPlan:
+
+    def __init__(self, read_strategy: ReadStrategy, chunk_layout: ChunkLayout, reads: List[SlabRead],
+                 naive_estimated_nbytes: int):
+        self.read_strategy: ReadStrategy = read_strategy
+        self.chunk_layout: ChunkLayout = chunk_layout
+        self.reads: List[SlabRead] = reads
+        # The number of decompressed bytes of the plan.
+        self.estimated_nbytes: int = sum([read.estimated_nbytes for read in reads])
+        # The number of decompressed bytes when the regions are read one by one.
+        self.naive_estimated_nbytes: int = naive_estimated_nbytes
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(read_strategy={self.read_strategy}, nb_reads={len(self.reads)}, " + \
+               f"estimated_nbytes={self.estimated_nbytes}, naive_estimated_nbytes={self.naive_estimated_nbytes}, " + \
+               f"chunk_layout={self.chunk_layout})"
+
+
+# Plan the reads of the regions given by their positions (see GridIndex.compute_window_positions).
+# itemsize is the size of a value in memory: it bounds the slabs of the bounding box strategy.
+# The bounding box strategy falls back to the chunk aligned strategy when it reads more than the regions read one by
+# one (e.g. a few regions scattered over the grid).
+def plan_reads(read_strategy: ReadStrategy, time_positions: np.ndarray, lat_positions: np.ndarray,
+               lon_positions: np.ndarray, chunk_layout: ChunkLayout, itemsize: int,
+               max_slab_nbytes: int = DEFAULT_MAX_SLAB_NBYTES,
+               read_overhead_nbytes: int = DEFAULT_READ_OVERHEAD_NBYTES) -> ReadPlan:
+    boxes = __compute_region_boxes(lat_positions, lon_positions, chunk_layout)
+    naive_estimated_nbytes = int(np.sum(__count_chunks(boxes, chunk_layout))) * chunk_layout.chunk_nbytes
+    if read_strategy == ReadStrategy.BOUNDING_BOX:
+        reads = __plan_bounding_box_reads(time_positions, boxes, chunk_layout, itemsize, max_slab_nbytes)
+        if sum([read.estimated_nbytes for read in reads]) > naive_estimated_nbytes:
+            read_strategy = ReadStrategy.CHUNK_ALIGNED
+            reads = __plan_chunk_aligned_reads(time_positions, boxes, chunk_layout, read_overhead_nbytes)
+    elif read_strategy == ReadStrategy.TIME_SLICE:
+        reads = __plan_time_slice_reads(time_positions, boxes, chunk_layout)
+    elif read_strategy == ReadStrategy.CHUNK_ALIGNED:
+        reads = __plan_chunk_aligned_reads(time_positions, boxes, chunk_layout, read_overhead_nbytes)
+    else:
+        msg = f"> [ERROR] unknown read strategy '{read_strategy}'"
+        raise ConfigurationError(msg)
+    return ReadPlan(read_strategy, chunk_layout, reads, naive_estimated_nbytes)
+
+
+# Copy the regions of the given read from its slab (shape: (number of time positions of the read, lat_stop -
+# lat_start, lon_stop - lon_start)) into the result (shape: (N, y, x)), with integer indexing.
+def gather_regions(result: np.ndarray, slab: np.ndarray, read: SlabRead, time_positions: np.ndarray,
+                   lat_positions: np.ndarray, lon_positions: np.ndarray) -> None:
+    # Window positions, relative to the slab.
+    indexes = read.region_indexes
+    slab_time_offsets = np.searchsorted(read.time_positions, time_positions[indexes])
+    lat_offsets = lat_positions[indexes] - read.lat_start
+    lon_offsets = lon_positions[indexes] - read.lon_start
+    result[indexes] = slab[slab_time_offsets[:, np.newaxis, np.newaxis],
+                           lat_offsets[:, :, np.newaxis],
+                           lon_offsets[:, np.newaxis, :]]
+
+
+# Return the positions of the regions (lat_start, lat_stop, lon_start, lon_stop): shape (N, 4).
+# A region wrapped around the longitude edge of the grid covers the whole longitude range.
+def __compute_region_boxes(lat_positions: np.ndarray, lon_positions: np.ndarray, chunk_layout: ChunkLayout) \
+        -> np.ndarray:
+    result = np.empty((len(lat_positions), 4), dtype=np.int64)
+    result[:, 0] = lat_positions.min(axis=1)
+    result[:, 1] = lat_positions.max(axis=1) + 1
+    result[:, 2] = lon_positions.min(axis=1)
+    result[:, 3] = lon_positions.max(axis=1) + 1
+    is_wrapped = (result[:, 3] - result[:, 2]) > lon_positions.shape[1]
+    result[is_wrapped, 2] = 0
+    result[is_wrapped, 3] = chunk_layout.shape[2]
+    return result
+
+
+# Return the number of (lat, lon) chunks touched by the given boxes.
+def __count_chunks(boxes: np.ndarray, chunk_layout: ChunkLayout) -> np.ndarray:
+    _, lat_chunk_size, lon_chunk_size = chunk_layout.chunk_shape
+    return (__chunk_stop(boxes[..., 1], lat_chunk_size) - boxes[..., 0] // lat_chunk_size) * \
+           (__chunk_stop(boxes[..., 3], lon_chunk_size) - boxes[..., 2] // lon_chunk_size)
+
+
+def __chunk_stop(stop, chunk_size: int):
+    return (stop - 1) // chunk_size + 1
+
+
+def __bounding_box(boxes: np.ndarray) -> Tuple[int, int, int, int]:
+    return int(boxes[:, 0].min()), int(boxes[:, 1].max()), int(boxes[:, 2].min()), int(boxes[:, 3].max())
+
+
+# Return the indexes of the regions, grouped by the given keys (ordered by key).
+def __group_by(keys: np.ndarray) -> List[np.ndarray]:
+    order = np.argsort(keys, kind='stable')
+    boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+    return np.split(order, boundaries)
+
+
+# Groups of consecutive timesteps, so as the slab that covers the bounding box of all the regions does not exceed
+# max_slab_nbytes. When the time dimension is chunked, a chunk may be decompressed for each timestep.
+def __plan_bounding_box_reads(time_positions: np.ndarray, boxes: np.ndarray, chunk_layout: ChunkLayout,
+                              itemsize: int, max_slab_nbytes: int) -> List[SlabRead]:
+    lat_start, lat_stop, lon_start, lon_stop = __bounding_box(boxes)
+    timestep_nbytes = (lat_stop - lat_start) * (lon_stop - lon_start) * itemsize
+    nb_timesteps_per_slab = max(1, max_slab_nbytes // timestep_nbytes)
+    unique_time_positions = np.unique(time_positions)
+    result = list()
+    for index in range(0, len(unique_time_positions), nb_timesteps_per_slab):
+        slab_time_positions = unique_time_positions[index:(index + nb_timesteps_per_slab)]
+        region_indexes = np.flatnonzero((time_positions >= slab_time_positions[0]) &
+                                        (time_positions <= slab_time_positions[-1]))
+        slab_box = np.array(__bounding_box(boxes[region_indexes]))
+        estimated_nbytes = len(slab_time_positions) * int(__count_chunks(slab_box, chunk_layout)) * \
+            chunk_layout.chunk_nbytes
+        result.append(SlabRead(slab_time_positions, *(int(value) for value in slab_box), region_indexes,
+                               estimated_nbytes))
+    return result
+
+
+def __plan_time_slice_reads(time_positions: np.ndarray, boxes: np.ndarray, chunk_layout: ChunkLayout) \
+        -> List[SlabRead]:
+    result = list()
+    for region_indexes in __group_by(time_positions):
+        slab_box = np.array(__bounding_box(boxes[region_indexes]))
+        estimated_nbytes = int(__count_chunks(slab_box, chunk_layout)) * chunk_layout.chunk_nbytes
+        result.append(SlabRead(time_positions[region_indexes[:1]], *(int(value) for value in slab_box),
+                               region_indexes, estimated_nbytes))
+    return result
+
+
+# For each time chunk: the chunk aligned boxes of the regions are merged until they are disjoint, so as each chunk
+# is decompressed only once. Then, reading the disjoint boxes is compared to reading their bounding box (cheaper
+# when the boxes are many and close to each other).
+def __plan_chunk_aligned_reads(time_positions: np.ndarray, boxes: np.ndarray, chunk_layout: ChunkLayout,
+                               read_overhead_nbytes: int) -> List[SlabRead]:
+    _, lat_chunk_size, lon_chunk_size = chunk_layout.chunk_shape
+    chunk_boxes = np.empty_like(boxes)
+    chunk_boxes[:, 0] = boxes[:, 0] // lat_chunk_size
+    chunk_boxes[:, 1] = __chunk_stop(boxes[:, 1], lat_chunk_size)
+    chunk_boxes[:, 2] = boxes[:, 2] // lon_chunk_size
+    chunk_boxes[:, 3] = __chunk_stop(boxes[:, 3], lon_chunk_size)
+
+    result = list()
+    for time_chunk_indexes in __group_by(time_positions // chunk_layout.chunk_shape[0]):
+        group_time_positions = time_positions[time_chunk_indexes]
+        # The contiguous range of timesteps: the chunks are decompressed once for all the timesteps.
+        slab_time_positions = np.arange(group_time_positions.min(), group_time_positions.max() + 1)
+        clusters = __merge_overlapping_boxes(chunk_boxes[time_chunk_indexes], time_chunk_indexes)
+        clusters_nbytes = sum([__box_area(cluster_box) for cluster_box, _ in clusters]) * chunk_layout.chunk_nbytes
+        bounding_box = __bounding_box(chunk_boxes[time_chunk_indexes])
+        bounding_box_nbytes = __box_area(bounding_box) * chunk_layout.chunk_nbytes
+        if bounding_box_nbytes + read_overhead_nbytes <= clusters_nbytes + len(clusters) * read_overhead_nbytes:
+            clusters = [(bounding_box, time_chunk_indexes)]
+        for cluster_box, region_indexes in clusters:
+            lat_start = cluster_box[0] * lat_chunk_size
+            lat_stop = min(cluster_box[1] * lat_chunk_size, chunk_layout.shape[1])
+            lon_start = cluster_box[2] * lon_chunk_size
+            lon_stop = min(cluster_box[3] * lon_chunk_size, chunk_layout.shape[2])
+            estimated_nbytes = __box_area(cluster_box) * chunk_layout.chunk_nbytes
+            result.append(SlabRead(slab_time_positions, lat_start, lat_stop, lon_start, lon_stop,
+                                   np.sort(region_indexes), estimated_nbytes))
+    return result
+
+
+def __box_area(box) -> int:
+    return int((box[1] - box[0]) * (box[3] - box[2]))
+
+
+# Merge the boxes (start included, stop excluded) that overlap, until all of them are disjoint.
+# Return the merged boxes and the indexes of the regions they contain.
+def __merge_overlapping_boxes(boxes: np.ndarray, region_indexes: np.ndarray) \
+        -> List[Tuple[List[int], np.ndarray]]:
+    # The regions of a dense block share the same chunk aligned boxes: the distinct boxes only are merged.
+    boxes, box_ids = np.unique(boxes, axis=0, return_inverse=True)
+    box_ids = box_ids.reshape(-1)
+    while True:
+        labels = __label_overlapping_boxes(boxes)
+        nb_clusters = int(labels.max()) + 1
+        if nb_clusters == len(boxes):
+            break
+        # The boxes of a cluster are replaced by their bounding box, which may overlap other bounding boxes.
+        merged_boxes = boxes[np.unique(labels, return_index=True)[1]]
+        for column, reduce in ((0, np.minimum), (1, np.maximum), (2, np.minimum), (3, np.maximum)):
+            reduce.at(merged_boxes[:, column], labels, boxes[:, column])
+        boxes = merged_boxes
+        box_ids = labels[box_ids]
+    return [(boxes[box_id].tolist(), region_indexes[indexes]) for box_id, indexes
+            in zip(np.unique(box_ids), __group_by(box_ids))]
+
+
+# Return the label of the connected component of each box, in the graph of the overlapping boxes: the labels are
+# numbered from 0. The boxes are swept by latitude start, so as each box is only compared with the boxes that start
+# before its latitude stop.
+def __label_overlapping_boxes(boxes: np.ndarray) -> np.ndarray:
+    order = np.argsort(boxes[:, 0], kind='stable')
+    sorted_boxes = boxes[order]
+    parents = np.arange(len(boxes))
+
+    def find(index: int) -> int:
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    lat_stops = np.searchsorted(sorted_boxes[:, 0], sorted_boxes[:, 1], side='left')
+    for position, box in enumerate(sorted_boxes):
+        candidates = sorted_boxes[position + 1:lat_stops[position]]
+        overlaps = np.flatnonzero((candidates[:, 2] < box[3]) & (box[2] < candidates[:, 3])) + position + 1
+        for other_position in overlaps:
+            root, other_root = find(position), find(other_position)
+            if root != other_root:
+                parents[max(root, other_root)] = min(root, other_root)
+    roots = np.array([find(position) for position in range(len(boxes))])
+    result = np.empty(len(boxes), dtype=np.int64)
+    result[order] = np.unique(roots, return_inverse=True)[1].reshape(-1)
+    return result
+
+
+# Return the regions of the given data (shape: (T, lat, lon)) read by the given plan, and the same regions read one
+# by one.
+def __test_read_regions(data: np.ndarray, read_plan: ReadPlan, time_positions: np.ndarray,
+                        lat_positions: np.ndarray, lon_positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    result = np.full((len(time_positions), lat_positions.shape[1], lon_positions.shape[1]), np.nan)
+    for read in read_plan.reads:
+        slab = data[read.time_positions, read.lat_start:read.lat_stop, read.lon_start:read.lon_stop]
+        gather_regions(result, slab, read, time_positions, lat_positions, lon_positions)
+    expected = data[time_positions[:, np.newaxis, np.newaxis], lat_positions[:, :, np.newaxis],
+                    lon_positions[:, np.newaxis, :]]
+    return result, expected
+
+
+def __test_plan_reads():
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(12, 40, 80))
+    nb_regions = 50
+    time_positions = rng.integers(0, 12, nb_regions)
+    lat_positions = rng.integers(0, 40 - 8, nb_regions)[:, np.newaxis] + np.arange(8)
+    lon_positions = rng.integers(0, 80 - 8, nb_regions)[:, np.newaxis] + np.arange(8)
+    # A region wrapped around the longitude edge of the grid.
+    lon_positions[0] = np.mod(np.arange(76, 84), 80)
+    for chunk_shape in ((1, 1, 1), (4, 10, 20)):
+        chunk_layout = ChunkLayout(data.shape, chunk_shape, int(np.prod(chunk_shape)) * data.itemsize)
+        for read_strategy in (ReadStrategy.BOUNDING_BOX, ReadStrategy.TIME_SLICE, ReadStrategy.CHUNK_ALIGNED):
+            read_plan = plan_reads(read_strategy, time_positions, lat_positions, lon_positions, chunk_layout,
+                                   data.itemsize, max_slab_nbytes=4 * 40 * 80 * data.itemsize)
+            result, expected = __test_read_regions(data, read_plan, time_positions, lat_positions, lon_positions)
+            assert np.array_equal(result, expected), (read_strategy, chunk_shape)
+            assert sorted(np.concatenate([read.region_indexes for read in read_plan.reads])) == \
+                list(range(nb_regions))
+            if read_strategy == ReadStrategy.TIME_SLICE:
+                assert len(read_plan.reads) == len(np.unique(time_positions))
+            if read_strategy == ReadStrategy.CHUNK_ALIGNED:
+                # Each chunk is read only once: the reads of a time chunk are disjoint.
+                read_boxes = np.array([[read.time_positions[0] // chunk_shape[0], read.lat_start, read.lat_stop,
+                                        read.lon_start, read.lon_stop] for read in read_plan.reads])
+                for box_index, box in enumerate(read_boxes):
+                    others = read_boxes[box_index + 1:]
+                    assert not np.any((others[:, 0] == box[0]) & (others[:, 1] < box[2]) & (box[1] < others[:, 2]) &
+                                      (others[:, 3] < box[4]) & (box[3] < others[:, 4]))
+        assert plan_reads(ReadStrategy.BOUNDING_BOX, time_positions, lat_positions, lon_positions, chunk_layout,
+                          data.itemsize).estimated_nbytes <= \
+            plan_reads(ReadStrategy.TIME_SLICE, time_positions, lat_positions, lon_positions, chunk_layout,
+                       data.itemsize).estimated_nbytes * chunk_shape[0]
+
+    # A few regions scattered over a contiguous grid: the bounding box strategy falls back to the chunk aligned one.
+    chunk_layout = ChunkLayout(data.shape, (1, 1, 1), data.itemsize)
+    read_plan = plan_reads(ReadStrategy.BOUNDING_BOX, np.array([0, 5]), np.array([np.arange(4), np.arange(30, 34)]),
+                           np.array([np.arange(4), np.arange(70, 74)]), chunk_layout, data.itemsize)
+    assert read_plan.read_strategy == ReadStrategy.CHUNK_ALIGNED
+    assert read_plan.estimated_nbytes == read_plan.naive_estimated_nbytes == 2 * 16 * data.itemsize
+
+
+def __test_merge_overlapping_boxes():
+    boxes = np.array([[0, 2, 0, 2], [1, 3, 1, 3], [7, 8, 7, 8], [0, 2, 0, 2], [2, 4, 2, 6], [3, 6, 0, 3]])
+    clusters = __merge_overlapping_boxes(boxes, np.arange(10, 16))
+    # The bounding box of the first two boxes overlaps the fifth box, then the sixth box.
+    assert sorted((box, sorted(indexes.tolist())) for box, indexes in clusters) == \
+        [([0, 6, 0, 6], [10, 11, 13, 14, 15]), ([7, 8, 7, 8], [12])]
+
+
+def __all_tests():
+    __test_plan_reads()
+    __test_merge_overlapping_boxes()
+
+
+if __name__ == '__main__':
+    __all_tests()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+from typing import Callable, List, Mapping, Sequence, Tuple
+
+import heapq
+
+import numpy as np
+
+from nxtensor.exceptions import ConfigurationError
+from nxtensor.core.types import LabelId, MetaDataBlock, Period
+from nxtensor.utils.coordinates import Coordinate
+
+import nxtensor.utils.naming_utils as nu
+
+# The cost of opening the source files of a task, expressed in number of rows: the opening of a NetCDF file
+# (metadata, coordinates and grid index) costs about as much as the extraction of this number of regions.
+DEFAULT_FILE_COST: float = 50.
+
+# A task is a period with the blocks of some or all of its labels.
+Task = Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]
+
+
+class SchedulingPolicy:
+
+    CHRONOLOGICAL  = 'chronological'   # The tasks are dispatched in the order of the periods.
+    HEAVIEST_FIRST = 'heaviest_first'  # The tasks are dispatched from the heaviest to the lightest.
+    # Like heaviest_first, but the periods that are heavier than a fair share of a worker are split by label.
+    SPLIT          = 'split'
+
+
+class Schedule:
+
+    # The tasks are in order of dispatch. predicted_worker_costs are the costs handled by each worker, assuming that
+    # a task is dispatched to the first idle worker (like Pool.map with a chunksize of 1).
+    def __init__(self, policy: SchedulingPolicy, tasks: List[Task], costs: List[float], nb_workers: int):
+        self.policy: SchedulingPolicy = policy
+        self.tasks: List[Task] = tasks
+        self.costs: List[float] = costs
+        self.nb_workers: int = nb_workers
+        self.predicted_worker_costs: List[float] = simulate_dispatch(costs, nb_workers)
+
+    def __repr__(self) -> str:
+        return f"Schedule(policy={self.policy}, nb_tasks={len(self.tasks)}, nb_workers={self.nb_workers})"
+
+
+# Estimate the cost of a task from its number of rows and the number of source files opened for its period:
+# every source file is opened once and read for every row.
+def estimate_cost(extraction_metadata_blocks: Sequence[Tuple[LabelId, MetaDataBlock]], nb_files: int,
+                  file_cost: float = DEFAULT_FILE_COST) -> float:
+    nb_rows = sum(len(extraction_metadata_block) for _, extraction_metadata_block in extraction_metadata_blocks)
+    return nb_files * (file_cost + nb_rows)
+
+
+def schedule(tasks: Sequence[Task], nb_workers: int, count_files: Callable[[Period], int],
+             policy: SchedulingPolicy = SchedulingPolicy.HEAVIEST_FIRST,
+             file_cost: float = DEFAULT_FILE_COST) -> Schedule:
+    if policy == SchedulingPolicy.CHRONOLOGICAL or policy == SchedulingPolicy.HEAVIEST_FIRST:
+        scheduled_tasks = list(tasks)
+    elif policy == SchedulingPolicy.SPLIT:
+        scheduled_tasks = __split_tasks(tasks, nb_workers, count_files, file_cost)
+    else:
+        msg = f"> [ERROR] unknown scheduling policy '{policy}'"
+        raise ConfigurationError(msg)
+
+    costs = [estimate_cost(blocks, count_files(period), file_cost) for period, blocks in scheduled_tasks]
+    if policy != SchedulingPolicy.CHRONOLOGICAL:
+        # Longest processing time first: the heaviest tasks start first, the lightest ones fill the gaps.
+        # Python sort is stable: the tasks of same cost stay in chronological order.
+        order = sorted(range(len(scheduled_tasks)), key=lambda index: -costs[index])
+        scheduled_tasks = [scheduled_tasks[index] for index in order]
+        costs = [costs[index] for index in order]
+    return Schedule(policy, scheduled_tasks, costs, nb_workers)
+
+
+# Return the costs handled by each worker when the given tasks are dispatched in order to the first idle worker.
+def simulate_dispatch(costs: Sequence[float], nb_workers: int) -> List[float]:
+    worker_costs = [(0., worker_index) for worker_index in range(nb_workers)]
+    for cost in costs:
+        worker_cost, worker_index = heapq.heappop(worker_costs)
+        heapq.heappush(worker_costs, (worker_cost + cost, worker_index))
+    return [worker_cost for worker_cost, _ in sorted(worker_costs, key=lambda item: item[1])]
+
+
+# The balance is the mean load divided by the maximum load: 1 means that all the workers finish at the same time.
+def compute_balance(worker_loads: Sequence[float]) -> float:
+    max_load = max(worker_loads, default=0.)
+    if max_load == 0.:
+        return 1.
+    return (sum(worker_loads) / len(worker_loads)) / max_load
+
+
+def format_load_report(title: str, worker_loads: Mapping[any, float], unit: str = '') -> str:
+    lines = [f"> {title} (balance: {compute_balance(list(worker_loads.values()))*100:.1f}%):"]
+    for worker, load in worker_loads.items():
+        lines.append(f"  - worker {worker}: {load:.2f}{unit}")
+    return '\n'.join(lines)
+
+
+# A period heavier than a fair share of a worker is split into a task per label: the blocks of different labels
+# are written in different files, so the tasks are independent.
+def __split_tasks(tasks: Sequence[Task], nb_workers: int, count_files: Callable[[Period], int],
+                  file_cost: float) -> List[Task]:
+    costs = [estimate_cost(blocks, count_files(period), file_cost) for period, blocks in tasks]
+    fair_share = sum(costs) / max(nb_workers, 1)
+    result: List[Task] = list()
+    for (period, blocks), cost in zip(tasks, costs):
+        if cost > fair_share and len(blocks) > 1:
+            result.extend([(period, [block]) for block in blocks])
+        else:
+            result.append((period, blocks))
+    return result
+
+
+def __test_schedule():
+    def create_block(nb_rows: int) -> MetaDataBlock:
+        # noinspection PyTypeChecker
+        return np.zeros(nb_rows, dtype=[(Coordinate.LAT, np.float64), (Coordinate.LON, np.float64)])
+
+    tasks = [((2000, 1), [('cyclone', create_block(10)), ('no_cyclone', create_block(10))]),
+             ((2000, 8), [('cyclone', create_block(500)), ('no_cyclone', create_block(500))]),
+             ((2000, 9), [('cyclone', create_block(300)), ('no_cyclone', create_block(20))])]
+    chronological = schedule(tasks, 2, lambda period: 1, SchedulingPolicy.CHRONOLOGICAL, 0.)
+    assert [task[0] for task in chronological.tasks] == [(2000, 1), (2000, 8), (2000, 9)]
+    assert chronological.predicted_worker_costs == [340., 1000.]
+
+    heaviest_first = schedule(tasks, 2, lambda period: 1, SchedulingPolicy.HEAVIEST_FIRST, 0.)
+    assert [task[0] for task in heaviest_first.tasks] == [(2000, 8), (2000, 9), (2000, 1)]
+    assert heaviest_first.predicted_worker_costs == [1000., 340.]
+
+    split = schedule(tasks, 2, lambda period: 1, SchedulingPolicy.SPLIT, 0.)
+    assert len(split.tasks) == 4
+    assert split.predicted_worker_costs == [820., 520.]
+    assert compute_balance(split.predicted_worker_costs) > compute_balance(heaviest_first.predicted_worker_costs)
+    print(format_load_report('predicted load', dict(enumerate(split.predicted_worker_costs))))
+    print(nu.list_to_string([nu.create_period_str(task[0]) for task in split.tasks]))
+
+
+def __all_tests():
+    __test_schedule()
+
+
+if __name__ == '__main__':
+    __all_tests()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 09:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+from functools import reduce
+from typing import Dict, Iterable, Mapping, Tuple
+
+import numpy as np
+
+from nxtensor.utils.tensor_dimensions import TensorDimension
+
+# Number of images processed at once when computing the statistics, so as to bound the memory of the float64
+# temporary arrays.
+BATCH_SIZE: int = 1024
+
+COUNT: str = 'count'
+M2: str = 'm2'  # The sum of the squared deviations from the mean.
+
+FIELDS = (COUNT, TensorDimension.MEAN, M2, TensorDimension.MIN, TensorDimension.MAX)
+
+
+# Return the finite values of the given data (flattened), or the data itself if all its values are finite.
+def select_finite_values(data: np.ndarray) -> np.ndarray:
+    is_finite = np.isfinite(data)
+    return data if is_finite.all() else data[is_finite]
+
+
+# The statistics of a set of values (e.g. the pixels of a block), accumulated in float64. The statistics of two sets
+# are merged without their values (Chan et al. pairwise update of the mean and M2), so as the statistics of a
+# channel are computed from the statistics of its blocks.
+class Statistics:
+
+    def __init__(self, count: int = 0, mean: float = 0., m2: float = 0., min: float = np.inf, max: float = -np.inf):
+        self.count: int = count
+        self.mean: float = mean
+        self.m2: float = m2
+        self.min: float = min
+        self.max: float = max
+
+    # Return the statistics of the given data, computed by batches of images (two-pass mean and M2). Like the
+    # StandardScaler, the missing values (NaN) are ignored: only the finite values are counted.
+    @staticmethod
+    def compute(data: np.ndarray) -> 'Statistics':
+        count = 0
+        total = 0.
+        data_min = np.inf
+        data_max = -np.inf
+        for index in range(0, len(data), BATCH_SIZE):
+            values = select_finite_values(data[index:index+BATCH_SIZE])
+            if values.size == 0:
+                continue
+            count += values.size
+            total += float(np.sum(values, dtype=np.float64))
+            # Cast into 64 bits otherwise the value is trunked.
+            data_min = min(data_min, float(values.min()))
+            data_max = max(data_max, float(values.max()))
+        if count == 0:
+            return Statistics()
+        mean = total / count
+        m2 = 0.
+        for index in range(0, len(data), BATCH_SIZE):
+            centered_values = select_finite_values(data[index:index+BATCH_SIZE]).astype(np.float64).ravel()
+            centered_values -= mean
+            m2 += float(np.dot(centered_values, centered_values))
+        return Statistics(count, mean, m2, data_min, data_max)
+
+    # Return the statistics of the union of the values of the two statistics.
+    def merge(self, other: 'Statistics') -> 'Statistics':
+        count = self.count + other.count
+        if count == 0:
+            return Statistics()
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / count
+        m2 = self.m2 + other.m2 + delta * delta * self.count * other.count / count
+        return Statistics(count, mean, m2, min(self.min, other.min), max(self.max, other.max))
+
+    # The population standard deviation (like the StandardScaler).
+    def compute_std(self) -> float:
+        return float(np.sqrt(self.m2 / self.count)) if self.count else 0.
+
+    # See from_mapping (e.g. the attributes of a HDF5 dataset).
+    def to_mapping(self) -> Dict[str, float]:
+        return {COUNT: self.count, TensorDimension.MEAN: self.mean, M2: self.m2, TensorDimension.MIN: self.min,
+                TensorDimension.MAX: self.max}
+
+    # Return None if the mapping doesn't have the statistics (e.g. blocks extracted by a previous version).
+    @staticmethod
+    def from_mapping(mapping: Mapping[str, any]) -> 'Statistics':
+        if not all(field in mapping for field in FIELDS):
+            return None
+        return Statistics(int(mapping[COUNT]), float(mapping[TensorDimension.MEAN]), float(mapping[M2]),
+                          float(mapping[TensorDimension.MIN]), float(mapping[TensorDimension.MAX]))
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(count={self.count}, mean={self.mean}, m2={self.m2}, min={self.min}, " \
+               f"max={self.max})"
+
+
+# Return the merge of the given statistics.
+def merge_statistics(statistics: Iterable[Statistics]) -> Statistics:
+    return reduce(Statistics.merge, statistics, Statistics())
+
+
+SKETCH_MEANS: str = 'sketch_means'
+SKETCH_WEIGHTS: str = 'sketch_weights'
+SKETCH_MIN: str = 'sketch_min'
+SKETCH_MAX: str = 'sketch_max'
+
+SKETCH_FIELDS = (SKETCH_MEANS, SKETCH_WEIGHTS, SKETCH_MIN, SKETCH_MAX)
+
+# The compression of the quantile sketches: the number of centroids is about the half of it.
+SKETCH_COMPRESSION: int = 400
+
+
+# A quantile sketch of a set of values (a t-digest): the values are summarized by weighted centroids, which are
+# smaller at the tails so as the extreme quantiles (e.g. the 1st and the 99th percentiles) stay accurate. The sketches
+# of two sets are merged without their values, so as the quantiles of a channel are computed from the sketches of its
+# blocks, without sorting the channel.
+class QuantileSketch:
+
+    def __init__(self, means: np.ndarray = None, weights: np.ndarray = None, min: float = np.inf,
+                 max: float = -np.inf):
+        self.means: np.ndarray = means if means is not None else np.empty(0, dtype=np.float64)
+        self.weights: np.ndarray = weights if weights is not None else np.empty(0, dtype=np.float64)
+        self.min: float = min
+        self.max: float = max
+
+    # Return the sketch of the given data, computed by batches of images: only a batch is sorted at once. The missing
+    # values (NaN) are ignored (see Statistics.compute).
+    @staticmethod
+    def compute(data: np.ndarray, compression: int = SKETCH_COMPRESSION) -> 'QuantileSketch':
+        result = QuantileSketch()
+        for index in range(0, len(data), BATCH_SIZE):
+            values = np.sort(select_finite_values(data[index:index+BATCH_SIZE]), axis=None).astype(np.float64)
+            if values.size > 0:
+                batch_sketch = QuantileSketch(values, np.ones(values.size), float(values[0]), float(values[-1]))
+                result = result.merge(batch_sketch, compression)
+        return result
+
+    # Return the sketch of the union of the values of the two sketches.
+    def merge(self, other: 'QuantileSketch', compression: int = SKETCH_COMPRESSION) -> 'QuantileSketch':
+        means = np.concatenate((self.means, other.means))
+        weights = np.concatenate((self.weights, other.weights))
+        order = np.argsort(means, kind='stable')
+        means, weights = QuantileSketch.__compress(means[order], weights[order], compression)
+        return QuantileSketch(means, weights, min(self.min, other.min), max(self.max, other.max))
+
+    # Return the quantiles (from 0 to 1) of the values, interpolated between the centroids.
+    def compute_quantiles(self, quantiles: Iterable[float]) -> np.ndarray:
+        quantiles = np.asarray(quantiles, dtype=np.float64)
+        total_weight = self.weights.sum()
+        if total_weight == 0:
+            return np.full(quantiles.shape, np.nan)
+        centroid_quantiles = (np.cumsum(self.weights) - self.weights / 2) / total_weight
+        return np.interp(quantiles, np.concatenate(([0.], centroid_quantiles, [1.])),
+                         np.concatenate(([self.min], self.means, [self.max])))
+
+    # See from_mapping (e.g. the attributes of a HDF5 dataset).
+    def to_mapping(self) -> Dict[str, any]:
+        return {SKETCH_MEANS: self.means, SKETCH_WEIGHTS: self.weights, SKETCH_MIN: self.min, SKETCH_MAX: self.max}
+
+    # Return None if the mapping doesn't have the sketch (e.g. blocks extracted by a previous version).
+    @staticmethod
+    def from_mapping(mapping: Mapping[str, any]) -> 'QuantileSketch':
+        if not all(field in mapping for field in SKETCH_FIELDS):
+            return None
+        return QuantileSketch(np.asarray(mapping[SKETCH_MEANS], dtype=np.float64),
+                              np.asarray(mapping[SKETCH_WEIGHTS], dtype=np.float64),
+                              float(mapping[SKETCH_MIN]), float(mapping[SKETCH_MAX]))
+
+    # Merge the given sorted centroids into the centroids of equal width in the space of the t-digest scale function
+    # k(q) = compression / (2 pi) * arcsin(2q - 1), q being the quantile of the middle of a centroid.
+    @staticmethod
+    def __compress(means: np.ndarray, weights: np.ndarray, compression: int) -> Tuple[np.ndarray, np.ndarray]:
+        if means.size == 0:
+            return means, weights
+        cumulative_weights = np.cumsum(weights)
+        quantiles = (cumulative_weights - weights / 2) / cumulative_weights[-1]
+        scales = compression / (2 * np.pi) * np.arcsin(2 * quantiles - 1)
+        buckets = np.floor(scales).astype(np.int64)
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        merged_weights = np.add.reduceat(weights, starts)
+        merged_means = np.add.reduceat(means * weights, starts) / merged_weights
+        return merged_means, merged_weights
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(nb_centroids={len(self.means)}, weight={self.weights.sum()}, " \
+               f"min={self.min}, max={self.max})"
+
+
+# Return the merge of the given sketches.
+def merge_quantile_sketches(sketches: Iterable[QuantileSketch]) -> QuantileSketch:
+    return reduce(QuantileSketch.merge, sketches, QuantileSketch())
+
+
+def __test_merge_statistics():
+    data = np.random.default_rng(0).normal(loc=1000., scale=3., size=(100, 8, 8)).astype(np.float32)
+    expected = Statistics.compute(data)
+    merged = merge_statistics(Statistics.compute(data[start:start+13]) for start in range(0, len(data), 13))
+    assert merged.count == data.size
+    assert np.isclose(merged.mean, data.mean(dtype=np.float64)) and np.isclose(merged.mean, expected.mean)
+    assert np.isclose(merged.compute_std(), data.std(dtype=np.float64))
+    assert merged.min == float(data.min()) and merged.max == float(data.max())
+    assert merge_statistics([]).count == 0
+    assert Statistics.from_mapping(merged.to_mapping()).m2 == merged.m2
+    assert Statistics.from_mapping({COUNT: 1}) is None
+    # The missing values are ignored.
+    data_with_nan = data.copy()
+    data_with_nan[3, 2, 1] = np.nan
+    finite_values = data_with_nan[np.isfinite(data_with_nan)]
+    merged = merge_statistics(Statistics.compute(data_with_nan[start:start+13])
+                              for start in range(0, len(data), 13))
+    assert merged.count == data.size - 1
+    assert np.isclose(merged.mean, finite_values.mean(dtype=np.float64))
+    assert np.isclose(merged.compute_std(), finite_values.std(dtype=np.float64))
+    assert merged.min == float(finite_values.min()) and merged.max == float(finite_values.max())
+    statistics = Statistics.compute(np.array([[1., np.nan]]))
+    assert (statistics.count, statistics.mean, statistics.m2, statistics.min, statistics.max) == (1, 1., 0., 1., 1.)
+    assert Statistics.compute(np.full((2, 2), np.nan)).count == 0
+
+
+def __test_merge_quantile_sketches():
+    data = np.random.default_rng(0).lognormal(mean=0., sigma=1.5, size=(300, 16, 16))
+    quantiles = [0.01, 0.25, 0.5, 0.75, 0.99]
+    expected = np.quantile(data, quantiles)
+    sketch = merge_quantile_sketches(QuantileSketch.compute(data[start:start+7]) for start in range(0, len(data), 7))
+    assert sketch.weights.sum() == data.size and len(sketch.means) <= SKETCH_COMPRESSION
+    assert sketch.min == data.min() and sketch.max == data.max()
+    ranks = np.searchsorted(np.sort(data, axis=None), sketch.compute_quantiles(quantiles)) / data.size
+    assert np.all(np.abs(ranks - quantiles) < 0.005), (ranks, expected)
+    assert np.all(np.isnan(QuantileSketch().compute_quantiles([0.5])))
+    mapping = sketch.to_mapping()
+    assert np.array_equal(QuantileSketch.from_mapping(mapping).compute_quantiles(quantiles),
+                          sketch.compute_quantiles(quantiles))
+    assert QuantileSketch.from_mapping({SKETCH_MIN: 0.}) is None
+    # The missing values are ignored.
+    data[5, 3, 2] = np.nan
+    finite_values = np.sort(data[np.isfinite(data)])
+    sketch = merge_quantile_sketches(QuantileSketch.compute(data[start:start+7]) for start in range(0, len(data), 7))
+    assert sketch.weights.sum() == finite_values.size
+    assert sketch.min == finite_values[0] and sketch.max == finite_values[-1]
+    ranks = np.searchsorted(finite_values, sketch.compute_quantiles(quantiles)) / finite_values.size
+    assert np.all(np.abs(ranks - quantiles) < 0.005), ranks
+    sketch = QuantileSketch.compute(np.array([[1., np.nan]]))
+    assert sketch.weights.sum() == 1. and sketch.min == sketch.max == 1.
+    assert np.all(np.isnan(QuantileSketch.compute(np.full((2, 2), np.nan)).compute_quantiles([0.5])))
+
+
+def __all_tests():
+    __test_merge_statistics()
+    __test_merge_quantile_sketches()
+
+
+if __name__ == '__main__':
+    __all_tests()
@@ -6,18 +6,20 @@ Created on Fri Jun 5 10:00:00 2020
 @author: sebastien@gardoll.fr
 """
 
-from typing import NewType, Sequence, Mapping, Union, Tuple, Dict
+from typing import NewType, Union, Tuple, Dict, Callable
+
+import numpy as np
+import xarray as xr
 
 from nxtensor.utils.coordinates import Coordinate
-from nxtensor.utils.tensor_dimensions import TensorDimension
 from nxtensor.utils.time_resolutions import TimeResolution
 
 VariableId = str
 LabelId = str
 
-# A block of extraction metadata (lat, lon, year, month, etc.).
-MetaDataBlock = NewType('MetaDataBlock', Sequence[Mapping[Union[TimeResolution, Coordinate, TensorDimension],
-                                                          Union[int, float, str]]])
+# A block of extraction metadata: a NumPy structured array with one field per column (lat, lon, year, month, etc.)
+# and one element per row (see metadata_block).
+MetaDataBlock = NewType('MetaDataBlock', np.ndarray)
 
 
 # A Period is a tuple composed of values that correspond to the values of
@@ -26,3 +28,7 @@ Period = NewType('Period', Tuple[Union[float, int], ...])
 
 
 DBMetadataMapping = Dict[Union[Coordinate, TimeResolution], str]
+
+
+# Function called on each extracted data block, as soon as it is extracted (label id, data block, metadata block).
+BlockHandler = Callable[[LabelId, xr.DataArray, MetaDataBlock], None]
@@ -7,7 +7,7 @@ Created on Wed Apr  22 09:20:10 2020
 """
 
 from abc import abstractmethod, ABC
-from typing import Dict, Set, Tuple, Mapping, Sequence, List
+from typing import Callable, Dict, Iterable, Set, Tuple, Mapping, Sequence, List
 
 import pandas as pd
 import xarray as xr
@@ -20,6 +20,8 @@ from nxtensor.utils.tensor_dimensions import TensorDimension
 from nxtensor.utils.time_resolutions import TimeResolution
 from nxtensor.utils.db_utils import create_db_metadata_mapping
 from nxtensor.utils.csv_option_names import CsvOptName
+from nxtensor.utils.block_formats import BlockFormat
+from nxtensor.utils.hdf5_option_names import Hdf5OptName
 
 from multiprocessing import Pool
 import os.path as path
@@ -29,18 +31,26 @@ import nxtensor.utils.time_utils as tu
 import nxtensor.utils.naming_utils as nu
 import nxtensor.utils.csv_utils as cu
 import nxtensor.utils.db_utils as du
+import nxtensor.utils.file_utils as fu
 
 import pickle
+import shutil
 
 import time
 
-from nxtensor.core.types import VariableId, LabelId, MetaDataBlock, Period, DBMetadataMapping
+from nxtensor.core.types import VariableId, LabelId, MetaDataBlock, Period, DBMetadataMapping, BlockHandler
+from nxtensor.core.scheduling import SchedulingPolicy
+from nxtensor.core.extraction_manifest import ManifestWriter, ManifestField, compute_checksum, load_manifest, \
+    is_valid_entry, is_in_dir, compute_rows_checksum
+from nxtensor.utils.progress import ProgressMeter
+import nxtensor.core.metadata_block as mdb
+from nxtensor.core.statistics import Statistics, QuantileSketch
+import nxtensor.core.scheduling as scheduling
 
 import numpy as np
 
 INDEX_NAME = 'index'
 
-
 METADATA_TYPES = {TimeResolution.DAY: np.int8, TimeResolution.DAY2D: np.str,
                   TimeResolution.HOUR: np.int8, TimeResolution.HOUR2D: np.str,
                   TimeResolution.MONTH: np.int8, TimeResolution.MONTH2D: np.str,
@@ -51,19 +61,22 @@ METADATA_TYPES = {TimeResolution.DAY: np.int8, TimeResolution.DAY2D: np.str,
 
 class BlockProcessor(ABC):
 
+    # When the block handler is given, the blocks are handed over to it as soon as they are extracted, instead of
+    # being returned.
     @abstractmethod
-    def process_blocks(self, period: Period, extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]]) \
+    def process_blocks(self, period: Period, extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]],
+                       block_handler: BlockHandler = None) \
             -> Tuple[str, List[Tuple[LabelId, xr.DataArray, MetaDataBlock]]]:
         pass
 
+    # Return the path of the parent directory of the blocks.
+    @abstractmethod
+    def get_blocks_dir_path(self) -> str:
+        pass
 
-def convert_block_to_dict(extraction_metadata_block: pd.DataFrame) -> MetaDataBlock:
-    result = extraction_metadata_block.to_dict('records')
-    for dictionary in result:
-        dictionary[TimeResolution.MONTH2D] = f"{int(dictionary[TimeResolution.MONTH]):02d}"
-        dictionary[TimeResolution.DAY2D] = f"{int(dictionary[TimeResolution.DAY]):02d}"
-        dictionary[TimeResolution.HOUR2D] = f"{int(dictionary[TimeResolution.HOUR]):02d}"
-    return result
+    # Return the number of source files opened for the given period (see scheduling.estimate_cost).
+    def count_source_files(self, period: Period) -> int:
+        return 1
 
 
 def preprocess_extraction(preprocessing_output_file_path: str,
@@ -85,22 +98,123 @@ def preprocess_extraction(preprocessing_output_file_path: str,
     merged_structures: List[Tuple[Period, List[Tuple[LabelId, MetaDataBlock]]]] = __merge_block_structures(structures)
     del structures
 
-    os.makedirs(path.dirname(preprocessing_output_file_path), exist_ok=True)
+    # Each block is saved in its own memory-mappable file and the preprocessing file is only an index of block
+    # references: the extraction processes load the rows of the blocks they process, nothing else.
+    blocks_dir_path = __create_preprocessing_blocks_dir(preprocessing_output_file_path)
+    try:
+        index: List[Tuple[Period, List[Tuple[LabelId, mdb.LazyMetaDataBlock]]]] = list()
+        for period, extraction_metadata_blocks in merged_structures:
+            references = [(label_id, mdb.save_metadata_block(extraction_metadata_block,
+                           nu.compute_preprocessing_block_file_path(preprocessing_output_file_path, period, label_id)))
+                          for label_id, extraction_metadata_block in extraction_metadata_blocks]
+            index.append((period, references))
+    except Exception as e:
+        msg = f'> [ERROR] unable to persist extraction preprocessing blocks in {blocks_dir_path}'
+        raise Exception(msg, e)
+    __save_preprocessing_index(preprocessing_output_file_path, index)
+
+
+# Same as preprocess_extraction, for label dbs larger than the memory: each db is read by chunks (see
+# db_utils.get_dataframe_chunks_load_function) and the rows of the chunks are appended to a shard file per period
+# on disk. The dbs are processed in parallel, one per worker process.
+# The chunk iterators are functions without parameters (e.g. functools.partial of db_utils.iterate_csv_file) that
+# return an iterator over the chunks of a db. They must be picklable when nb_workers is greater than 1.
+def preprocess_extraction_by_chunks(preprocessing_output_file_path: str,
+                                    db_chunk_iterators: Mapping[LabelId, Callable[[], Iterable[pd.DataFrame]]],
+                                    db_metadata_mappings: Mapping[LabelId, DBMetadataMapping],
+                                    netcdf_file_time_period: TimeResolution,
+                                    label_num_ids: Mapping[str, float],
+                                    nb_workers: int = 1) -> None:
+    blocks_dir_path = __create_preprocessing_blocks_dir(preprocessing_output_file_path)
+    parameters_list = [(preprocessing_output_file_path, label_id, db_chunk_iterator, db_metadata_mappings[label_id],
+                        netcdf_file_time_period, label_num_ids[label_id])
+                       for label_id, db_chunk_iterator in db_chunk_iterators.items()]
+    try:
+        if nb_workers is not None and nb_workers > 1 and len(parameters_list) > 1:
+            with Pool(processes=min(nb_workers, len(parameters_list))) as pool:
+                label_structures = pool.starmap(func=__shard_label_db, iterable=parameters_list, chunksize=1)
+        else:
+            label_structures = [__shard_label_db(*parameters) for parameters in parameters_list]
+    except Exception as e:
+        msg = f'> [ERROR] unable to persist extraction preprocessing blocks in {blocks_dir_path}'
+        raise Exception(msg, e)
+    structures = {label_id: structure for label_id, structure in label_structures}
+    __save_preprocessing_index(preprocessing_output_file_path, __merge_block_structures(structures))
+
+
+# Read the given db by chunks and return the references to its blocks, per period. The memory is bounded by a chunk.
+def __shard_label_db(preprocessing_output_file_path: str, label_id: LabelId,
+                     db_chunk_iterator: Callable[[], Iterable[pd.DataFrame]], db_metadata_mapping: DBMetadataMapping,
+                     netcdf_file_time_period: TimeResolution, label_num_id: float) \
+        -> Tuple[LabelId, Dict[Period, mdb.MetaDataBlockReference]]:
+    period_keys = __compute_period_keys(netcdf_file_time_period)
+    reverse_metadata_mapping = {v: k for k, v in db_metadata_mapping.items()}
+    selected_columns = list(db_metadata_mapping.keys())
+    selected_columns.append(TensorDimension.LABEL_NUM_ID)
+    nb_rows: Dict[Period, int] = dict()
+    dtype = None
+    for chunk in db_chunk_iterator():
+        if len(chunk) == 0:
+            continue
+        chunk = chunk.rename(reverse_metadata_mapping, axis='columns')
+        chunk[TensorDimension.LABEL_NUM_ID] = label_num_id
+        chunk = chunk[selected_columns]
+        metadata_block = mdb.create_metadata_block(chunk)
+        if dtype is None:
+            dtype = mdb.create_shard_dtype(metadata_block.dtype)
+        metadata_block = metadata_block.astype(dtype)
+        # Same order as __build_blocks_structure: the order of the rows of the db, period by period.
+        for key, positions in chunk.groupby(period_keys, sort=False).indices.items():
+            period = tuple(int(value) for value in (key if isinstance(key, tuple) else (key,)))
+            block_file_path = nu.compute_preprocessing_block_file_path(preprocessing_output_file_path, period,
+                                                                       label_id)
+            mdb.append_to_shard(metadata_block[positions], f'{block_file_path}.part')
+            nb_rows[period] = nb_rows.get(period, 0) + len(positions)
+        del chunk, metadata_block
+    result: Dict[Period, mdb.MetaDataBlockReference] = dict()
+    for period, period_nb_rows in nb_rows.items():
+        block_file_path = nu.compute_preprocessing_block_file_path(preprocessing_output_file_path, period, label_id)
+        result[period] = mdb.save_shard(f'{block_file_path}.part', dtype, period_nb_rows, block_file_path)
+    return label_id, result
+
+
+# Create the directory of the blocks of the given preprocessing, without the blocks of a previous preprocessing.
+def __create_preprocessing_blocks_dir(preprocessing_output_file_path: str) -> str:
+    blocks_dir_path = nu.compute_preprocessing_blocks_dir_path(preprocessing_output_file_path)
+    shutil.rmtree(blocks_dir_path, ignore_errors=True)
+    os.makedirs(blocks_dir_path, exist_ok=True)
+    return blocks_dir_path
+
+
+def __save_preprocessing_index(preprocessing_output_file_path: str,
+                               index: List[Tuple[Period, List[Tuple[LabelId, mdb.LazyMetaDataBlock]]]]) -> None:
     try:
         with open(preprocessing_output_file_path, 'wb') as file:
-            pickle.dump(obj=merged_structures, file=file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(obj=index, file=file, protocol=pickle.HIGHEST_PROTOCOL)
     except Exception as e:
         msg = f'> [ERROR] unable to persist extraction preprocessing in {preprocessing_output_file_path}'
         raise Exception(msg, e)
 
 
+# When has_to_resume is true, the blocks completed by a previous call from the same rows are skipped (see the
+# manifest) and the blocks that no longer exist in the preprocessing structure are removed.
+# When is_incremental is true, the preprocessing structure is compared with the blocks of the previous extraction:
+# only the new and the changed rows are extracted, the new rows are merged into the existing blocks and the blocks
+# that no longer exist are removed.
 def extract(variable_id: str,
             preprocess_input_file_path: str,
             block_processor: BlockProcessor,
             extraction_metadata_block_csv_save_options: Mapping[CsvOptName, any] = None,
-            nb_workers: int = 1) -> Dict[Period, Dict[str, Dict[str, str]]]:
+            nb_workers: int = 1, dtype: str = None,
+            scheduling_policy: SchedulingPolicy = SchedulingPolicy.HEAVIEST_FIRST,
+            has_to_resume: bool = True, is_incremental: bool = False,
+            block_format: BlockFormat = BlockFormat.CSV,
+            hdf5_options: Mapping[Hdf5OptName, any] = None) \
+        -> Dict[Period, Dict[str, Dict[str, str]]]:
 
     # Returns the extraction data and extraction metadata blocks file paths.
+    # Only the index of the blocks is loaded: the blocks are loaded by the processes that extract them (see
+    # preprocess_extraction).
     try:
         with open(preprocess_input_file_path, 'rb') as file:
             merged_structures = pickle.load(file=file)
@@ -108,57 +222,268 @@ def extract(variable_id: str,
         msg = f'unable to load extraction preprocessing located at {preprocess_input_file_path}'
         raise Exception(msg, e)
 
+    # The manifest of a previous extraction is the completion journal of the blocks: the complete and valid blocks
+    # are not extracted again.
+    result: Dict[Period, Dict[str, Dict[str, str]]] = dict()
+    blocks_dir_path = block_processor.get_blocks_dir_path()
+    manifest_file_path = nu.compute_manifest_file_path(variable_id, blocks_dir_path)
+    completed_entries = list()
+    # The blocks that receive new rows (incremental mode), mapped with their complete metadata.
+    appended_blocks: Dict[Tuple[Period, LabelId], mdb.LazyMetaDataBlock] = dict()
+    if is_incremental:
+        merged_structures, completed_entries, appended_blocks, stale_entries = \
+            __plan_incremental_extraction(merged_structures, manifest_file_path, blocks_dir_path)
+        __remove_stale_blocks(stale_entries, blocks_dir_path)
+        print(f"> variable {variable_id} incremental extraction: {len(completed_entries)} unchanged block(s), "
+              f"{len(appended_blocks)} appended block(s), {len(stale_entries)} removed block(s)")
+    elif has_to_resume:
+        merged_structures, completed_entries, stale_entries = \
+            __filter_completed_blocks(merged_structures, manifest_file_path, blocks_dir_path)
+        # The blocks that no longer exist in the preprocessing structure are not assembled.
+        __remove_stale_blocks(stale_entries, blocks_dir_path)
+        for entry in completed_entries:
+            period = tu.create_period(entry[ManifestField.PERIOD])
+            result.setdefault(period, dict())[entry[ManifestField.LABEL_ID]] = \
+                {'data_block': entry[ManifestField.DATA_BLOCK], 'metadata_block': entry[ManifestField.METADATA_BLOCK]}
+        if completed_entries:
+            print(f"> variable {variable_id} resuming the extraction: {len(completed_entries)} block(s) already "
+                  f"complete, {len(stale_entries)} removed block(s)")
+
+    if not nb_workers:
+        nb_workers = 1
+    extraction_schedule = scheduling.schedule(merged_structures, nb_workers, block_processor.count_source_files,
+                                              scheduling_policy)
+    print(scheduling.format_load_report(f"variable {variable_id} predicted load per worker "
+                                        f"({extraction_schedule.policy}, {len(extraction_schedule.tasks)} tasks)",
+                                        dict(enumerate(extraction_schedule.predicted_worker_costs))))
+
     static_parameters = (variable_id, block_processor,
-                         extraction_metadata_block_csv_save_options)
-    parameters_list = [(period, extraction_metadata_blocks, *static_parameters)
-                       for period, extraction_metadata_blocks in merged_structures]
-    start = time.time()
-    if nb_workers > 1:
-        print(f"> variable {variable_id} starting parallel extractions (number of workers: {nb_workers})")
-        with Pool(processes=nb_workers) as pool:
-            tmp_result = pool.map(func=__map_core_extraction, iterable=parameters_list, chunksize=1)
-    else:
-        print(f"> variable {variable_id} starting sequential extractions")
-        tmp_result = list()
-        for parameters in parameters_list:
-            tmp_result.append(__map_core_extraction(parameters))
-    print(f"> elapsed time: {tu.display_duration(time.time()-start)}")
-    result = dict(tmp_result)
+                         extraction_metadata_block_csv_save_options, dtype, block_format, hdf5_options)
+    parameters_list = [(period, extraction_metadata_blocks,
+                        {label_id: appended_blocks[(period, label_id)] for label_id, _ in extraction_metadata_blocks
+                         if (period, label_id) in appended_blocks},
+                        *static_parameters)
+                       for period, extraction_metadata_blocks in extraction_schedule.tasks]
+
+    # The results are handled as the tasks complete: the blocks are reported and written in the manifest, and the
+    # tasks of a split period are merged back.
+    worker_elapsed_times: Dict[int, float] = dict()
+    total_nb_regions = sum(len(extraction_metadata_block) for _, extraction_metadata_blocks
+                           in extraction_schedule.tasks for _, extraction_metadata_block in extraction_metadata_blocks)
+    progress = ProgressMeter(total_nb_regions)
+
+    def handle_task_result(task_result) -> None:
+        period, file_paths, block_statistics, pid, elapsed_time = task_result
+        result.setdefault(period, dict()).update(file_paths)
+        worker_elapsed_times[pid] = worker_elapsed_times.get(pid, 0.) + elapsed_time
+        for label_id, (nb_regions, nb_extracted_regions, nb_bytes, checksum, rows_checksum) \
+                in block_statistics.items():
+            manifest.write(period, label_id, nb_regions, nb_bytes, checksum, rows_checksum, file_paths[label_id])
+            progress.update(nb_extracted_regions, nb_bytes)
+            print(f"> variable {variable_id} completed {label_id} block for period {nu.create_period_str(period)}: "
+                  f"{progress}")
+
+    with ManifestWriter(manifest_file_path, blocks_dir_path, completed_entries) as manifest:
+        if nb_workers > 1:
+            print(f"> variable {variable_id} starting parallel extractions (number of workers: {nb_workers})")
+            with Pool(processes=nb_workers) as pool:
+                for parameters_result in pool.imap_unordered(func=__map_core_extraction, iterable=parameters_list,
+                                                             chunksize=1):
+                    handle_task_result(parameters_result)
+        else:
+            print(f"> variable {variable_id} starting sequential extractions")
+            for parameters in parameters_list:
+                handle_task_result(__map_core_extraction(parameters))
+    print(f"> elapsed time: {tu.display_duration(progress.get_elapsed_time())}")
+    print(f"> manifest saved in {manifest_file_path}")
+    print(scheduling.format_load_report(f"variable {variable_id} actual load per worker",
+                                        worker_elapsed_times, ' s'))
     return result
 
 
+# Return the result of the extraction with the pid of the worker and the elapsed time, so as to report the actual
+# load of the workers.
 def __map_core_extraction(parameters):
-    return __core_extraction(*parameters)
+    start = time.time()
+    period, result, block_statistics = __core_extraction(*parameters)
+    return period, result, block_statistics, os.getpid(), time.time() - start
 
 
+# The rows of the blocks of appended_blocks are appended to the existing blocks (see is_incremental).
 def __core_extraction(period: Period,
-                      extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]],
+                      extraction_metadata_blocks: List[Tuple[LabelId, mdb.LazyMetaDataBlock]],
+                      appended_blocks: Mapping[LabelId, mdb.LazyMetaDataBlock],
                       variable_id: VariableId,
                       block_processor: BlockProcessor,
-                      extraction_metadata_block_csv_save_options: Mapping[CsvOptName, any] = None)\
-                      -> Tuple[Period, Dict[str, Dict[str, str]]]:
+                      extraction_metadata_block_csv_save_options: Mapping[CsvOptName, any] = None,
+                      dtype: str = None, block_format: BlockFormat = BlockFormat.CSV,
+                      hdf5_options: Mapping[Hdf5OptName, any] = None) \
+        -> Tuple[Period, Dict[str, Dict[str, str]], Dict[LabelId, Tuple[int, int, int, str, str]]]:
     result: Dict[str, Dict[str, str]] = dict()
-    parent_dir_path, extracted_data_blocks = block_processor.process_blocks(period, extraction_metadata_blocks)
-
-    for extracted_data_block in extracted_data_blocks:
-        label_id, data_block, metadata_block = extracted_data_block
-        period_str = nu.create_period_str(period)
+    # The number of regions, the number of extracted regions, the number of bytes written, the checksum of the files
+    # and the checksum of the rows, for each block.
+    block_statistics: Dict[LabelId, Tuple[int, int, int, str, str]] = dict()
+    parent_dir_path = block_processor.get_blocks_dir_path()
+    period_str = nu.create_period_str(period)
+    extraction_metadata_blocks = [(label_id, mdb.load_metadata_block(extraction_metadata_block))
+                                  for label_id, extraction_metadata_block in extraction_metadata_blocks]
+    appended_blocks = {label_id: mdb.load_metadata_block(extraction_metadata_block)
+                       for label_id, extraction_metadata_block in appended_blocks.items()}
+
+    # Each data block is saved as soon as it is extracted, so as to bound the memory to one block.
+    def save_block(label_id: LabelId, data_block: xr.DataArray, metadata_block: MetaDataBlock) -> None:
         data_metadata_parent_dir = path.join(parent_dir_path, f"{period_str}", label_id)
         os.makedirs(data_metadata_parent_dir, exist_ok=True)
         data_block_file_path, metadata_block_file_path = \
             nu.compute_data_meta_data_file_path(variable_id, data_metadata_parent_dir)
-        if extraction_metadata_block_csv_save_options is None:
-            cu.to_csv(data=metadata_block, file_path=metadata_block_file_path)
+        nb_extracted_regions = len(metadata_block)
+        data = data_block.values
+        if label_id in appended_blocks:
+            # The existing block is rewritten with the new rows, so as the block tree stays consistent. The new
+            # file replaces the existing one once complete.
+            with nxtensor.utils.hdf5_utils.open_hdf5_dataset(data_block_file_path) as dataset:
+                nb_previous_images = dataset.shape[0]
+                merged_data = np.empty((nb_previous_images + len(data),) + data.shape[1:],
+                                       dtype=np.result_type(dataset.dtype, data.dtype))
+                nxtensor.utils.hdf5_utils.read_dataset_into(dataset, merged_data,
+                                                            destination_selection=np.s_[:nb_previous_images])
+            merged_data[nb_previous_images:] = data
+            data = merged_data
+            metadata_block = appended_blocks[label_id]
+        if block_format == BlockFormat.HDF5:
+            # The metadata is a compound dataset of the data block file.
+            metadata_block_file_path = data_block_file_path
+            embedded_metadata_block = metadata_block
+        elif block_format == BlockFormat.CSV:
+            embedded_metadata_block = None
+            if extraction_metadata_block_csv_save_options is None:
+                cu.to_csv(data=mdb.to_records(metadata_block), file_path=metadata_block_file_path)
+            else:
+                cu.to_csv(data=mdb.to_records(metadata_block), file_path=metadata_block_file_path,
+                          csv_options=extraction_metadata_block_csv_save_options)
         else:
-            cu.to_csv(data=metadata_block, file_path=metadata_block_file_path,
-                      csv_options=extraction_metadata_block_csv_save_options)
-
-        nxtensor.utils.hdf5_utils.write_ndarray_to_hdf5(data_block_file_path, data_block.values)
-        print(f'> saved {label_id} data block (shape: {data_block.shape}) for period {period_str}')
+            msg = f"> [ERROR] unknown block format '{block_format}'"
+            raise ConfigurationError(msg)
+
+        # The statistics and the quantile sketch of the block are computed on the stored values and written with
+        # them, so as the assembly merges the ones of the blocks instead of reading the data again (see statistics).
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        block_statistics_attributes = Statistics.compute(data).to_mapping()
+        block_statistics_attributes.update(QuantileSketch.compute(data).to_mapping())
+        tmp_data_block_file_path = f'{data_block_file_path}.tmp'
+        nxtensor.utils.hdf5_utils.write_ndarray_to_hdf5(tmp_data_block_file_path, data, dtype,
+                                                        embedded_metadata_block, hdf5_options,
+                                                        block_statistics_attributes)
+        os.replace(tmp_data_block_file_path, data_block_file_path)
+        print(f'> saved {label_id} data block (shape: {data.shape}) for period {period_str}')
         result[label_id] = dict()
         result[label_id]['data_block'] = data_block_file_path
         result[label_id]['metadata_block'] = metadata_block_file_path
-    return period, result
+        block_file_paths = set((data_block_file_path, metadata_block_file_path))
+        block_statistics[label_id] = (len(metadata_block), nb_extracted_regions,
+                                      sum(path.getsize(file_path) for file_path in block_file_paths),
+                                      compute_checksum(data_block_file_path, metadata_block_file_path),
+                                      compute_rows_checksum(metadata_block))
+
+    block_processor.process_blocks(period, extraction_metadata_blocks, save_block)
+    return period, result, block_statistics
+
+
+# Return the blocks that remain to be extracted, the manifest entries of the blocks that are complete and valid (i.e.
+# extracted from the same rows) and the manifest entries of the blocks that no longer exist in the preprocessing
+# structure (stale).
+def __filter_completed_blocks(merged_structures: List[Tuple[Period, List[Tuple[LabelId, mdb.LazyMetaDataBlock]]]],
+                              manifest_file_path: str, blocks_dir_path: str) \
+        -> Tuple[List[Tuple[Period, List[Tuple[LabelId, mdb.LazyMetaDataBlock]]]], List[Dict[str, any]],
+                 List[Dict[str, any]]]:
+    entries = load_manifest(manifest_file_path, blocks_dir_path)
+    remaining_structures: List[Tuple[Period, List[Tuple[LabelId, mdb.LazyMetaDataBlock]]]] = list()
+    completed_entries: List[Dict[str, any]] = list()
+    for period, extraction_metadata_blocks in merged_structures:
+        remaining_blocks: List[Tuple[LabelId, mdb.LazyMetaDataBlock]] = list()
+        for label_id, extraction_metadata_block in extraction_metadata_blocks:
+            entry = entries.pop((period, label_id), None)
+            if entry is not None and \
+               is_valid_entry(entry, len(extraction_metadata_block),
+                              compute_rows_checksum(mdb.load_metadata_block(extraction_metadata_block))):
+                completed_entries.append(entry)
+            else:
+                remaining_blocks.append((label_id, extraction_metadata_block))
+        if remaining_blocks:
+            remaining_structures.append((period, remaining_blocks))
+    return remaining_structures, completed_entries, list(entries.values())
+
+
+# Compare the given (new) preprocessing structure with the blocks extracted from the previous one (see the manifest):
+# - the unchanged blocks are not extracted again.
+# - the blocks that only have new rows, after the rows of the existing block, are appended with the new rows only.
+# - the other blocks (changed or new) are extracted.
+# - the blocks that no longer exist in the preprocessing structure are stale.
+# Return the blocks to be extracted, the manifest entries of the unchanged blocks, the complete metadata of the
+# appended blocks and the manifest entries of the stale blocks.
+def __plan_incremental_extraction(merged_structures: List[Tuple[Period, List[Tuple[LabelId, mdb.LazyMetaDataBlock]]]],
+                                  manifest_file_path: str, blocks_dir_path: str) \
+        -> Tuple[List[Tuple[Period, List[Tuple[LabelId, mdb.LazyMetaDataBlock]]]], List[Dict[str, any]],
+                 Dict[Tuple[Period, LabelId], mdb.LazyMetaDataBlock], List[Dict[str, any]]]:
+    entries = load_manifest(manifest_file_path, blocks_dir_path)
+    remaining_structures: List[Tuple[Period, List[Tuple[LabelId, mdb.LazyMetaDataBlock]]]] = list()
+    completed_entries: List[Dict[str, any]] = list()
+    appended_blocks: Dict[Tuple[Period, LabelId], mdb.LazyMetaDataBlock] = dict()
+    for period, extraction_metadata_blocks in merged_structures:
+        remaining_blocks: List[Tuple[LabelId, mdb.LazyMetaDataBlock]] = list()
+        for label_id, extraction_metadata_block in extraction_metadata_blocks:
+            entry = entries.pop((period, label_id), None)
+            nb_previous_rows = entry[ManifestField.NB_REGIONS] if entry is not None else 0
+            if entry is None or nb_previous_rows > len(extraction_metadata_block) or \
+               not is_valid_entry(entry, nb_previous_rows) or \
+               not __has_same_rows(mdb.load_metadata_block(extraction_metadata_block[0:nb_previous_rows]),
+                                   entry[ManifestField.METADATA_BLOCK]):
+                remaining_blocks.append((label_id, extraction_metadata_block))
+            elif nb_previous_rows == len(extraction_metadata_block):
+                completed_entries.append(entry)
+            else:
+                appended_blocks[(period, label_id)] = extraction_metadata_block
+                remaining_blocks.append((label_id, extraction_metadata_block[nb_previous_rows:]))
+        if remaining_blocks:
+            remaining_structures.append((period, remaining_blocks))
+    return remaining_structures, completed_entries, appended_blocks, list(entries.values())
+
+
+# The rows are compared on their values (coordinates, time and label), not on their formatting.
+def __has_same_rows(extraction_metadata_block: MetaDataBlock, metadata_block_file_path: str) -> bool:
+    keys = sorted(key for key in extraction_metadata_block.dtype.names if key not in mdb.FORMATTED_TIME_KEYS)
+    try:
+        if metadata_block_file_path.endswith(f'.{fu.HDF5_FILE_EXTENSION}'):  # See BlockFormat.HDF5.
+            previous_metadata_block = nxtensor.utils.hdf5_utils.read_metadata_from_hdf5(metadata_block_file_path)
+            previous_rows = np.stack([previous_metadata_block[key].astype(np.float64) for key in keys], axis=1)
+        else:
+            previous_rows = pd.read_csv(metadata_block_file_path, usecols=keys, float_precision='round_trip')
+            # usecols doesn't reorder the columns.
+            previous_rows = previous_rows[keys].to_numpy(dtype=np.float64)
+    except (ValueError, KeyError):  # Missing columns or dataset.
+        return False
+    rows = np.stack([extraction_metadata_block[key].astype(np.float64) for key in keys], axis=1)
+    return rows.shape == previous_rows.shape and np.array_equal(rows, previous_rows)
+
+
+# Nothing outside the given blocks directory is removed (see load_manifest).
+def __remove_stale_blocks(stale_entries: Sequence[Mapping[str, any]], blocks_dir_path: str) -> None:
+    for entry in stale_entries:
+        file_paths = (entry[ManifestField.DATA_BLOCK], entry[ManifestField.METADATA_BLOCK])
+        if not all(is_in_dir(file_path, blocks_dir_path) for file_path in file_paths):
+            continue
+        for file_path in file_paths:
+            if path.isfile(file_path):
+                os.remove(file_path)
+        # The directory of the block (then the one of its period) is removed when the blocks of all the variables
+        # are removed.
+        parent_dir_path = path.dirname(entry[ManifestField.DATA_BLOCK])
+        for dir_path in (parent_dir_path, path.dirname(parent_dir_path)):
+            if path.realpath(dir_path) == path.realpath(blocks_dir_path) or not path.isdir(dir_path) or \
+               os.listdir(dir_path):
+                break
+            os.rmdir(dir_path)
 
 
 # Enable processing of extractions period by period so as to open a netcdf file only one time.
@@ -208,16 +533,11 @@ def __build_blocks_structure(dataframe: pd.DataFrame, db_metadata_mapping: DBMet
     #     - dataframe row at index 7
     #     ...
     #  ...
-    try:
-        resolution_degree = TimeResolution.KEYS.index(netcdf_file_time_period)
-    except ValueError as e:
-        msg = f"'{netcdf_file_time_period}' is not a known time resolution"
-        raise ConfigurationError(msg, e)
+    list_keys = __compute_period_keys(netcdf_file_time_period)
 
     # Add the numerical id of the label.
     dataframe[TensorDimension.LABEL_NUM_ID] = label_num_id
 
-    list_keys = TimeResolution.KEYS[0:(resolution_degree + 1)]
     list_column_names = [db_metadata_mapping[key] for key in list_keys]
     indices = dataframe.groupby(list_column_names).indices
 
@@ -235,14 +555,27 @@ def __build_blocks_structure(dataframe: pd.DataFrame, db_metadata_mapping: DBMet
     selected_columns.append(TensorDimension.LABEL_NUM_ID)
     restricted_renamed_df = renamed_df[selected_columns]
 
-    # Compute the extraction_metadata_blocks.
+    # Compute the extraction_metadata_blocks: the rows are converted once, then the blocks are taken from their
+    # positions (indices are positional).
+    metadata_block = mdb.create_metadata_block(restricted_renamed_df)
     result: Dict[Period, MetaDataBlock] = dict()
     for index, value in indices.items():
-        result[index] = convert_block_to_dict(restricted_renamed_df.loc[value])
+        result[index] = metadata_block[value]
 
     return result
 
 
+# Return the time resolutions of a period covered by a netcdf file of the given period resolution
+# (e.g. (year, month) for a month).
+def __compute_period_keys(netcdf_file_time_period: TimeResolution) -> List[TimeResolution]:
+    try:
+        resolution_degree = TimeResolution.KEYS.index(netcdf_file_time_period)
+    except ValueError as e:
+        msg = f"'{netcdf_file_time_period}' is not a known time resolution"
+        raise ConfigurationError(msg, e)
+    return list(TimeResolution.KEYS[0:(resolution_degree + 1)])
+
+
 def __test_build_blocks_structure(csv_file_path: str, period_resolution: TimeResolution, label_num_id: float)\
         -> Dict[Period, MetaDataBlock]:
     dataframe = du.load_csv_file(csv_file_path)
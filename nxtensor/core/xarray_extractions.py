@@ -5,11 +5,17 @@ Created on Fri Apr 17 10:50:00 2020
 
 @author: sebastien@gardoll.fr
 """
-from typing import Mapping
+from typing import Mapping, Sequence, Tuple
 
+import logging
 import dask
+import numpy as np
 import xarray as xr
 import nxtensor.utils.coordinate_utils as coordinate_utils
+from nxtensor.core.grid_index import GridIndex
+from nxtensor.core.read_planner import ReadStrategy, ReadPlan, ChunkLayout, DEFAULT_MAX_SLAB_NBYTES, \
+    DEFAULT_READ_OVERHEAD_NBYTES
+import nxtensor.core.read_planner as rp
 from nxtensor.exceptions import ExtractionError
 
 # Ignore 'DataArray.py:1965: FutureWarning: dropping coordinates using `drop` is be deprecated; use drop_vars'
@@ -23,7 +29,17 @@ def open_netcdf(netcdf_file_path: str, options: Mapping[str, str] = None) -> xr.
     return xr.open_dataset(netcdf_file_path, **options)
 
 
+def create_grid_index(dataset: xr.Dataset, lat_resolution: float, lon_resolution: float,
+                      time_netcdf_attr_name: str = 'time',
+                      lat_netcdf_attr_name: str = 'latitude',
+                      lon_netcdf_attr_name: str = 'longitude') -> GridIndex:
+    return GridIndex(times=dataset.indexes[time_netcdf_attr_name],
+                     lats=dataset[lat_netcdf_attr_name].values, lat_resolution=lat_resolution,
+                     lons=dataset[lon_netcdf_attr_name].values, lon_resolution=lon_resolution)
+
+
 # Extract the region that centers the given lat/lon location.
+# The grid index of the dataset should be computed once (see create_grid_index) and given for each extraction.
 def extract_square_region(dataset: xr.Dataset, variable_netcdf_attr_name: str, formatted_date: str,
                           lat: float, lat_resolution: float, half_lat_frame: int,
                           lon: float, lon_resolution: float, half_lon_frame: int,
@@ -32,45 +48,156 @@ def extract_square_region(dataset: xr.Dataset, variable_netcdf_attr_name: str, f
                           lat_netcdf_attr_name: str = 'latitude',
                           lon_netcdf_attr_name: str = 'longitude',
                           has_to_round: bool = False, lat_nb_decimal: int = None, lon_nb_decimal: int = None,
-                          dask_scheduler: str = 'single-threaded') -> xr.DataArray:
+                          dask_scheduler: str = 'single-threaded', grid_index: GridIndex = None) -> xr.DataArray:
     if has_to_round:
         if (not lat_nb_decimal) or (not lon_nb_decimal):
             raise ExtractionError("when has_to_round is true, lat_nb_decimal and lon_nb_decimal must be provided")
         lat = coordinate_utils.round_nearest(lat, lat_resolution, lat_nb_decimal)
         lon = coordinate_utils.round_nearest(lon, lon_resolution, lon_nb_decimal)
 
-    # Minus lat_resolution because the upper bound in slice is included.
-    lat_min = (lat - half_lat_frame + lat_resolution)
-    lat_max = (lat + half_lat_frame)
-    # Minus lon_resolution because the upper bound in slice is included.
-    lon_min = (lon - half_lon_frame)
-    lon_max = (lon + half_lon_frame - lon_resolution)
-
-    lat_series = dataset[lat_netcdf_attr_name]
-
-    # Switching lat min and max.
-    if lat_series[0] > lat_series[-1]:
-        tmp = lat_min
-        lat_min = lat_max
-        lat_max = tmp
-        del tmp
+    if grid_index is None:
+        grid_index = create_grid_index(dataset, lat_resolution, lon_resolution, time_netcdf_attr_name,
+                                       lat_netcdf_attr_name, lon_netcdf_attr_name)
+    time_positions, lat_positions, lon_positions = \
+        grid_index.compute_window_positions([formatted_date], [lat], half_lat_frame, [lon], half_lon_frame)
 
     indexers = dict()
-    indexers[time_netcdf_attr_name] = formatted_date
-    indexers[lat_netcdf_attr_name] = slice(lat_min, lat_max)
-    indexers[lon_netcdf_attr_name] = slice(lon_min, lon_max)
+    indexers[time_netcdf_attr_name] = time_positions[0]
+    indexers[lat_netcdf_attr_name] = __to_indexer(lat_positions[0])
+    indexers[lon_netcdf_attr_name] = __to_indexer(lon_positions[0])
 
     with dask.config.set(scheduler=dask_scheduler):
         if variable_level:
-            indexers[level_netcdf_attr_name] = variable_level
+            variable = dataset[variable_netcdf_attr_name].sel(indexers={level_netcdf_attr_name: variable_level})
+        else:
+            variable = dataset[variable_netcdf_attr_name]
 
-        result = dataset[variable_netcdf_attr_name].sel(indexers=indexers).compute()
+        result = variable.isel(indexers=indexers).compute()
         # Drop the coordinates (time, latitude and longitude) so as to concatenate
         # the extracted region so as to stack several of them and make a channel.
         result = result.drop(result.coords)
         return result
 
 
+# Return the on-disk layout (chunks and compression) of the given variable, as read by the NetCDF backend.
+def get_chunk_layout(dataset: xr.Dataset, variable_netcdf_attr_name: str,
+                     time_netcdf_attr_name: str = 'time',
+                     lat_netcdf_attr_name: str = 'latitude',
+                     lon_netcdf_attr_name: str = 'longitude') -> ChunkLayout:
+    variable = dataset[variable_netcdf_attr_name]
+    encoding = variable.encoding
+    chunk_sizes = encoding.get('chunksizes', None)
+    if chunk_sizes is None or encoding.get('contiguous', False):
+        chunk_sizes = (1,) * variable.ndim
+    chunk_sizes = dict(zip(variable.dims, chunk_sizes))
+    dims = (time_netcdf_attr_name, lat_netcdf_attr_name, lon_netcdf_attr_name)
+    itemsize = np.dtype(encoding.get('dtype', variable.dtype)).itemsize
+    chunk_nbytes = int(np.prod(list(chunk_sizes.values()))) * itemsize
+    is_compressed = bool(encoding.get('zlib', False) or encoding.get('compression', None))
+    return ChunkLayout(shape=tuple(variable.sizes[dim] for dim in dims),
+                       chunk_shape=tuple(chunk_sizes[dim] for dim in dims),
+                       chunk_nbytes=chunk_nbytes, is_compressed=is_compressed)
+
+
+# Extract the regions that center the given lat/lon locations, with vectorized gathers.
+# The result is an array of shape (number of locations, y, x): the regions are the same, and in the same order,
+# as the ones returned by successive calls to extract_square_region.
+# The data is read by slabs, according to the given read strategy (see read_planner), then the regions are gathered
+# from the slabs, in memory, with integer indexing over the window positions.
+def extract_square_regions(dataset: xr.Dataset, variable_netcdf_attr_name: str, formatted_dates: Sequence[str],
+                           lats: Sequence[float], lat_resolution: float, half_lat_frame: int,
+                           lons: Sequence[float], lon_resolution: float, half_lon_frame: int,
+                           variable_level: int = None, level_netcdf_attr_name: str = 'level',
+                           time_netcdf_attr_name: str = 'time',
+                           lat_netcdf_attr_name: str = 'latitude',
+                           lon_netcdf_attr_name: str = 'longitude',
+                           has_to_round: bool = False, lat_nb_decimal: int = None, lon_nb_decimal: int = None,
+                           dask_scheduler: str = 'single-threaded', grid_index: GridIndex = None,
+                           read_strategy: ReadStrategy = ReadStrategy.BOUNDING_BOX,
+                           max_slab_nbytes: int = DEFAULT_MAX_SLAB_NBYTES,
+                           read_overhead_nbytes: int = DEFAULT_READ_OVERHEAD_NBYTES) -> np.ndarray:
+    time_positions, lat_positions, lon_positions = \
+        __compute_window_positions(dataset, formatted_dates, lats, lat_resolution, half_lat_frame,
+                                   lons, lon_resolution, half_lon_frame, time_netcdf_attr_name,
+                                   lat_netcdf_attr_name, lon_netcdf_attr_name, has_to_round, lat_nb_decimal,
+                                   lon_nb_decimal, grid_index)
+
+    with dask.config.set(scheduler=dask_scheduler):
+        variable = dataset[variable_netcdf_attr_name]
+        if variable_level:
+            variable = variable.sel(indexers={level_netcdf_attr_name: variable_level})
+        variable = variable.transpose(time_netcdf_attr_name, lat_netcdf_attr_name, lon_netcdf_attr_name)
+
+        chunk_layout = get_chunk_layout(dataset, variable_netcdf_attr_name, time_netcdf_attr_name,
+                                        lat_netcdf_attr_name, lon_netcdf_attr_name)
+        read_plan = rp.plan_reads(read_strategy, time_positions, lat_positions, lon_positions, chunk_layout,
+                                  variable.dtype.itemsize, max_slab_nbytes, read_overhead_nbytes)
+        logging.debug(f"extracting {len(time_positions)} regions of {variable_netcdf_attr_name}: {read_plan}")
+
+        result = np.empty((len(time_positions),) + lat_positions.shape[1:] + lon_positions.shape[1:],
+                          dtype=variable.dtype)
+        for read in read_plan.reads:
+            indexers = dict()
+            indexers[time_netcdf_attr_name] = __to_indexer(read.time_positions)
+            indexers[lat_netcdf_attr_name] = slice(read.lat_start, read.lat_stop)
+            indexers[lon_netcdf_attr_name] = slice(read.lon_start, read.lon_stop)
+            slab = variable.isel(indexers=indexers).values
+            rp.gather_regions(result, slab, read, time_positions, lat_positions, lon_positions)
+        return result
+
+
+# Return the plan of the reads of extract_square_regions for the same parameters, so as to tune the extraction.
+def plan_square_regions(dataset: xr.Dataset, variable_netcdf_attr_name: str, formatted_dates: Sequence[str],
+                        lats: Sequence[float], lat_resolution: float, half_lat_frame: int,
+                        lons: Sequence[float], lon_resolution: float, half_lon_frame: int,
+                        time_netcdf_attr_name: str = 'time',
+                        lat_netcdf_attr_name: str = 'latitude',
+                        lon_netcdf_attr_name: str = 'longitude',
+                        has_to_round: bool = False, lat_nb_decimal: int = None, lon_nb_decimal: int = None,
+                        grid_index: GridIndex = None,
+                        read_strategy: ReadStrategy = ReadStrategy.BOUNDING_BOX,
+                        max_slab_nbytes: int = DEFAULT_MAX_SLAB_NBYTES,
+                        read_overhead_nbytes: int = DEFAULT_READ_OVERHEAD_NBYTES) -> ReadPlan:
+    time_positions, lat_positions, lon_positions = \
+        __compute_window_positions(dataset, formatted_dates, lats, lat_resolution, half_lat_frame,
+                                   lons, lon_resolution, half_lon_frame, time_netcdf_attr_name,
+                                   lat_netcdf_attr_name, lon_netcdf_attr_name, has_to_round, lat_nb_decimal,
+                                   lon_nb_decimal, grid_index)
+    chunk_layout = get_chunk_layout(dataset, variable_netcdf_attr_name, time_netcdf_attr_name,
+                                    lat_netcdf_attr_name, lon_netcdf_attr_name)
+    itemsize = dataset[variable_netcdf_attr_name].dtype.itemsize
+    return rp.plan_reads(read_strategy, time_positions, lat_positions, lon_positions, chunk_layout, itemsize,
+                         max_slab_nbytes, read_overhead_nbytes)
+
+
+def __compute_window_positions(dataset: xr.Dataset, formatted_dates: Sequence[str],
+                               lats: Sequence[float], lat_resolution: float, half_lat_frame: int,
+                               lons: Sequence[float], lon_resolution: float, half_lon_frame: int,
+                               time_netcdf_attr_name: str, lat_netcdf_attr_name: str, lon_netcdf_attr_name: str,
+                               has_to_round: bool, lat_nb_decimal: int, lon_nb_decimal: int,
+                               grid_index: GridIndex) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if has_to_round:
+        if (not lat_nb_decimal) or (not lon_nb_decimal):
+            raise ExtractionError("when has_to_round is true, lat_nb_decimal and lon_nb_decimal must be provided")
+        lats = coordinate_utils.round_nearest_array(lats, lat_resolution, lat_nb_decimal)
+        lons = coordinate_utils.round_nearest_array(lons, lon_resolution, lon_nb_decimal)
+
+    if grid_index is None:
+        grid_index = create_grid_index(dataset, lat_resolution, lon_resolution, time_netcdf_attr_name,
+                                       lat_netcdf_attr_name, lon_netcdf_attr_name)
+    return grid_index.compute_window_positions(formatted_dates, lats, half_lat_frame, lons, half_lon_frame)
+
+
+# Return a slice if the given positions are contiguous (basic indexing is cheaper), the positions otherwise.
+def __to_indexer(positions: np.ndarray):
+    if positions[-1] - positions[0] == len(positions) - 1:
+        return slice(int(positions[0]), int(positions[-1]) + 1)
+    else:
+        return positions
+
+
 def __era5_unit_test_extraction(variable_name: str,
                                 year: int, month: int, day: int, hour: int,
                                 lat: float, lon: float,
@@ -133,9 +260,30 @@ def __test_multilevel_variable():
     return __era5_unit_test_extraction(variable_name, year, month, day, hour, lat, lon, variable_level)
 
 
+def __test_square_regions():
+    variable_name = 'msl'
+    netcdf_file_path = '/bdd/ERA5/NETCDF/GLOBAL_025/hourly/AN_SF/2000/msl.200010.as1e5.GLOBAL_025.nc'
+    formatted_dates = ['2000-10-1T00', '2000-10-1T00', '2000-10-12T06', '2000-10-31T23']
+    lats = [39.7, 15.0, 26.5, -12.3]
+    lons = [312, 301, 282.8, 45.1]
+    with open_netcdf(netcdf_file_path) as dataset:
+        regions = extract_square_regions(dataset=dataset, variable_netcdf_attr_name=variable_name,
+                                         formatted_dates=formatted_dates, lats=lats, lat_resolution=0.25,
+                                         half_lat_frame=4, lons=lons, lon_resolution=0.25, half_lon_frame=4,
+                                         has_to_round=True, lat_nb_decimal=2, lon_nb_decimal=2)
+        for index in range(0, len(formatted_dates)):
+            region = extract_square_region(dataset=dataset, variable_netcdf_attr_name=variable_name,
+                                           formatted_date=formatted_dates[index], lat=lats[index],
+                                           lat_resolution=0.25, half_lat_frame=4, lon=lons[index],
+                                           lon_resolution=0.25, half_lon_frame=4, has_to_round=True,
+                                           lat_nb_decimal=2, lon_nb_decimal=2)
+            assert np.array_equal(regions[index], region.values)
+
+
 def __all_tests():
     __test_simple_variable()
     __test_multilevel_variable()
+    __test_square_regions()
 
 
 if __name__ == '__main__':
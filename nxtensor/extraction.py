@@ -9,9 +9,13 @@ Created on Wed Apr  3 13:26:39 2019
 from nxtensor.utils.time_resolutions import TimeResolution
 from nxtensor.utils.csv_option_names import CsvOptName
 from nxtensor.utils.db_types import DBType
+from nxtensor.utils.block_formats import BlockFormat
+from nxtensor.utils.hdf5_option_names import Hdf5OptName
+from nxtensor.utils.normalization_modes import NormalizationMode
 from nxtensor.yaml_serializable import YamlSerializable
 from nxtensor.variable import Variable
 from nxtensor.core.types import VariableId, LabelId, DBMetadataMapping
+from nxtensor.core.scheduling import SchedulingPolicy
 import logging
 from typing import List, Dict, Mapping
 
@@ -21,6 +25,26 @@ class ExtractionShape:
     SQUARE = 'square'
 
 
+class ExtractionMode:
+
+    ROW        = 'row'         # One extraction per row of extraction metadata.
+    # One vectorized extraction per block of extraction metadata, reading the bounding box of all the regions of the
+    # block (the best mode for regions close to each other).
+    BATCH      = 'batch'
+    # One vectorized extraction per block of extraction metadata, reading each timestep only once
+    # for all the regions of the block (the best mode for dense labels).
+    TIME_SLICE = 'time_slice'
+    # One vectorized extraction per block of extraction metadata, reading the data by chunk aligned slabs,
+    # planned from the chunk layout of the NetCDF files (the best mode for chunked and compressed files).
+    PLANNED    = 'planned'
+
+
+class ReaderBackend:
+
+    XARRAY  = 'xarray'   # Read the NetCDF files with xarray (see xarray_extractions).
+    NETCDF4 = 'netcdf4'  # Read the NetCDF files directly with the netCDF4 library (see netcdf4_extractions).
+
+
 class ExtractionConfig(YamlSerializable):
 
     yaml_tag = u'ExtractionConfig'
@@ -50,6 +74,24 @@ class ExtractionConfig(YamlSerializable):
         # List of label file path descriptions.
         self.label_file_paths: List[str] = None
         self.extraction_shape: ExtractionShape = ExtractionShape.SQUARE
+        self.extraction_mode: ExtractionMode = ExtractionMode.PLANNED
+        self.reader_backend: ReaderBackend = ReaderBackend.XARRAY
+        # Storage and compute type of the blocks, channels and tensors (e.g. 'float32' or 'float16').
+        # None keeps the precision of the NetCDF files. The statistics are always computed in float64.
+        self.dtype: str = None
+        # The format of the extracted blocks: metadata in CSV files or in the HDF5 files of the data (see BlockFormat).
+        self.block_format: BlockFormat = BlockFormat.CSV
+        # The normalization of the channels (see NormalizationMode), per variable: the variables missing from
+        # variable_normalization_modes are normalized with normalization_mode. The percentile clip normalization
+        # clips the channels into the normalization_clip_percentiles (None: [1, 99]).
+        self.normalization_mode: NormalizationMode = NormalizationMode.STANDARD
+        self.variable_normalization_modes: Dict[VariableId, NormalizationMode] = None
+        self.normalization_clip_percentiles: List[float] = None
+        # The chunking and the compression of the HDF5 files of the blocks, the channels and the tensors
+        # (see Hdf5OptName). None writes one image per chunk, without compression.
+        self.block_hdf5_options: Mapping[Hdf5OptName, any] = None
+        self.channel_hdf5_options: Mapping[Hdf5OptName, any] = None
+        self.tensor_hdf5_options: Mapping[Hdf5OptName, any] = None
         # The path of required directories for an extraction and assemble (channel and tensor).
         self.qsub_log_dir_path: str = None
         self.blocks_dir_path: str = None
@@ -60,6 +102,12 @@ class ExtractionConfig(YamlSerializable):
         # The maximum number of process spawn during the extraction.
         # Each process treats one extraction_metadata_blocks.
         self.nb_process: int = None
+        # The order in which the periods are dispatched to the processes (see scheduling).
+        self.scheduling_policy: SchedulingPolicy = SchedulingPolicy.HEAVIEST_FIRST
+        # The number of rows of the label dbs read at once by the preprocessing. None loads the dbs in memory,
+        # otherwise the dbs are read by chunks and sharded per period on disk, one db per process (for the dbs larger
+        # than the memory).
+        self.preprocessing_chunk_size: int = None
 
         # The maximum walltime for the extraction per variable.
         self.max_walltime: str = None  # i.e. '01:59:59' hours:mins:seconds
@@ -83,6 +131,12 @@ class ExtractionConfig(YamlSerializable):
 
         # TODO: save metadata options (csv).
 
+    # Called by the yaml loader: the options missing from configuration files saved by previous
+    # versions of NXTensor get their default value.
+    def __setstate__(self, state: Dict[str, any]) -> None:
+        self.__init__(state['str_id'])
+        self.__dict__.update(state)
+
     def save(self, file_path: str) -> None:
         variables = self.__variables
         labels = self.__labels
@@ -92,6 +146,11 @@ class ExtractionConfig(YamlSerializable):
         self.__variables = variables
         self.__labels = labels
 
+    def get_normalization_mode(self, variable_id: VariableId) -> NormalizationMode:
+        if self.variable_normalization_modes and variable_id in self.variable_normalization_modes:
+            return self.variable_normalization_modes[variable_id]
+        return self.normalization_mode
+
     def get_variables(self) -> Mapping[VariableId, Variable]:
         variables_value = getattr(self, '__variables', None)
         if variables_value is None:
@@ -158,8 +217,20 @@ class ClassificationLabel(YamlSerializable):
         # Time resolution in the db.
         self.db_time_resolution: TimeResolution = None
 
+        # Optional filters of the rows of the db (see db_utils.DBRowFilter), pushed down into the read for the
+        # columnar db formats. Time range: inclusive ISO 8601 dates (e.g. '2000-10-01' or '2000-10-31T18').
+        self.db_start_date: str = None
+        self.db_end_date: str = None
+        # Bounding box: (lat_min, lat_max, lon_min, lon_max), inclusive, in the coordinates of the db.
+        self.db_bounding_box: List[float] = None
+
+    # See ExtractionConfig.__setstate__.
+    def __setstate__(self, state: Dict[str, any]) -> None:
+        self.__init__(state['str_id'], state['dataset_id'])
+        self.__dict__.update(state)
+
     def save(self, file_path: str) -> None:
-        if CsvOptName.LINE_TERMINATOR in self.db_open_options:
+        if self.db_open_options and CsvOptName.LINE_TERMINATOR in self.db_open_options:
             line_terminator = self.db_open_options[CsvOptName.LINE_TERMINATOR]
             if line_terminator == '\n':
                 self.db_open_options[CsvOptName.LINE_TERMINATOR] = '\\n'
@@ -171,7 +242,7 @@ class ClassificationLabel(YamlSerializable):
     @staticmethod
     def load(file_path: str) -> 'ClassificationLabel':
         result = YamlSerializable.load(file_path)
-        if CsvOptName.LINE_TERMINATOR in result.db_open_options:
+        if result.db_open_options and CsvOptName.LINE_TERMINATOR in result.db_open_options:
             line_terminator = result.db_open_options[CsvOptName.LINE_TERMINATOR]
             if line_terminator == '\\n':
                 result.db_open_options[CsvOptName.LINE_TERMINATOR] = '\n'
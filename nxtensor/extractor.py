@@ -5,19 +5,26 @@ Created on Fri Apr 23 14:50:20 2020
 
 @author: sebastien@gardoll.fr
 """
+from types import ModuleType
 from typing import Dict, List, Mapping, Tuple, Type
 
 from nxtensor.exceptions import ConfigurationError
-from nxtensor.square_extractor import SquareRegionExtractionVisitor, RegionExtractionVisitor
+from nxtensor.square_extractor import SquareRegionExtractionVisitor, RegionExtractionVisitor, \
+    SquareBlockExtractionVisitor
 from nxtensor.utils.tensor_dimensions import TensorDimension
-from nxtensor.extraction import ExtractionShape
+from nxtensor.extraction import ExtractionShape, ExtractionMode, ReaderBackend
 from nxtensor.variable import VariableVisitor, SingleLevelVariable, MultiLevelVariable, ComputedVariable, Variable, \
     VariableNetcdfFilePathVisitor
-from nxtensor.core.types import VariableId, LabelId, MetaDataBlock, Period
+from nxtensor.core.types import VariableId, LabelId, MetaDataBlock, Period, BlockHandler
+from nxtensor.core.grid_index import GridIndex
+from nxtensor.core.read_planner import ReadStrategy
 
 import nxtensor.core.xarray_extractions as xtract
+import nxtensor.core.netcdf4_extractions as nc4tract
+import nxtensor.core.metadata_block as mdb
 import nxtensor.utils.time_utils as tu
 
+import numpy as np
 import xarray as xr
 
 
@@ -26,6 +33,17 @@ class ExtractionVisitor(VariableVisitor):
     __EXTRACTOR_FACTORY: Mapping[ExtractionShape, Type[RegionExtractionVisitor]] = \
         {ExtractionShape.SQUARE: SquareRegionExtractionVisitor}
 
+    __BLOCK_EXTRACTOR_FACTORY: Mapping[ExtractionShape, Type[SquareBlockExtractionVisitor]] = \
+        {ExtractionShape.SQUARE: SquareBlockExtractionVisitor}
+
+    __READ_STRATEGIES: Mapping[ExtractionMode, ReadStrategy] = \
+        {ExtractionMode.BATCH: ReadStrategy.BOUNDING_BOX,
+         ExtractionMode.TIME_SLICE: ReadStrategy.TIME_SLICE,
+         ExtractionMode.PLANNED: ReadStrategy.CHUNK_ALIGNED}
+
+    __READER_FACTORY: Mapping[ReaderBackend, ModuleType] = \
+        {ReaderBackend.XARRAY: xtract, ReaderBackend.NETCDF4: nc4tract}
+
     @staticmethod
     def __create_extractor(shape: ExtractionShape) -> Type[RegionExtractionVisitor]:
         try:
@@ -34,45 +52,108 @@ class ExtractionVisitor(VariableVisitor):
             msg = f"> [ERROR] unknown extraction shape '{shape}'"
             raise ConfigurationError(msg)
 
+    @staticmethod
+    def __create_block_extractor(shape: ExtractionShape) -> Type[SquareBlockExtractionVisitor]:
+        try:
+            return ExtractionVisitor.__BLOCK_EXTRACTOR_FACTORY[shape]
+        except KeyError:
+            msg = f"> [ERROR] unknown extraction shape '{shape}'"
+            raise ConfigurationError(msg)
+
+    @staticmethod
+    def __create_reader(reader_backend: ReaderBackend) -> ModuleType:
+        try:
+            return ExtractionVisitor.__READER_FACTORY[reader_backend]
+        except KeyError:
+            msg = f"> [ERROR] unknown reader backend '{reader_backend}'"
+            raise ConfigurationError(msg)
+
     def __init__(self, period: Period, extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]],
                  half_lat_frame: int,
                  half_lon_frame: int, dask_scheduler: str = 'single-threaded',
-                 shape: ExtractionShape = ExtractionShape.SQUARE):
+                 shape: ExtractionShape = ExtractionShape.SQUARE,
+                 mode: ExtractionMode = ExtractionMode.PLANNED,
+                 reader_backend: ReaderBackend = ReaderBackend.XARRAY,
+                 block_handler: BlockHandler = None):
         self.__period: Period = period
         self.__extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]] = extraction_metadata_blocks
         self.__half_lat_frame: int = half_lat_frame
         self.__half_lon_frame: int = half_lon_frame
         self.__dask_scheduler: str = dask_scheduler
         self.__shape: ExtractionShape = shape
+        self.__mode: ExtractionMode = mode
+        self.__reader: ModuleType = ExtractionVisitor.__create_reader(reader_backend)
+        # When a block handler is given, the extracted data blocks are handed over one by one instead of being
+        # accumulated in the result: only one block is held in memory at a time.
+        self.__block_handler: BlockHandler = block_handler
         self.result: List[Tuple[LabelId, xr.DataArray, MetaDataBlock]] = list()
 
-    def __core_extraction(self, var: Variable, datasets: Mapping[VariableId, xr.Dataset]) -> None:
+    def __row_extraction(self, var: Variable, datasets: Mapping[VariableId, xr.Dataset],
+                         grid_indexes: Dict[VariableId, GridIndex],
+                         extraction_metadata_block: MetaDataBlock) -> np.ndarray:
+        # noinspection PyTypeChecker
+        extracted_regions: np.ndarray = None
+        # The order of extraction_data_list must be deterministic so as all the channel
+        # match their extracted region line by line.
+        for index, extraction_data in enumerate(mdb.to_records(extraction_metadata_block)):
+            extractor = ExtractionVisitor.__create_extractor(self.__shape)(datasets=datasets,
+                                                                           extraction_data=extraction_data,
+                                                                           half_lat_frame=self.__half_lat_frame,
+                                                                           half_lon_frame=self.__half_lon_frame,
+                                                                           dask_scheduler=self.__dask_scheduler,
+                                                                           grid_indexes=grid_indexes,
+                                                                           reader=self.__reader)
+            var.accept(extractor)
+            region = extractor.get_result()
+            if extracted_regions is None:
+                # The regions are written straight into a buffer allocated once their shape and type are known.
+                extracted_regions = np.empty((len(extraction_metadata_block),) + region.shape, dtype=region.dtype)
+            extracted_regions[index] = region
+        return extracted_regions
+
+    def __block_extraction(self, var: Variable, datasets: Mapping[VariableId, xr.Dataset],
+                           grid_indexes: Dict[VariableId, GridIndex],
+                           extraction_metadata_block: MetaDataBlock) -> np.ndarray:
+        extractor = ExtractionVisitor.__create_block_extractor(self.__shape)(
+            datasets=datasets,
+            extraction_metadata_block=extraction_metadata_block,
+            half_lat_frame=self.__half_lat_frame,
+            half_lon_frame=self.__half_lon_frame,
+            dask_scheduler=self.__dask_scheduler,
+            grid_indexes=grid_indexes,
+            read_strategy=ExtractionVisitor.__READ_STRATEGIES[self.__mode],
+            reader=self.__reader)
+        var.accept(extractor)
+        return extractor.get_result()
 
+    def __core_extraction(self, var: Variable, datasets: Mapping[VariableId, xr.Dataset]) -> None:
+        # The grid indexes are computed once per dataset, then shared by all the extractions of the period.
+        grid_indexes: Dict[VariableId, GridIndex] = dict()
         for label_id, extraction_metadata_block in self.__extraction_metadata_blocks:
-            extracted_regions: List[xr.DataArray] = list()
-            # The order of extraction_data_list must be deterministic so as all the channel
-            # match their extracted region line by line.
-            for extraction_data in extraction_metadata_block:
-                extractor = ExtractionVisitor.__create_extractor(self.__shape)(datasets=datasets,
-                                                                               extraction_data=extraction_data,
-                                                                               half_lat_frame=self.__half_lat_frame,
-                                                                               half_lon_frame=self.__half_lon_frame,
-                                                                               dask_scheduler=self.__dask_scheduler)
-                var.accept(extractor)
-                extracted_regions.append(extractor.get_result())
-
-            # dims are lost when instantiating a DataArray based on other DataArray objects.
+            if self.__mode == ExtractionMode.ROW:
+                extracted_regions = self.__row_extraction(var, datasets, grid_indexes, extraction_metadata_block)
+            elif self.__mode in ExtractionVisitor.__READ_STRATEGIES:
+                extracted_regions = self.__block_extraction(var, datasets, grid_indexes,
+                                                            extraction_metadata_block)
+            else:
+                msg = f"> [ERROR] unknown extraction mode '{self.__mode}'"
+                raise ConfigurationError(msg)
+
             dims = (var.str_id, TensorDimension.X, TensorDimension.Y)
-            # Stack the extracted regions in a xarray data array => data extraction_metadata_blocks.
+            # Wrap the (N, y, x) buffer of the extracted regions, without copy => data extraction_metadata_blocks.
             data = xr.DataArray(extracted_regions, dims=dims)
-            self.result.append((label_id, data, extraction_metadata_block))
+            if self.__block_handler is None:
+                self.result.append((label_id, data, extraction_metadata_block))
+            else:
+                self.__block_handler(label_id, data, extraction_metadata_block)
+            del data, extracted_regions
 
         [dataset.close() for dataset in datasets.values()]
 
     def visit_single_level_variable(self, var: SingleLevelVariable) -> None:
         time_dict = tu.from_time_list_to_dict(self.__period)
         netcdf_file_path = var.compute_netcdf_file_path(time_dict)
-        datasets = {var.str_id: xtract.open_netcdf(netcdf_file_path)}
+        datasets = {var.str_id: self.__reader.open_netcdf(netcdf_file_path)}
         self.__core_extraction(var, datasets)
 
     def visit_multi_level_variable(self, var: MultiLevelVariable) -> None:
@@ -84,7 +165,7 @@ class ExtractionVisitor(VariableVisitor):
         var.accept(visitor)
         datasets: Dict[VariableId, xr.Dataset] = dict()
         for var_id, netcdf_file_path in visitor.result.items():
-            datasets[var_id] = xtract.open_netcdf(netcdf_file_path)
+            datasets[var_id] = self.__reader.open_netcdf(netcdf_file_path)
         self.__core_extraction(var, datasets)
 
     def get_result(self) -> List[Tuple[LabelId, xr.DataArray, MetaDataBlock]]:
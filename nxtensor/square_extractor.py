@@ -6,24 +6,30 @@ Created on Fri Apr 17 17:00:00 2020
 @author: sebastien@gardoll.fr
 """
 from abc import abstractmethod
-from typing import Dict, Union, Mapping
+from types import ModuleType
+from typing import Dict, Union, Mapping, Sequence, Tuple
 
+import numpy as np
 import xarray as xr
 import nxtensor.core.xarray_extractions as xtract
+import nxtensor.core.metadata_block as mdb
 import nxtensor.utils.naming_utils
 from nxtensor.utils.coordinates import Coordinate
 from nxtensor.utils.time_resolutions import TimeResolution
 from nxtensor.utils.xarray_rpn_calulator import XarrayRpnCalculator
 from nxtensor.variable import MultiLevelVariable, SingleLevelVariable, ComputedVariable, \
     VariableNetcdfFilePathVisitor, Variable, VariableVisitor
-from nxtensor.core.types import VariableId
+from nxtensor.core.types import VariableId, MetaDataBlock
+from nxtensor.core.grid_index import GridIndex
+from nxtensor.core.read_planner import ReadStrategy
 
 
 class RegionExtractionVisitor(VariableVisitor):
     @abstractmethod
     def __init__(self, datasets: Mapping[VariableId, xr.Dataset],
                  extraction_data: Mapping[Union[Coordinate, TimeResolution], Union[int, float]],
-                 half_lat_frame: int, half_lon_frame: int, dask_scheduler: str = 'single-threaded'):
+                 half_lat_frame: int, half_lon_frame: int, dask_scheduler: str = 'single-threaded',
+                 grid_indexes: Dict[VariableId, GridIndex] = None, reader: ModuleType = xtract):
         # Buffer of extracted regions: optimization for computed variables.
         # Computed variables may contain computed variables, recursively !
         self._extracted_regions: Dict[VariableId, xr.DataArray] = dict()
@@ -32,63 +38,81 @@ class RegionExtractionVisitor(VariableVisitor):
         self._half_lat_frame: int = half_lat_frame
         self._half_lon_frame: int = half_lon_frame
         self._dask_scheduler: str = dask_scheduler
+        # Grid indexes of the datasets, computed once per dataset and shared between the extractors.
+        self._grid_indexes: Dict[VariableId, GridIndex] = dict() if grid_indexes is None else grid_indexes
+        # The module that reads the datasets: xarray_extractions or netcdf4_extractions.
+        self._reader: ModuleType = reader
         self._recursive_call_count: int = 0
         # noinspection PyTypeChecker
         self._result: xr.DataArray = None
 
+    def _get_grid_index(self, var: Variable) -> GridIndex:
+        if var.str_id not in self._grid_indexes:
+            self._grid_indexes[var.str_id] = self._reader.create_grid_index(self._datasets[var.str_id],
+                                                                            var.lat_resolution, var.lon_resolution,
+                                                                            var.time_netcdf_attr_name,
+                                                                            var.lat_netcdf_attr_name,
+                                                                            var.lon_netcdf_attr_name)
+        return self._grid_indexes[var.str_id]
+
 
 class SquareRegionExtractionVisitor(RegionExtractionVisitor):
 
     def __init__(self, datasets: Mapping[VariableId, xr.Dataset],
                  extraction_data: Mapping[Union[Coordinate, TimeResolution], Union[int, float]], half_lat_frame: int,
-                 half_lon_frame: int, dask_scheduler: str = 'single-threaded'):
-        super().__init__(datasets, extraction_data, half_lat_frame, half_lon_frame, dask_scheduler)
+                 half_lon_frame: int, dask_scheduler: str = 'single-threaded',
+                 grid_indexes: Dict[VariableId, GridIndex] = None, reader: ModuleType = xtract):
+        super().__init__(datasets, extraction_data, half_lat_frame, half_lon_frame, dask_scheduler, grid_indexes,
+                         reader)
 
     def __bootstrap(self, var: SingleLevelVariable) -> str:
-        # month2d, day2d and hour2d are computed when calling convert_block_to_dict function from module
-        # xarray_channel_extraction.
+        # month2d, day2d and hour2d are computed when calling create_metadata_block function from module
+        # metadata_block.
         formatted_date = var.date_template.format(**self._extraction_data)
         return formatted_date
 
     def visit_single_level_variable(self, var: SingleLevelVariable) -> None:
         if var.str_id not in self._extracted_regions:
             formatted_date = self.__bootstrap(var)
-            self._result = xtract.extract_square_region(dataset=self._datasets[var.str_id],
-                                                        variable_netcdf_attr_name=var.netcdf_attr_name,
-                                                        formatted_date=formatted_date,
-                                                        lat=self._extraction_data[Coordinate.LAT],
-                                                        lat_resolution=var.lat_resolution,
-                                                        half_lat_frame=self._half_lat_frame,
-                                                        lon=self._extraction_data[Coordinate.LON],
-                                                        lon_resolution=var.lon_resolution,
-                                                        half_lon_frame=self._half_lon_frame,
-                                                        time_netcdf_attr_name=var.time_netcdf_attr_name,
-                                                        lat_netcdf_attr_name=var.lat_netcdf_attr_name,
-                                                        lon_netcdf_attr_name=var.lon_netcdf_attr_name,
-                                                        has_to_round=True, lat_nb_decimal=var.lat_nb_decimal,
-                                                        lon_nb_decimal=var.lon_nb_decimal,
-                                                        dask_scheduler=self._dask_scheduler)
+            self._result = self._reader.extract_square_region(dataset=self._datasets[var.str_id],
+                                                              variable_netcdf_attr_name=var.netcdf_attr_name,
+                                                              formatted_date=formatted_date,
+                                                              lat=self._extraction_data[Coordinate.LAT],
+                                                              lat_resolution=var.lat_resolution,
+                                                              half_lat_frame=self._half_lat_frame,
+                                                              lon=self._extraction_data[Coordinate.LON],
+                                                              lon_resolution=var.lon_resolution,
+                                                              half_lon_frame=self._half_lon_frame,
+                                                              time_netcdf_attr_name=var.time_netcdf_attr_name,
+                                                              lat_netcdf_attr_name=var.lat_netcdf_attr_name,
+                                                              lon_netcdf_attr_name=var.lon_netcdf_attr_name,
+                                                              has_to_round=True, lat_nb_decimal=var.lat_nb_decimal,
+                                                              lon_nb_decimal=var.lon_nb_decimal,
+                                                              dask_scheduler=self._dask_scheduler,
+                                                              grid_index=self._get_grid_index(var))
             self._extracted_regions[var.str_id] = self._result
 
     def visit_multi_level_variable(self, var: MultiLevelVariable) -> None:
         if var.str_id not in self._extracted_regions:
             formatted_date = self.__bootstrap(var)
-            self._result = xtract.extract_square_region(dataset=self._datasets[var.str_id],
-                                                        variable_netcdf_attr_name=var.netcdf_attr_name,
-                                                        formatted_date=formatted_date,
-                                                        lat=self._extraction_data[Coordinate.LAT],
-                                                        lat_resolution=var.lat_resolution,
-                                                        half_lat_frame=self._half_lat_frame,
-                                                        lon=self._extraction_data[Coordinate.LON],
-                                                        lon_resolution=var.lon_resolution,
-                                                        half_lon_frame=self._half_lon_frame, variable_level=var.level,
-                                                        level_netcdf_attr_name=var.level_netcdf_attr_name,
-                                                        time_netcdf_attr_name=var.time_netcdf_attr_name,
-                                                        lat_netcdf_attr_name=var.lat_netcdf_attr_name,
-                                                        lon_netcdf_attr_name=var.lon_netcdf_attr_name,
-                                                        has_to_round=True, lat_nb_decimal=var.lat_nb_decimal,
-                                                        lon_nb_decimal=var.lon_nb_decimal,
-                                                        dask_scheduler=self._dask_scheduler)
+            self._result = self._reader.extract_square_region(dataset=self._datasets[var.str_id],
+                                                              variable_netcdf_attr_name=var.netcdf_attr_name,
+                                                              formatted_date=formatted_date,
+                                                              lat=self._extraction_data[Coordinate.LAT],
+                                                              lat_resolution=var.lat_resolution,
+                                                              half_lat_frame=self._half_lat_frame,
+                                                              lon=self._extraction_data[Coordinate.LON],
+                                                              lon_resolution=var.lon_resolution,
+                                                              half_lon_frame=self._half_lon_frame,
+                                                              variable_level=var.level,
+                                                              level_netcdf_attr_name=var.level_netcdf_attr_name,
+                                                              time_netcdf_attr_name=var.time_netcdf_attr_name,
+                                                              lat_netcdf_attr_name=var.lat_netcdf_attr_name,
+                                                              lon_netcdf_attr_name=var.lon_netcdf_attr_name,
+                                                              has_to_round=True, lat_nb_decimal=var.lat_nb_decimal,
+                                                              lon_nb_decimal=var.lon_nb_decimal,
+                                                              dask_scheduler=self._dask_scheduler,
+                                                              grid_index=self._get_grid_index(var))
             self._extracted_regions[var.str_id] = self._result
 
     def visit_computed_variable(self, var: ComputedVariable) -> None:
@@ -114,6 +138,82 @@ class SquareRegionExtractionVisitor(RegionExtractionVisitor):
         return self._result
 
 
+class SquareBlockExtractionVisitor(RegionExtractionVisitor):
+
+    # Extract the regions of all the rows of a block of extraction metadata at once
+    # (see xarray_extractions.extract_square_regions), instead of one row at a time.
+    # The read strategy sets how the data is read from the NetCDF files (see read_planner).
+    def __init__(self, datasets: Mapping[VariableId, xr.Dataset], extraction_metadata_block: MetaDataBlock,
+                 half_lat_frame: int, half_lon_frame: int, dask_scheduler: str = 'single-threaded',
+                 grid_indexes: Dict[VariableId, GridIndex] = None,
+                 read_strategy: ReadStrategy = ReadStrategy.BOUNDING_BOX, reader: ModuleType = xtract):
+        # The rows are given by the block, not by the extraction data.
+        super().__init__(datasets, None, half_lat_frame, half_lon_frame, dask_scheduler, grid_indexes, reader)
+        self._extraction_metadata_block: MetaDataBlock = extraction_metadata_block
+        self._read_strategy: ReadStrategy = read_strategy
+
+    def __bootstrap(self, var: SingleLevelVariable) -> Tuple[Sequence[str], Sequence[float], Sequence[float]]:
+        # month2d, day2d and hour2d are computed when calling create_metadata_block function from module
+        # metadata_block. The dates are formatted column-wise.
+        formatted_dates = mdb.format_template(var.date_template, self._extraction_metadata_block)
+        lats, lons = mdb.get_coordinates(self._extraction_metadata_block)
+        return formatted_dates, lats, lons
+
+    def __extract(self, var: SingleLevelVariable, variable_level: int = None, level_netcdf_attr_name: str = 'level') \
+            -> None:
+        formatted_dates, lats, lons = self.__bootstrap(var)
+        regions = self._reader.extract_square_regions(dataset=self._datasets[var.str_id],
+                                                      variable_netcdf_attr_name=var.netcdf_attr_name,
+                                                      formatted_dates=formatted_dates,
+                                                      lats=lats,
+                                                      lat_resolution=var.lat_resolution,
+                                                      half_lat_frame=self._half_lat_frame,
+                                                      lons=lons,
+                                                      lon_resolution=var.lon_resolution,
+                                                      half_lon_frame=self._half_lon_frame,
+                                                      variable_level=variable_level,
+                                                      level_netcdf_attr_name=level_netcdf_attr_name,
+                                                      time_netcdf_attr_name=var.time_netcdf_attr_name,
+                                                      lat_netcdf_attr_name=var.lat_netcdf_attr_name,
+                                                      lon_netcdf_attr_name=var.lon_netcdf_attr_name,
+                                                      has_to_round=True, lat_nb_decimal=var.lat_nb_decimal,
+                                                      lon_nb_decimal=var.lon_nb_decimal,
+                                                      dask_scheduler=self._dask_scheduler,
+                                                      grid_index=self._get_grid_index(var),
+                                                      read_strategy=self._read_strategy)
+        self._result = xr.DataArray(regions)
+        self._extracted_regions[var.str_id] = self._result
+
+    def visit_single_level_variable(self, var: SingleLevelVariable) -> None:
+        if var.str_id not in self._extracted_regions:
+            self.__extract(var)
+
+    def visit_multi_level_variable(self, var: MultiLevelVariable) -> None:
+        if var.str_id not in self._extracted_regions:
+            self.__extract(var, var.level, var.level_netcdf_attr_name)
+
+    def visit_computed_variable(self, var: ComputedVariable) -> None:
+        if var.str_id not in self._extracted_regions:
+            self._recursive_call_count = self._recursive_call_count + 1
+            for internal_var in var.get_variables().values():
+                internal_var.accept(self)
+
+            # The operations of the calculator are element-wise: they apply to a block of regions as well.
+            calculator = XarrayRpnCalculator(var.computation_expression, self._extracted_regions,
+                                             self._dask_scheduler)
+            self._result = calculator.compute()
+            self._extracted_regions[var.str_id] = self._result
+            self._recursive_call_count = self._recursive_call_count - 1
+
+        if self._recursive_call_count == 0:
+            # See SquareRegionExtractionVisitor.visit_computed_variable.
+            self._extracted_regions.clear()
+
+    def get_result(self) -> np.ndarray:
+        self._extracted_regions.clear()
+        return np.asarray(self._result)
+
+
 def __test_create_extraction_data(lat: float, lon: float, year: int, month: int, day: int, hour: int) \
                              -> Mapping[Union[Coordinate, TimeResolution], Union[int, float]]:
     result = {Coordinate.LAT: lat, Coordinate.LON: lon, TimeResolution.YEAR: year, TimeResolution.MONTH: month,
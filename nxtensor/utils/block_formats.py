@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 09:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+
+class BlockFormat:
+
+    CSV  = 'csv'   # The data in a HDF5 file, the metadata in a CSV file.
+    # The data and the metadata (a compound dataset) in the same HDF5 file: the number of rows of a block is read
+    # from the shape of its datasets and the metadata is read without parsing (see hdf5_utils).
+    HDF5 = 'hdf5'
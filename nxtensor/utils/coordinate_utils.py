@@ -6,104 +6,99 @@ Created on Thu Mar 28 16:14:08 2019
 @author: sebastien@gardoll.fr
 """
 
-import math
+from typing import Callable, Mapping
+
+from nxtensor.exceptions import ConfigurationError
 from nxtensor.utils.coordinates import CoordinateFormat
 import numpy as np
 import pandas as pd
 
 
-__CONVERT_MAPPING = dict()
-
-
 def round_nearest(value, resolution, num_decimal):
     return round(round(value / resolution) * resolution, num_decimal)
 
 
+# Vectorized version of round_nearest (half to even as well).
+def round_nearest_array(values: np.ndarray, resolution: float, num_decimal: int) -> np.ndarray:
+    return np.round(np.round(values / resolution) * resolution, num_decimal)
+
+
+# Round the given column of the dataframe to the given resolution and convert it from a format to another
+# (see convert_coordinates).
 def reformat_coordinates(dataframe: pd.DataFrame, column_name: str, from_format: CoordinateFormat,
                          to_format: CoordinateFormat, resolution: float, nb_decimal_to_round: int):
-    coordinate_mapping = __get_convert_mapping(from_format, to_format, resolution)
-
-    # Update the format of the coordinate.
-    def __convert_coordinates(value):
-        rounded_value = round_nearest(value, resolution, nb_decimal_to_round)
-        return coordinate_mapping[rounded_value]
-
-    dataframe[column_name] = np.vectorize(__convert_coordinates)(dataframe[column_name])
-
-
-def __get_convert_mapping(from_format, to_format, resolution):
-    if from_format in __CONVERT_MAPPING:
-        from_format_dict = __CONVERT_MAPPING[from_format]
-        if to_format in from_format_dict:
-            to_format_dict = from_format_dict[to_format]
-            if resolution in to_format_dict:
-                return to_format_dict[resolution]
-            else:
-                return __compute_mapping(from_format, to_format, resolution, to_format_dict)
-        else:
-            to_format_dict = dict()
-            from_format_dict[to_format] = to_format_dict
-            return __compute_mapping(from_format, to_format, resolution, to_format_dict)
-    else:
-        from_format_dict = dict()
-        __CONVERT_MAPPING[from_format] = from_format_dict
-        to_format_dict = dict()
-        from_format_dict[to_format] = to_format_dict
-        return __compute_mapping(from_format, to_format, resolution, to_format_dict)
-
-
-def __compute_mapping(from_format, to_format, resolution, parent_mapping):
+    dataframe[column_name] = convert_coordinates(dataframe[column_name].to_numpy(), from_format, to_format,
+                                                 resolution, nb_decimal_to_round)
+
+
+# Round the given coordinates to the given resolution and convert them from a format to another, by array
+# arithmetic (any resolution).
+# The increasing and decreasing degree north formats only differ in the order of the latitudes of the grid:
+# the values of the coordinates are the same.
+def convert_coordinates(values: np.ndarray, from_format: CoordinateFormat, to_format: CoordinateFormat,
+                        resolution: float, nb_decimal_to_round: int) -> np.ndarray:
     try:
-        result = __GENERATOR[from_format][to_format](resolution)
-        parent_mapping[resolution] = result
-        return result
-    except Exception:
-        msg = f"the conversion of coordinates from '{from_format}' to '{to_format}' is not supported"
-        raise Exception(msg)
-
-
-def __generate_mapping_degrees_north_inc_to_dec(resolution):
-    values = __generate_float_range(-90, 90, resolution)
-    keys   = values
-    return dict(zip(keys, values))
-
-
-def __generate_mapping_degrees_east_m_180_to_0(resolution):
-    dest_values = __generate_float_range(0, 360, resolution)
-    keys_1 = __generate_float_range(0, (180 + resolution), resolution)
-    keys_2 = __generate_float_range((-180 + resolution), 0, resolution)
-    result = dict()
-    index = 0
-    for key in keys_1:
-        result[key] = dest_values[index]
-        index = index + 1
-    for key in keys_2:
-        result[key] = dest_values[index]
-        index = index + 1
-    return result
-
-
-def __generate_float_range(start, stop, resolution):
-    if resolution < 1:
-        nb_decimal = len(str(resolution)) - 2  # -2 for the zero and the dot.
-        factor = math.pow(10, nb_decimal)
-        int_range = range(int(start*factor), int(stop*factor), int(resolution*factor))
-        result = list()
-        for value in int_range:
-            result.append(value/100)
-        return result
-    else:
-        return range(start, stop, resolution)
-
-
-__GENERATOR = {
+        converter = __get_converter(from_format, to_format)
+    except KeyError:
+        msg = f"> [ERROR] the conversion of coordinates from '{from_format}' to '{to_format}' is not supported"
+        raise ConfigurationError(msg)
+    rounded_values = round_nearest_array(np.asarray(values, dtype=np.float64), resolution, nb_decimal_to_round)
+    # The wrapping may introduce floating-point errors (e.g. -0.1 + 360).
+    return np.round(converter(rounded_values), nb_decimal_to_round)
+
+
+def __get_converter(from_format: CoordinateFormat, to_format: CoordinateFormat) \
+        -> Callable[[np.ndarray], np.ndarray]:
+    if from_format == to_format:
+        return __identity
+    return __CONVERTERS[from_format][to_format]
+
+
+def __identity(values: np.ndarray) -> np.ndarray:
+    return values
+
+
+# From [-180, 180] to [0, 360[: -180 is 180.
+def __convert_degrees_east_m_180_to_0(values: np.ndarray) -> np.ndarray:
+    return np.mod(values, 360.)
+
+
+# From [0, 360] to ]-180, 180]: 360 is 0.
+def __convert_degrees_east_0_to_m_180(values: np.ndarray) -> np.ndarray:
+    wrapped_values = np.mod(values, 360.)
+    return np.where(wrapped_values > 180., wrapped_values - 360., wrapped_values)
+
+
+__CONVERTERS: Mapping[CoordinateFormat, Mapping[CoordinateFormat, Callable[[np.ndarray], np.ndarray]]] = {
     CoordinateFormat.M_180_TO_180_DEGREE_EAST: {
-         CoordinateFormat.ZERO_TO_360_DEGREE_EAST: __generate_mapping_degrees_east_m_180_to_0},
+         CoordinateFormat.ZERO_TO_360_DEGREE_EAST: __convert_degrees_east_m_180_to_0},
+    CoordinateFormat.ZERO_TO_360_DEGREE_EAST: {
+         CoordinateFormat.M_180_TO_180_DEGREE_EAST: __convert_degrees_east_0_to_m_180},
     CoordinateFormat.INCREASING_DEGREE_NORTH: {
-         CoordinateFormat.DECREASING_DEGREE_NORTH: __generate_mapping_degrees_north_inc_to_dec}
+         CoordinateFormat.DECREASING_DEGREE_NORTH: __identity},
+    CoordinateFormat.DECREASING_DEGREE_NORTH: {
+         CoordinateFormat.INCREASING_DEGREE_NORTH: __identity}
     }
 
 
+def __test_convert_coordinates():
+    lons = np.array([-180., -179.9, -90.12, -0.1, 0., 0.04, 90.26, 179.9, 180.])
+    converted_lons = convert_coordinates(lons, CoordinateFormat.M_180_TO_180_DEGREE_EAST,
+                                         CoordinateFormat.ZERO_TO_360_DEGREE_EAST, 0.25, 2)
+    assert list(converted_lons) == [180., 180., 270., 0., 0., 0., 90.25, 180., 180.]
+    converted_lons = convert_coordinates(lons, CoordinateFormat.M_180_TO_180_DEGREE_EAST,
+                                         CoordinateFormat.ZERO_TO_360_DEGREE_EAST, 0.1, 1)
+    assert list(converted_lons) == [180., 180.1, 269.9, 359.9, 0., 0., 90.3, 179.9, 180.]
+    assert list(convert_coordinates(converted_lons, CoordinateFormat.ZERO_TO_360_DEGREE_EAST,
+                                    CoordinateFormat.M_180_TO_180_DEGREE_EAST, 0.1, 1)) == \
+        [180., -179.9, -90.1, -0.1, 0., 0., 90.3, 179.9, 180.]
+    lats = np.array([-90., -12.3, 0.126, 89.99])
+    assert list(convert_coordinates(lats, CoordinateFormat.INCREASING_DEGREE_NORTH,
+                                    CoordinateFormat.DECREASING_DEGREE_NORTH, 0.25, 2)) == [-90., -12.25, 0.25, 90.]
+    assert list(convert_coordinates(lats, CoordinateFormat.INCREASING_DEGREE_NORTH,
+                                    CoordinateFormat.INCREASING_DEGREE_NORTH, 1., 0)) == [-90., -12., 0., 90.]
+
+
 def __test_reformat_coordinates(dataframe_file_path: str):
     df = pd.read_csv(filepath_or_buffer=dataframe_file_path, sep=',', header=0)
     reformat_coordinates(df, 'lat', CoordinateFormat.INCREASING_DEGREE_NORTH, CoordinateFormat.DECREASING_DEGREE_NORTH,
@@ -116,6 +111,8 @@ def __test_reformat_coordinates(dataframe_file_path: str):
 
 
 def __all_tests():
+    __test_convert_coordinates()
+
     import os.path as path
     dataframes_dir_path = '/data/sgardoll/cyclone_data/dataset'
 
@@ -9,4 +9,8 @@ Created on Wed Apr  22 17:06:18 2020
 
 class DBType:
 
-    CSV = 'csv'
+    CSV     = 'csv'
+    # Columnar formats: only the columns of interest are read and the filters of the rows are pushed down into
+    # the read (requires pyarrow, see db_utils).
+    PARQUET = 'parquet'
+    FEATHER = 'feather'
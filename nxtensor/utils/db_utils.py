@@ -5,10 +5,13 @@ Created on Fri Apr 24 11:01:15 2020
 @author: sebastien@gardoll.fr
 """
 
-from typing import Callable, Mapping
+from typing import Callable, Iterator, List, Mapping, Sequence, Tuple
+import operator
+import numpy as np
 import pandas as pd
 
 from nxtensor.core.types import DBMetadataMapping
+from nxtensor.exceptions import ConfigurationError
 from nxtensor.utils.coordinates import Coordinate
 from nxtensor.utils.csv_option_names import CsvOptName
 from nxtensor.utils.csv_utils import DEFAULT_CSV_OPTIONS
@@ -30,18 +33,215 @@ def save_to_csv_file(data: pd.DataFrame, csv_file_path: str, options: Mapping[Cs
         raise Exception(msg, e)
 
 
-def load_csv_file(csv_file_path: str, options: Mapping[CsvOptName, any] = DEFAULT_CSV_OPTIONS)\
-                  -> pd.DataFrame:
+# Predicates in disjunctive normal form: a list of conjunctions of (column name, operator, value).
+Predicates = List[List[Tuple[str, str, any]]]
+
+__OPERATORS = {'==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt,
+               '>=': operator.ge}
+
+
+class DBRowFilter:
+
+    # Keep the rows of a db that are within the given time range and bounding box (inclusive bounds, None for
+    # unbounded). The dates are ISO 8601 strings (e.g. '2000-10-01' or '2000-10-31T18'). The bounding box is
+    # (lat_min, lat_max, lon_min, lon_max) in the coordinates of the db: lon_min greater than lon_max means that the
+    # box crosses the longitude edge (e.g. (0, 40, 340, 20)).
+    def __init__(self, db_metadata_mapping: DBMetadataMapping, start_date: str = None, end_date: str = None,
+                 bounding_box: Sequence[float] = None):
+        self.db_metadata_mapping: DBMetadataMapping = db_metadata_mapping
+        self.start_date: pd.Timestamp = None if start_date is None else pd.Timestamp(start_date)
+        self.end_date: pd.Timestamp = None if end_date is None else pd.Timestamp(end_date)
+        self.bounding_box: Sequence[float] = bounding_box
+        if self.start_date is not None and self.end_date is not None and self.start_date > self.end_date:
+            msg = f"> [ERROR] the start date '{start_date}' is after the end date '{end_date}'"
+            raise ConfigurationError(msg)
+        if self.bounding_box is not None and len(self.bounding_box) != 4:
+            msg = f"> [ERROR] the bounding box '{bounding_box}' is not (lat_min, lat_max, lon_min, lon_max)"
+            raise ConfigurationError(msg)
+
+    def is_empty(self) -> bool:
+        return self.start_date is None and self.end_date is None and self.bounding_box is None
+
+    # Return the predicates that can be evaluated by the reader of a columnar db (None if there is none). The time
+    # range is only pushed down on the years (the time is split over several columns): compute_mask is exact.
+    def compute_pushdown_predicates(self) -> Predicates:
+        conjunction: List[Tuple[str, str, any]] = list()
+        year_column = self.db_metadata_mapping.get(TimeResolution.YEAR, None)
+        if year_column is not None:
+            if self.start_date is not None:
+                conjunction.append((year_column, '>=', self.start_date.year))
+            if self.end_date is not None:
+                conjunction.append((year_column, '<=', self.end_date.year))
+        if self.bounding_box is None:
+            return [conjunction] if conjunction else None
+
+        lat_min, lat_max, lon_min, lon_max = self.bounding_box
+        lat_column = self.db_metadata_mapping[Coordinate.LAT]
+        lon_column = self.db_metadata_mapping[Coordinate.LON]
+        conjunction.extend([(lat_column, '>=', lat_min), (lat_column, '<=', lat_max)])
+        if lon_min <= lon_max:
+            return [conjunction + [(lon_column, '>=', lon_min), (lon_column, '<=', lon_max)]]
+        else:
+            return [conjunction + [(lon_column, '>=', lon_min)], conjunction + [(lon_column, '<=', lon_max)]]
+
+    # Return the mask of the rows of the given dataframe that pass the filter.
+    def compute_mask(self, dataframe: pd.DataFrame) -> np.ndarray:
+        result = np.ones(len(dataframe), dtype=bool)
+        if self.start_date is not None or self.end_date is not None:
+            # The missing time resolutions take their first value (e.g. the first day of the month).
+            time_columns = {key: dataframe[column_name] for key, column_name in self.db_metadata_mapping.items()
+                            if key in (TimeResolution.YEAR, TimeResolution.MONTH, TimeResolution.DAY,
+                                       TimeResolution.HOUR)}
+            time_columns.setdefault(TimeResolution.MONTH, 1)
+            time_columns.setdefault(TimeResolution.DAY, 1)
+            dates = pd.to_datetime(pd.DataFrame(time_columns, index=dataframe.index)).to_numpy()
+            if self.start_date is not None:
+                result &= dates >= self.start_date.to_datetime64()
+            if self.end_date is not None:
+                result &= dates <= self.end_date.to_datetime64()
+        if self.bounding_box is not None:
+            lat_min, lat_max, lon_min, lon_max = self.bounding_box
+            lats = dataframe[self.db_metadata_mapping[Coordinate.LAT]].to_numpy()
+            lons = dataframe[self.db_metadata_mapping[Coordinate.LON]].to_numpy()
+            result &= (lats >= lat_min) & (lats <= lat_max)
+            if lon_min <= lon_max:
+                result &= (lons >= lon_min) & (lons <= lon_max)
+            else:
+                result &= (lons >= lon_min) | (lons <= lon_max)
+        return result
+
+    def apply(self, dataframe: pd.DataFrame) -> pd.DataFrame:
+        if self.is_empty():
+            return dataframe
+        return dataframe[self.compute_mask(dataframe)].reset_index(drop=True)
+
+
+# Only the given columns are read (all of them if None). The rows that don't pass the given filter are dropped.
+def load_csv_file(csv_file_path: str, options: Mapping[CsvOptName, any] = DEFAULT_CSV_OPTIONS,
+                  columns: Sequence[str] = None, row_filter: DBRowFilter = None) -> pd.DataFrame:
+    options = dict(DEFAULT_CSV_OPTIONS if options is None else options)
+    if columns is not None and 'usecols' not in options:
+        options['usecols'] = columns
     with open(csv_file_path, 'r') as db_file:
         try:
             result = pd.read_csv(filepath_or_buffer=db_file, **options)
-            return result
         except Exception as e:
             msg = f"error while loading cvs file '{csv_file_path}' with options {options}"
             raise Exception(msg, e)
+    return result if row_filter is None else row_filter.apply(result)
+
+
+# The options are the ones of pyarrow.dataset.dataset (e.g. partitioning='hive' for a directory of Parquet files
+# partitioned by year). The column selection and the predicates of the filter are pushed down into the read:
+# the row groups (or partitions) that can't pass the filter are skipped.
+def load_parquet_file(parquet_file_path: str, options: Mapping[str, any] = None, columns: Sequence[str] = None,
+                      row_filter: DBRowFilter = None) -> pd.DataFrame:
+    return __load_arrow_file(parquet_file_path, 'parquet', options, columns, row_filter)
+
 
+# Same as load_parquet_file, for Feather (Arrow IPC) files, which are memory-mapped.
+def load_feather_file(feather_file_path: str, options: Mapping[str, any] = None, columns: Sequence[str] = None,
+                      row_filter: DBRowFilter = None) -> pd.DataFrame:
+    return __load_arrow_file(feather_file_path, 'feather', options, columns, row_filter)
 
-def get_dataframe_load_function(db_type: DBType) -> Callable[[str, Mapping[CsvOptName, any]], pd.DataFrame]:
+
+def __load_arrow_file(file_path: str, file_format: str, options: Mapping[str, any], columns: Sequence[str],
+                      row_filter: DBRowFilter) -> pd.DataFrame:
+    try:
+        import pyarrow.dataset as ds
+    except ImportError as e:
+        msg = f"> [ERROR] the {file_format} db format requires pyarrow"
+        raise ConfigurationError(msg, e)
+    options = dict() if options is None else dict(options)
+    predicates = None if row_filter is None else row_filter.compute_pushdown_predicates()
+    try:
+        dataset = ds.dataset(file_path, format=file_format, **options)
+        table = dataset.to_table(columns=None if columns is None else list(columns),
+                                 filter=__to_arrow_expression(predicates))
+        result = table.to_pandas()
+    except Exception as e:
+        msg = f"error while loading {file_format} file '{file_path}' with options {options}"
+        raise Exception(msg, e)
+    # The time range is only partially pushed down.
+    return result if row_filter is None else row_filter.apply(result)
+
+
+# The number of rows of the chunks of a db read by chunk (see get_dataframe_chunks_load_function).
+DEFAULT_CHUNK_SIZE: int = 1_000_000
+
+
+# Same as load_csv_file, but the db is read by chunks of the given number of rows: the memory is bounded by a chunk.
+def iterate_csv_file(csv_file_path: str, options: Mapping[CsvOptName, any] = DEFAULT_CSV_OPTIONS,
+                     columns: Sequence[str] = None, row_filter: DBRowFilter = None,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    options = dict(DEFAULT_CSV_OPTIONS if options is None else options)
+    if columns is not None and 'usecols' not in options:
+        options['usecols'] = columns
+    with open(csv_file_path, 'r') as db_file:
+        try:
+            for chunk in pd.read_csv(filepath_or_buffer=db_file, chunksize=chunk_size, **options):
+                yield chunk if row_filter is None else row_filter.apply(chunk)
+        except Exception as e:
+            msg = f"error while loading cvs file '{csv_file_path}' with options {options}"
+            raise Exception(msg, e)
+
+
+# Same as load_parquet_file, but the db is read by chunks (record batches) of the given number of rows at most.
+def iterate_parquet_file(parquet_file_path: str, options: Mapping[str, any] = None, columns: Sequence[str] = None,
+                         row_filter: DBRowFilter = None, chunk_size: int = DEFAULT_CHUNK_SIZE) \
+        -> Iterator[pd.DataFrame]:
+    return __iterate_arrow_file(parquet_file_path, 'parquet', options, columns, row_filter, chunk_size)
+
+
+# Same as load_feather_file, but the db is read by chunks (record batches) of the given number of rows at most.
+def iterate_feather_file(feather_file_path: str, options: Mapping[str, any] = None, columns: Sequence[str] = None,
+                         row_filter: DBRowFilter = None, chunk_size: int = DEFAULT_CHUNK_SIZE) \
+        -> Iterator[pd.DataFrame]:
+    return __iterate_arrow_file(feather_file_path, 'feather', options, columns, row_filter, chunk_size)
+
+
+def __iterate_arrow_file(file_path: str, file_format: str, options: Mapping[str, any], columns: Sequence[str],
+                         row_filter: DBRowFilter, chunk_size: int) -> Iterator[pd.DataFrame]:
+    try:
+        import pyarrow.dataset as ds
+    except ImportError as e:
+        msg = f"> [ERROR] the {file_format} db format requires pyarrow"
+        raise ConfigurationError(msg, e)
+    options = dict() if options is None else dict(options)
+    predicates = None if row_filter is None else row_filter.compute_pushdown_predicates()
+    try:
+        dataset = ds.dataset(file_path, format=file_format, **options)
+        batches = dataset.to_batches(columns=None if columns is None else list(columns),
+                                     filter=__to_arrow_expression(predicates), batch_size=chunk_size)
+        for batch in batches:
+            if batch.num_rows > 0:
+                chunk = batch.to_pandas()
+                yield chunk if row_filter is None else row_filter.apply(chunk)
+    except Exception as e:
+        msg = f"error while loading {file_format} file '{file_path}' with options {options}"
+        raise Exception(msg, e)
+
+
+def __to_arrow_expression(predicates: Predicates):
+    if not predicates:
+        return None
+    import pyarrow.dataset as ds
+    result = None
+    for conjunction in predicates:
+        expression = None
+        for column_name, operator_name, value in conjunction:
+            predicate = __OPERATORS[operator_name](ds.field(column_name), value)
+            expression = predicate if expression is None else expression & predicate
+        if expression is not None:
+            result = expression if result is None else result | expression
+    return result
+
+
+# A load function takes the path of the db, its options, the columns to be read and a filter of the rows.
+DataFrameLoadFunction = Callable[[str, Mapping[CsvOptName, any], Sequence[str], DBRowFilter], pd.DataFrame]
+
+
+def get_dataframe_load_function(db_type: DBType) -> DataFrameLoadFunction:
     try:
         return __LOAD_TYPE_FUNCTIONS[db_type]
     except KeyError:
@@ -49,8 +249,25 @@ def get_dataframe_load_function(db_type: DBType) -> Callable[[str, Mapping[CsvOp
         raise Exception(msg)
 
 
-__LOAD_TYPE_FUNCTIONS: Mapping[DBType, Callable[[str, Mapping[CsvOptName, any]], pd.DataFrame]] =\
-    {DBType.CSV: load_csv_file}
+__LOAD_TYPE_FUNCTIONS: Mapping[DBType, DataFrameLoadFunction] =\
+    {DBType.CSV: load_csv_file, DBType.PARQUET: load_parquet_file, DBType.FEATHER: load_feather_file}
+
+
+# Same as DataFrameLoadFunction, with the number of rows of the chunks.
+DataFrameChunksLoadFunction = Callable[[str, Mapping[CsvOptName, any], Sequence[str], DBRowFilter, int],
+                                       Iterator[pd.DataFrame]]
+
+
+def get_dataframe_chunks_load_function(db_type: DBType) -> DataFrameChunksLoadFunction:
+    try:
+        return __CHUNKS_LOAD_TYPE_FUNCTIONS[db_type]
+    except KeyError:
+        msg = f"unsupported db type '{db_type}'"
+        raise Exception(msg)
+
+
+__CHUNKS_LOAD_TYPE_FUNCTIONS: Mapping[DBType, DataFrameChunksLoadFunction] =\
+    {DBType.CSV: iterate_csv_file, DBType.PARQUET: iterate_parquet_file, DBType.FEATHER: iterate_feather_file}
 
 
 def create_db_metadata_mapping(lon: str = None, lat: str = None, year: str = None, month: str = None, day: str = None,
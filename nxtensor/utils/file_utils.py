@@ -10,6 +10,7 @@ CSV_FILE_EXTENSION    = 'csv'
 NETCDF_FILE_EXTENSION = 'nc'
 HDF5_FILE_EXTENSION   = 'h5'
 PICKLE_FILE_EXTENSION = 'pkl'
+NUMPY_FILE_EXTENSION  = 'npy'
 
 
 # Count the every single new line in a text file (included the last one).
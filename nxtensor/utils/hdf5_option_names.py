@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 22 09:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+
+# The options of the HDF5 files written by the extraction and the assembly (see hdf5_utils.write_ndarray_to_hdf5).
+class Hdf5OptName:
+
+    COMPRESSION       = 'compression'        # 'gzip', 'lzf' or None (default).
+    COMPRESSION_LEVEL = 'compression_level'  # From 0 to 9, for gzip only (default: 4).
+    SHUFFLE           = 'shuffle'            # Byte shuffle before compression (default: False).
+    # The number of images per chunk (default: 1). 0 writes a contiguous dataset, unless it is compressed (the
+    # chunk shape is guessed by h5py).
+    CHUNK_SIZE        = 'chunk_size'
@@ -1,16 +1,151 @@
+from contextlib import contextmanager
+from typing import Dict, Iterator, Mapping, Tuple, Union
 
+import os
+import os.path as path
 
 import h5py
 import numpy as np
 
+from nxtensor.exceptions import ConfigurationError
+from nxtensor.utils.hdf5_option_names import Hdf5OptName
 
-def write_ndarray_to_hdf5(file_path: str, ndarray: np.ndarray) -> None:
-    hdf5_file = h5py.File(file_path, 'w')
-    hdf5_file.create_dataset('dataset', data=ndarray)
-    hdf5_file.close()
+DATA_DATASET_NAME: str = 'dataset'
+# The compound dataset of the metadata of the data, when they are stored in the same file.
+METADATA_DATASET_NAME: str = 'metadata'
 
+DEFAULT_CHUNK_SIZE: int = 1
+DEFAULT_GZIP_LEVEL: int = 4
+__COMPRESSIONS = ('gzip', 'lzf')
 
-def read_ndarray_from_hdf5(file_path: str) -> np.ndarray:
-    hdf5_file = h5py.File(file_path, 'r')
-    data = hdf5_file.get('dataset')
-    return np.array(data)
+
+# The data is written with the given type, if any (e.g. 'float32'), otherwise with the type of the ndarray.
+# The metadata (a structured array, e.g. a block of extraction metadata), if any, is written in the same file as a
+# compound dataset.
+# The data is chunked and compressed according to the given options (see Hdf5OptName): one image per chunk by
+# default, so as to read any image without reading its neighbours.
+# The given attributes (e.g. the statistics of the data) are attached to the data dataset.
+# The file is removed if the writing fails, so as not to leave a partial file.
+def write_ndarray_to_hdf5(file_path: str, ndarray: np.ndarray, dtype: str = None, metadata: np.ndarray = None,
+                          options: Mapping[str, any] = None, attributes: Mapping[str, any] = None) -> None:
+    dataset_options = compute_dataset_options(ndarray.shape, options)
+    try:
+        with h5py.File(file_path, 'w') as hdf5_file:
+            dataset = hdf5_file.create_dataset(DATA_DATASET_NAME, data=ndarray, dtype=dtype, **dataset_options)
+            if attributes:
+                dataset.attrs.update(attributes)
+            if metadata is not None:
+                hdf5_file.create_dataset(METADATA_DATASET_NAME, data=__encode_strings(metadata))
+    except BaseException:
+        if path.exists(file_path):
+            os.remove(file_path)
+        raise
+
+
+# Yield an empty dataset of the given shape and type, so as to write the data by slices (e.g. block after block).
+# The dataset is chunked and compressed like write_ndarray_to_hdf5. The file is closed at the exit of the context.
+@contextmanager
+def create_hdf5_dataset(file_path: str, shape: tuple, dtype: Union[str, np.dtype],
+                        options: Mapping[str, any] = None) -> Iterator[h5py.Dataset]:
+    with h5py.File(file_path, 'w') as hdf5_file:
+        yield hdf5_file.create_dataset(DATA_DATASET_NAME, shape=shape, dtype=dtype,
+                                       **compute_dataset_options(shape, options))
+
+
+# Return the keyword arguments of h5py create_dataset for a dataset of the given shape and the given options.
+def compute_dataset_options(shape: tuple, options: Mapping[str, any] = None) -> Dict[str, any]:
+    options = options if options else dict()
+    compression = options.get(Hdf5OptName.COMPRESSION)
+    if compression is not None and compression not in __COMPRESSIONS:
+        msg = f"> [ERROR] unsupported HDF5 compression '{compression}' (supported: {', '.join(__COMPRESSIONS)})"
+        raise ConfigurationError(msg)
+    result: Dict[str, any] = dict()
+    # Empty datasets can't be chunked (nor compressed).
+    if len(shape) == 0 or not all(shape):
+        return result
+    if compression is not None:
+        result['compression'] = compression
+        if compression == 'gzip':
+            result['compression_opts'] = options.get(Hdf5OptName.COMPRESSION_LEVEL, DEFAULT_GZIP_LEVEL)
+    if options.get(Hdf5OptName.SHUFFLE, False):
+        result['shuffle'] = True
+    chunk_size = options.get(Hdf5OptName.CHUNK_SIZE, DEFAULT_CHUNK_SIZE)
+    if chunk_size:
+        result['chunks'] = (min(chunk_size, shape[0]), *shape[1:])
+    return result
+
+
+# Yield the (lazy) dataset of the given file: nothing is read until the dataset is sliced or read_direct is called.
+# The file is closed at the exit of the context.
+@contextmanager
+def open_hdf5_dataset(file_path: str, dataset_name: str = DATA_DATASET_NAME) -> Iterator[h5py.Dataset]:
+    with h5py.File(file_path, 'r') as hdf5_file:
+        yield hdf5_file[dataset_name]
+
+
+# Return the data, or only the given selection of the data (e.g. np.s_[10:20]), read without intermediate copy.
+def read_ndarray_from_hdf5(file_path: str, selection: Union[slice, Tuple] = None) -> np.ndarray:
+    with open_hdf5_dataset(file_path) as dataset:
+        return dataset[()] if selection is None else dataset[selection]
+
+
+# Read the data (or the source selection of the data) directly into the given preallocated array (or the
+# destination selection of the array, e.g. np.s_[..., 2] for the third channel of a tensor). The array must be
+# C-contiguous; the values are converted into its type by HDF5.
+def read_ndarray_into(file_path: str, destination: np.ndarray, source_selection: Union[slice, Tuple] = None,
+                      destination_selection: Union[slice, Tuple] = None) -> None:
+    with open_hdf5_dataset(file_path) as dataset:
+        read_dataset_into(dataset, destination, source_selection, destination_selection)
+
+
+# See read_ndarray_into.
+def read_dataset_into(dataset: h5py.Dataset, destination: np.ndarray, source_selection: Union[slice, Tuple] = None,
+                      destination_selection: Union[slice, Tuple] = None) -> None:
+    # HDF5 can't select in empty datasets.
+    if dataset.size == 0:
+        return
+    dataset.read_direct(destination, source_selection, destination_selection)
+
+
+# Return the metadata written with the data (see write_ndarray_to_hdf5).
+def read_metadata_from_hdf5(file_path: str) -> np.ndarray:
+    with h5py.File(file_path, 'r') as hdf5_file:
+        return __decode_strings(hdf5_file[METADATA_DATASET_NAME][()])
+
+
+# Return the attributes of the data (see write_ndarray_to_hdf5).
+def read_attributes_from_hdf5(file_path: str) -> Dict[str, any]:
+    with open_hdf5_dataset(file_path) as dataset:
+        return dict(dataset.attrs)
+
+
+# Return the number of rows of the data, read from the shape of the dataset.
+def read_nb_rows_from_hdf5(file_path: str) -> int:
+    with h5py.File(file_path, 'r') as hdf5_file:
+        return hdf5_file[DATA_DATASET_NAME].shape[0]
+
+
+# HDF5 doesn't support the unicode strings of NumPy: they are stored as UTF-8 fixed-length byte strings.
+def __encode_strings(structured_array: np.ndarray) -> np.ndarray:
+    string_names = [name for name in structured_array.dtype.names if structured_array.dtype[name].kind == 'U']
+    if not string_names:
+        return structured_array
+    fields = {name: np.char.encode(structured_array[name], 'utf-8') if name in string_names
+              else structured_array[name] for name in structured_array.dtype.names}
+    return __create_structured_array(fields, len(structured_array))
+
+
+def __decode_strings(structured_array: np.ndarray) -> np.ndarray:
+    string_names = [name for name in structured_array.dtype.names if structured_array.dtype[name].kind == 'S']
+    if not string_names:
+        return structured_array
+    fields = {name: np.char.decode(structured_array[name], 'utf-8') if name in string_names
+              else structured_array[name] for name in structured_array.dtype.names}
+    return __create_structured_array(fields, len(structured_array))
+
+
+def __create_structured_array(fields, nb_rows: int) -> np.ndarray:
+    result = np.empty(nb_rows, dtype=[(name, values.dtype) for name, values in fields.items()])
+    for name, values in fields.items():
+        result[name] = values
+    return result
@@ -39,6 +39,9 @@ __DATA_BLOCK_FILENAME_TEMPLATE: str = '{}' + NAME_SEPARATOR + 'data.' + fu.HDF5_
 __METADATA_BLOCK_FILENAME_TEMPLATE: str = '{}' + NAME_SEPARATOR + 'metadata.' + fu.CSV_FILE_EXTENSION
 __STAT_FILENAME_TEMPLATE: str = '{}' + NAME_SEPARATOR + 'stats.' + fu.CSV_FILE_EXTENSION
 __PREPROCESSING_FILENAME_TEMPLATE: str = '{}' + NAME_SEPARATOR + 'preprocessing.' + fu.PICKLE_FILE_EXTENSION
+__MANIFEST_FILENAME_TEMPLATE: str = '{}' + NAME_SEPARATOR + 'manifest.' + fu.CSV_FILE_EXTENSION
+# {} stands for the period and the label id of the block.
+__PREPROCESSING_BLOCK_FILENAME_TEMPLATE: str = '{}' + NAME_SEPARATOR + '{}.' + fu.NUMPY_FILE_EXTENSION
 
 
 def compute_data_meta_data_file_path(str_id: str, parent_dir_path: str, *other_filename_prefixes: str)\
@@ -66,6 +69,21 @@ def compute_preprocessing_file_path(str_id: str, preprocessing_kind: str, parent
     return __PREPROCESSING_FILENAME_TEMPLATE.format(preprocessing_file_path_prefix)
 
 
+# The blocks of a preprocessing are saved in a directory next to the preprocessing file (its index).
+def compute_preprocessing_blocks_dir_path(preprocessing_file_path: str) -> str:
+    return f"{path.splitext(preprocessing_file_path)[0]}{NAME_SEPARATOR}blocks"
+
+
+def compute_preprocessing_block_file_path(preprocessing_file_path: str, period: Period, label_id: LabelId) -> str:
+    return path.join(compute_preprocessing_blocks_dir_path(preprocessing_file_path),
+                     __PREPROCESSING_BLOCK_FILENAME_TEMPLATE.format(create_period_str(period), label_id))
+
+
+# The manifest of the blocks of a variable is located at the root of the blocks directory.
+def compute_manifest_file_path(str_id: str, blocks_dir_path: str) -> str:
+    return path.join(blocks_dir_path, __MANIFEST_FILENAME_TEMPLATE.format(str_id))
+
+
 def create_period_str(period: Period) -> str:
     return __parts_concatenation(period)
 
@@ -95,6 +113,7 @@ def __all_tests():
     print(compute_data_meta_data_file_path(str_id, parent_dir_path, 'otherId'))
     print(compute_data_meta_data_file_template_path(str_id, parent_dir_path, 'otherId'))
     print(compute_preprocessing_file_path(str_id, 'kind', parent_dir_path))
+    print(compute_manifest_file_path(str_id, parent_dir_path))
 
 
 if __name__ == '__main__':
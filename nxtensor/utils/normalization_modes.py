@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 25 09:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+
+# The normalizations of the channels (see normalization.compute_normalization_parameters).
+class NormalizationMode:
+
+    STANDARD        = 'standard'         # (x - mean) / std.
+    ROBUST          = 'robust'           # (x - median) / IQR, for the heavy-tailed variables.
+    # x clipped into the [low, high] percentiles, then scaled into [0, 1]: (x - low) / (high - low).
+    PERCENTILE_CLIP = 'percentile_clip'
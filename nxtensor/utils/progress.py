@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:00:00 2026
+
+@author: sebastien@gardoll.fr
+"""
+
+import time
+
+import nxtensor.utils.time_utils as tu
+
+
+def format_nbytes(nb_bytes: float) -> str:
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(nb_bytes) < 1024:
+            return f'{nb_bytes:.1f} {unit}'
+        nb_bytes /= 1024
+    return f'{nb_bytes:.1f} TiB'
+
+
+class ProgressMeter:
+
+    # Throughput and estimated time of arrival of a processing of regions (extracted, normalized, etc.).
+    def __init__(self, total_nb_regions: int):
+        self.total_nb_regions: int = total_nb_regions
+        self.nb_regions: int = 0
+        self.nb_bytes: int = 0
+        self.__start: float = time.time()
+
+    def update(self, nb_regions: int, nb_bytes: int = 0) -> None:
+        self.nb_regions += nb_regions
+        self.nb_bytes += nb_bytes
+
+    def get_elapsed_time(self) -> float:
+        return time.time() - self.__start
+
+    def get_regions_per_second(self) -> float:
+        elapsed_time = self.get_elapsed_time()
+        return self.nb_regions / elapsed_time if elapsed_time > 0 else 0.
+
+    # Return the estimated remaining time in seconds, None if it is unknown.
+    def get_eta(self) -> float:
+        regions_per_second = self.get_regions_per_second()
+        if regions_per_second == 0:
+            return None
+        return (self.total_nb_regions - self.nb_regions) / regions_per_second
+
+    def __str__(self) -> str:
+        eta = self.get_eta()
+        eta_str = 'unknown' if eta is None else tu.display_duration(eta)
+        percentage = self.nb_regions * 100. / self.total_nb_regions if self.total_nb_regions else 100.
+        return f'{self.nb_regions}/{self.total_nb_regions} regions ({percentage:.1f}%), ' \
+               f'{self.get_regions_per_second():.1f} regions/s, {format_nbytes(self.nb_bytes)} written, ' \
+               f'ETA: {eta_str}'
@@ -7,14 +7,16 @@ Created on Wed Apr  22 11:14:54 2020
 """
 
 
-from typing import Dict, Tuple, List
+from typing import Callable, Dict, Iterable, Tuple, List
+
+import functools
 
 from nxtensor.extraction import ExtractionConfig
 from nxtensor.extractor import ExtractionVisitor
-from nxtensor.variable import Variable
+from nxtensor.variable import Variable, VariableNetcdfFilePathVisitor
 
 import nxtensor.core.xarray_channel_extraction as chan_xtract
-from nxtensor.core.types import LabelId, MetaDataBlock, Period, DBMetadataMapping
+from nxtensor.core.types import LabelId, MetaDataBlock, Period, DBMetadataMapping, BlockHandler
 
 import pandas as pd
 
@@ -24,21 +26,35 @@ import os.path as path
 
 import nxtensor.utils.db_utils as du
 import nxtensor.utils.naming_utils as nu
+import nxtensor.utils.time_utils as tu
 
 
-# Single process - single thread.
+# Single process - single thread, unless the preprocessing chunk size is set (see ExtractionConfig).
 def preprocess_extraction(extraction_conf_file_path: str) -> None:
     extraction_conf = ExtractionConfig.load(extraction_conf_file_path)
     print(f"> starting pre-process of extraction '{extraction_conf.str_id}'")
     db_metadata_mappings: Dict[LabelId, DBMetadataMapping] = dict()
     extraction_metadata_blocks: Dict[LabelId, pd.DataFrame] = dict()
+    db_chunk_iterators: Dict[LabelId, Callable[[], Iterable[pd.DataFrame]]] = dict()
     label_num_ids = dict()
+    chunk_size = extraction_conf.preprocessing_chunk_size
     for label_id, label in extraction_conf.get_labels().items():
         label_num_ids[label_id] = label.num_id
         db_metadata_mappings[label_id] = label.db_meta_data_mapping
-        dataframe_load_function = du.get_dataframe_load_function(label.db_format)
-        extraction_metadata_block = dataframe_load_function(label.db_file_path, label.db_open_options)
-        extraction_metadata_blocks[label_id] = extraction_metadata_block
+        # Only the columns of the mapping are read and the rows out of the time range or the bounding box of the
+        # label are dropped (in the read for the columnar db formats).
+        row_filter = du.DBRowFilter(label.db_meta_data_mapping, label.db_start_date, label.db_end_date,
+                                    label.db_bounding_box)
+        columns = list(label.db_meta_data_mapping.values())
+        if chunk_size:
+            chunks_load_function = du.get_dataframe_chunks_load_function(label.db_format)
+            db_chunk_iterators[label_id] = functools.partial(chunks_load_function, label.db_file_path,
+                                                             label.db_open_options, columns, row_filter, chunk_size)
+        else:
+            dataframe_load_function = du.get_dataframe_load_function(label.db_format)
+            extraction_metadata_block = dataframe_load_function(label.db_file_path, label.db_open_options, columns,
+                                                                row_filter)
+            extraction_metadata_blocks[label_id] = extraction_metadata_block
 
     netcdf_period_resolution = None
     for variable in extraction_conf.get_variables().values():
@@ -47,12 +63,20 @@ def preprocess_extraction(extraction_conf_file_path: str) -> None:
 
     preprocessing_output_file_path = __generate_preprocessing_file_path(extraction_conf)
 
-    chan_xtract.preprocess_extraction(preprocessing_output_file_path=preprocessing_output_file_path,
-                                      extraction_metadata_blocks=extraction_metadata_blocks,
-                                      db_metadata_mappings=db_metadata_mappings,
-                                      netcdf_file_time_period=netcdf_period_resolution,
-                                      label_num_ids=label_num_ids,
-                                      inplace=True)
+    if chunk_size:
+        chan_xtract.preprocess_extraction_by_chunks(preprocessing_output_file_path=preprocessing_output_file_path,
+                                                    db_chunk_iterators=db_chunk_iterators,
+                                                    db_metadata_mappings=db_metadata_mappings,
+                                                    netcdf_file_time_period=netcdf_period_resolution,
+                                                    label_num_ids=label_num_ids,
+                                                    nb_workers=extraction_conf.nb_process)
+    else:
+        chan_xtract.preprocess_extraction(preprocessing_output_file_path=preprocessing_output_file_path,
+                                          extraction_metadata_blocks=extraction_metadata_blocks,
+                                          db_metadata_mappings=db_metadata_mappings,
+                                          netcdf_file_time_period=netcdf_period_resolution,
+                                          label_num_ids=label_num_ids,
+                                          inplace=True)
     print('> pre-process is completed')
 
 
@@ -66,7 +90,16 @@ class __SquareExtractionProcessor(chan_xtract.BlockProcessor):
         self.__extraction_conf = extraction_conf
         self.__variable = variable
 
-    def process_blocks(self, period: Period, extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]]) \
+    def get_blocks_dir_path(self) -> str:
+        return self.__extraction_conf.blocks_dir_path
+
+    def count_source_files(self, period: Period) -> int:
+        visitor = VariableNetcdfFilePathVisitor(tu.from_time_list_to_dict(period))
+        self.__variable.accept(visitor)
+        return len(visitor.get_result())
+
+    def process_blocks(self, period: Period, extraction_metadata_blocks: List[Tuple[LabelId, MetaDataBlock]],
+                       block_handler: BlockHandler = None) \
             -> Tuple[str, List[Tuple[LabelId, xr.DataArray, MetaDataBlock]]]:
         # Must be a integer !!! TODO: check for that when designing an extraction.
         half_lat_frame = int((self.__extraction_conf.y_size * self.__variable.lat_resolution)/2)
@@ -77,15 +110,22 @@ class __SquareExtractionProcessor(chan_xtract.BlockProcessor):
                                                          half_lat_frame=half_lat_frame,
                                                          half_lon_frame=half_lon_frame,
                                                          dask_scheduler=self.__extraction_conf.dask_scheduler,
-                                                         shape=self.__extraction_conf.extraction_shape)
+                                                         shape=self.__extraction_conf.extraction_shape,
+                                                         mode=self.__extraction_conf.extraction_mode,
+                                                         reader_backend=self.__extraction_conf.reader_backend,
+                                                         block_handler=block_handler)
         self.__variable.accept(extractor)
         result: Tuple[str, List[Tuple[LabelId, xr.DataArray, MetaDataBlock]]] = \
-            (self.__extraction_conf.blocks_dir_path, extractor.get_result())
+            (self.get_blocks_dir_path(), extractor.get_result())
 
         return result
 
 
-def extract(extraction_conf_file_path: str, variable_id: str) -> Dict[Period, Dict[str, Dict[str, str]]]:
+# The blocks already extracted by a previous call are skipped, unless has_to_resume is false.
+# When is_incremental is true, the blocks are compared with the ones of the previous extraction (after a new
+# preprocessing): only the new and changed rows are extracted (see xarray_channel_extraction.extract).
+def extract(extraction_conf_file_path: str, variable_id: str, has_to_resume: bool = True,
+            is_incremental: bool = False) -> Dict[Period, Dict[str, Dict[str, str]]]:
     extraction_conf = ExtractionConfig.load(extraction_conf_file_path)
     variable: Variable = extraction_conf.get_variables()[variable_id]
     preprocess_input_file_path = __generate_preprocessing_file_path(extraction_conf)
@@ -94,7 +134,13 @@ def extract(extraction_conf_file_path: str, variable_id: str) -> Dict[Period, Di
     file_paths = chan_xtract.extract(variable_id=variable_id,
                                      preprocess_input_file_path=preprocess_input_file_path,
                                      block_processor=block_processor,
-                                     nb_workers=extraction_conf.nb_process)
+                                     nb_workers=extraction_conf.nb_process,
+                                     dtype=extraction_conf.dtype,
+                                     scheduling_policy=extraction_conf.scheduling_policy,
+                                     has_to_resume=has_to_resume,
+                                     is_incremental=is_incremental,
+                                     block_format=extraction_conf.block_format,
+                                     hdf5_options=extraction_conf.block_hdf5_options)
     return file_paths
 
 
@@ -31,7 +31,10 @@ setuptools.setup(
         'numpy>=1.18.1',
         'pandas>=1.0.3',
         'pyyaml>=5.3.1',
-        'scikit-learn>=0.22.1',
         'xarray>=0.15.1'
     ],
+    extras_require={
+        # Parquet and Feather label databases.
+        'arrow': ['pyarrow>=1.0.0']
+    },
 )